@@ -0,0 +1,42 @@
+"""Benchmark: pack/unpack cost and size of each message type with the JSON and binary payload codecs.
+
+Usage: python bench_codec.py [--number 100000]
+"""
+import argparse
+import timeit
+
+import protocol
+
+SAMPLES = {
+    'LOGIN': (protocol.MSG_TYPE_LOGIN, {'codecs': list(protocol.SUPPORTED_CODECS)}),
+    'TEXT_BROADCAST_UDP': (protocol.MSG_TYPE_TEXT_BROADCAST_UDP, {'text': 'Hello everyone, how is the project going?'}),
+    'PRIVATE_TEXT_UDP': (protocol.MSG_TYPE_PRIVATE_TEXT_UDP, {'recipient': 'bob', 'text': 'See you at the lab at five.'}),
+    'ACK_TCP': (protocol.MSG_TYPE_ACK_TCP, {}),
+    'USER_LIST_TCP': (protocol.MSG_TYPE_USER_LIST_TCP, {'users': [f'user{i}' for i in range(50)]}),
+    'PING_REQUEST_TCP': (protocol.MSG_TYPE_PING_REQUEST_TCP, {'recipient': 'bob'}),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=100000, help="Iterations per measurement.")
+    args = parser.parse_args()
+
+    print(f"{'message type':<20} {'codec':<7} {'bytes':>6} {'pack ns':>9} {'unpack ns':>10} {'route ns':>9}")
+    for name, (msg_type, payload) in SAMPLES.items():
+        for codec in (protocol.CODEC_JSON, protocol.CODEC_BINARY):
+            packet = protocol.pack_data(msg_type, 'alice', 1, payload, codec)
+            header, body = packet[:protocol.HEADER_SIZE], packet[protocol.HEADER_SIZE:]
+            flags = protocol.header_flags(header)
+
+            pack = timeit.timeit(lambda: protocol.pack_data(msg_type, 'alice', 1, payload, codec), number=args.number)
+            unpack = timeit.timeit(lambda: (protocol.unpack_header(header), protocol.unpack_payload(body, flags)), number=args.number)
+            route = timeit.timeit(lambda: protocol.peek_recipient(body, flags), number=args.number) if 'recipient' in payload else None
+
+            ns = 1e9 / args.number
+            route_text = f"{route * ns:>9.0f}" if route is not None else f"{'-':>9}"
+            print(f"{name:<20} {protocol.frame_codec(packet):<7} {len(packet):>6} {pack * ns:>9.0f} {unpack * ns:>10.0f} {route_text}")
+
+
+if __name__ == '__main__':
+    main()
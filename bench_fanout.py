@@ -0,0 +1,96 @@
+"""Benchmark: broadcast fan-out throughput of ChatServer to many recipients.
+
+Connects N real TCP sockets to a sink process, registers them as logged-in users and
+pushes broadcasts through ChatServer.broadcast_message. Reports messages delivered
+per second (messages x recipients / elapsed) for two paths:
+
+- naive:  one sendall() per recipient from the routing thread (the original behaviour)
+- queued: shared frame, per-client outbound queues, batched sendmsg() from the writer
+
+Usage: python bench_fanout.py [--recipients 1000 5000 10000] [--messages 200] [--size 128]
+"""
+import argparse
+import logging
+import multiprocessing
+import selectors
+import socket
+import time
+
+import protocol
+import server
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def sink(pipe, expected_connections):
+    """Accepts connections and discards everything it reads, reporting byte counts on request."""
+    listener = socket.socket(); listener.bind(('127.0.0.1', 0)); listener.listen(1024)
+    pipe.send(listener.getsockname()[1])
+    selector = selectors.DefaultSelector()
+    for _ in range(expected_connections):
+        conn, _ = listener.accept(); conn.setblocking(False)
+        selector.register(conn, selectors.EVENT_READ)
+    pipe.send('ready')
+    while True:
+        target = pipe.recv()
+        if target is None: return
+        received = 0
+        while received < target:
+            for key, _ in selector.select():
+                received += len(key.fileobj.recv(262144))
+        pipe.send(received)
+
+
+def run(recipients, messages, size, mode):
+    pipe, child_pipe = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=sink, args=(child_pipe, recipients), daemon=True); process.start()
+    port = pipe.recv()
+    chat_server = server.ChatServer('127.0.0.1', 0, 0)
+    chat_server.writer.start()
+    for i in range(recipients):
+        conn = socket.create_connection(('127.0.0.1', port))
+        chat_server.clients.add(f'user{i}', {'tcp_socket': conn, 'tcp_address': conn.getsockname(), 'outbound': chat_server.create_outbound_queue(on_ready=chat_server.writer.notify, sock=conn)})
+    pipe.recv()
+
+    frames = [protocol.pack_data(protocol.MSG_TYPE_TEXT_BROADCAST_UDP, 'bench', seq, {'text': 'x' * size}) for seq in range(1, messages + 1)]
+    pipe.send(sum(len(frame) for frame in frames) * recipients)
+    start = time.perf_counter()
+    for frame in frames:
+        if mode == 'naive':
+            with chat_server.clients.lock:
+                for client_info in chat_server.clients.values(): client_info['tcp_socket'].sendall(frame)
+        else:
+            chat_server.broadcast_message(frame, 'bench')
+    pipe.recv()
+    elapsed = time.perf_counter() - start
+
+    pipe.send(None); process.join()
+    for client_info in chat_server.clients.values(): client_info['tcp_socket'].close()
+    chat_server.tcp_socket.close(); chat_server.udp_socket.close()
+    return messages * recipients / elapsed, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--recipients', type=int, nargs='+', default=[1000, 5000, 10000])
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--size', type=int, default=128, help="Length of the text in each message.")
+    args = parser.parse_args()
+
+    logging.getLogger('ChatServer').setLevel(logging.WARNING)
+    if resource:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    print(f"{'recipients':>10} {'mode':>7} {'delivered msg/s':>16} {'elapsed s':>10}")
+    for recipients in args.recipients:
+        for mode in ('naive', 'queued'):
+            rate, elapsed = run(recipients, args.messages, args.size, mode)
+            print(f"{recipients:>10} {mode:>7} {rate:>16,.0f} {elapsed:>10.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""Benchmark: append rate, index rebuild time and scrollback latency of the message history store.
+
+Fills a temporary store with N broadcast and private message frames spread over many
+conversations, then measures reopening it (rebuilding the index from the segments),
+fetching the newest page of the public room, and fetching pages at random depths.
+
+Usage: python bench_history.py [--messages 1000000] [--conversations 1000] [--page 50] [--pages 1000]
+"""
+import argparse
+import random
+import shutil
+import tempfile
+import time
+
+import history
+import protocol
+
+
+def percentile_ms(samples, p):
+    return sorted(samples)[min(int(p / 100 * len(samples)), len(samples) - 1)] * 1000
+
+
+def measure_pages(store, keys, page_size, pages, newest):
+    samples = []
+    for _ in range(pages):
+        key = random.choice(keys)
+        before = None if newest else random.randrange(store.count(key) + 1)
+        start = time.perf_counter(); store.page(key, before, page_size); samples.append(time.perf_counter() - start)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--conversations', type=int, default=1000, help="Private conversations besides the public room.")
+    parser.add_argument('--page', type=int, default=protocol.HISTORY_PAGE_SIZE, help="Messages per page.")
+    parser.add_argument('--pages', type=int, default=1000, help="Pages fetched per measurement.")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='chat-history-')
+    try:
+        keys = [history.PUBLIC] + [history.conversation_key(f'user{i}', f'user{i + 1}') for i in range(args.conversations)]
+        frames = [protocol.pack_data(protocol.MSG_TYPE_TEXT_BROADCAST_UDP, f'user{i}', i, {'text': f'History benchmark message number {i}.'}, protocol.CODEC_BINARY) for i in range(1000)]
+
+        store = history.HistoryStore(directory)
+        start = time.perf_counter()
+        for i in range(args.messages): store.append(keys[0] if i % 2 else keys[i % len(keys)], frames[i % len(frames)])
+        elapsed = time.perf_counter() - start
+        print(f"append:          {args.messages / elapsed:>12,.0f} msg/s  ({len(store.segments)} segments)")
+        store.close()
+
+        start = time.perf_counter(); store = history.HistoryStore(directory); elapsed = time.perf_counter() - start
+        print(f"reopen + index:  {elapsed:>12.2f} s      ({sum(store.count(key) for key in keys):,} messages)")
+
+        for name, sample_keys, newest in (('newest public page', keys[:1], True), ('random public page', keys[:1], False), ('random private page', keys[1:], False)):
+            samples = measure_pages(store, sample_keys, args.page, args.pages, newest)
+            print(f"{name + ':':<20} p50 {percentile_ms(samples, 50):.3f} ms  p99 {percentile_ms(samples, 99):.3f} ms")
+        store.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""Benchmark: server memory per idle logged-in connection, for each engine.
+
+Starts the server on free ports, logs in --users clients, lets every one of them send one
+PING_REQUEST of --frame bytes (so the server has read a frame far larger than a read buffer on
+every connection), waits until all of them are idle and reports how much the server's
+resident memory grew per connection. Exits with status 1 if that is above --max-kb, as it
+is when every connection keeps a 64 KB read buffer. On the threads engine the figure
+includes the stack each connection's thread has touched.
+
+Reads the server's RSS from /proc, so it runs on Linux only.
+
+Usage: python bench_idle.py [--users 2000] [--frame 65536] [--max-kb 48]
+"""
+import argparse
+import logging
+import multiprocessing
+import selectors
+import socket
+import sys
+import time
+
+import protocol
+import server
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+SETTLE_TIME = 1.0
+FEATURES = [protocol.FEATURE_ROSTER_DELTA]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0)); return sock.getsockname()[1]
+
+
+def serve(engine, tcp_port, udp_port):
+    logging.getLogger('ChatServer').setLevel(logging.ERROR)
+    server.ENGINES[engine]('127.0.0.1', tcp_port, udp_port, probe_interval=0).start()
+
+
+def rss_kb(pid):
+    with open(f'/proc/{pid}/status') as status:
+        return next(int(line.split()[1]) for line in status if line.startswith('VmRSS:'))
+
+
+def pump(selector, duration):
+    """Reads and discards everything that arrives for duration seconds; returns the names logged in meanwhile."""
+    ready = set(); end = time.perf_counter() + duration
+    while (remaining := end - time.perf_counter()) > 0:
+        for key, _ in selector.select(remaining):
+            name, reader = key.data
+            frames = reader.read_frames()
+            if frames is None: selector.unregister(key.fileobj); continue
+            if any(frame.msg_type == protocol.MSG_TYPE_USER_LIST_TCP for frame in frames): ready.add(name)
+    return ready
+
+
+def run(engine, users, frame):
+    tcp_port, udp_port = free_port(), free_port()
+    server_process = multiprocessing.Process(target=serve, args=(engine, tcp_port, udp_port)); server_process.start()
+    time.sleep(0.5); pump(selectors.DefaultSelector(), SETTLE_TIME)
+    baseline = rss_kb(server_process.pid)
+
+    selector = selectors.DefaultSelector(); sockets = []; ready = set()
+    for i in range(users):
+        sock = socket.create_connection(('127.0.0.1', tcp_port)); sockets.append(sock)
+        sock.sendall(protocol.pack_data(protocol.MSG_TYPE_LOGIN, f'user{i}', 0, {'codecs': [protocol.CODEC_BINARY], 'features': FEATURES}, protocol.CODEC_BINARY))
+        selector.register(sock, selectors.EVENT_READ, (f'user{i}', protocol.FrameReader(sock)))
+        if i % 100 == 99: ready |= pump(selector, 0.01)
+    while len(ready) < users: ready |= pump(selector, 0.1)
+    # A PING_REQUEST to a user that is not logged in is read whole and dropped.
+    ping = protocol.pack_data(protocol.MSG_TYPE_PING_REQUEST_TCP, 'bench', 0, {'recipient': 'nobody', 'padding': 'x' * frame})
+    for sock in sockets: sock.sendall(ping)
+    pump(selector, SETTLE_TIME)
+    grown = rss_kb(server_process.pid) - baseline
+
+    server_process.terminate(); server_process.join()
+    for sock in sockets: sock.close()
+    return grown / users
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--frame', type=int, default=65536, help="Size of the frame every client sends once.")
+    parser.add_argument('--max-kb', type=float, default=48.0, help="Most KB of server memory an idle connection may cost.")
+    args = parser.parse_args()
+
+    if resource:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    print(f"{args.users} idle connections, each after one {args.frame:,} byte frame")
+    print(f"{'engine':>8} {'KB per connection':>18}")
+    failed = False
+    for engine in sorted(server.ENGINES):
+        per_connection = run(engine, args.users, args.frame)
+        failed |= per_connection > args.max_kb
+        print(f"{engine:>8} {per_connection:>18.1f}{'  over --max-kb' if per_connection > args.max_kb else ''}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
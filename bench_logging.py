@@ -0,0 +1,81 @@
+"""Benchmark: forward latency of ChatServer.process_udp_packet with logging off and on.
+
+Registers two users and routes private UDP messages between them, each of which logs
+a forward and an ACK line at INFO. Reports per-message latency (p50/p99/p999) and the
+time to write out whatever was still queued when the last message was routed, for:
+
+- off:     the ChatServer logger at WARNING
+- sync:    file and console handlers called from the routing thread (the original setup)
+- queued:  serverlog.LogPipeline, every line logged
+- sampled: serverlog.LogPipeline with the default per-message rate limit (server.events)
+
+The console output goes to os.devnull, so a slow terminal does not skew the results.
+
+Usage: python bench_logging.py [--messages 200000]
+"""
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import protocol
+import reliability
+import server
+import serverlog
+
+
+def percentile_us(samples, p):
+    return samples[min(int(p / 100 * len(samples)), len(samples) - 1)] * 1e6
+
+
+def route(chat_server, messages):
+    """Sends `messages` private messages from alice to bob; returns the sorted latencies."""
+    frames = [protocol.pack_data(protocol.MSG_TYPE_PRIVATE_TEXT_UDP, 'alice', seq, {'text': 'Logging benchmark message.', 'recipient': 'bob'}) for seq in range(1, messages + 1)]
+    queues = [client_info['outbound'] for client_info in chat_server.clients.values()]
+    samples = []
+    for frame in frames:
+        start = time.perf_counter(); chat_server.process_udp_packet(frame, ('127.0.0.1', 1)); samples.append(time.perf_counter() - start)
+        for queue in queues: queue.take_all()
+    return sorted(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=200000)
+    args = parser.parse_args()
+
+    log = logging.getLogger('ChatServer')
+    directory = tempfile.mkdtemp(prefix='chat-logging-')
+    devnull = open(os.devnull, 'w')
+    try:
+        for mode in ('off', 'sync', 'queued', 'sampled'):
+            chat_server = server.ChatServer('127.0.0.1', 0, 0)
+            for name in ('alice', 'bob'):
+                chat_server.clients.add(name, {'username': name, 'tcp_address': None, 'features': set(), 'dedup': reliability.DedupWindow(), 'acks': reliability.AckBatcher(), 'outbound': chat_server.create_outbound_queue()})
+            path = os.path.join(directory, f'{mode}.log')
+            handlers, pipeline = [], None
+            log.setLevel(logging.WARNING if mode == 'off' else logging.INFO)
+            if mode == 'sync':
+                handlers = [logging.FileHandler(path), logging.StreamHandler(devnull)]
+                for handler in handlers: handler.setFormatter(logging.Formatter(serverlog.TEXT_FORMAT)); log.addHandler(handler)
+            elif mode != 'off':
+                pipeline = serverlog.LogPipeline(log, path, max_bytes=0, stream=devnull)
+            server.events.limiter.rate = serverlog.EVENT_RATE if mode == 'sampled' else 0
+
+            start = time.perf_counter(); samples = route(chat_server, args.messages); elapsed = time.perf_counter() - start
+            start = time.perf_counter()
+            if pipeline: pipeline.stop()
+            for handler in handlers: log.removeHandler(handler); handler.close()
+            drain = time.perf_counter() - start
+            lines = sum(1 for name in os.listdir(directory) if name.startswith(f'{mode}.log') for _ in open(os.path.join(directory, name)))
+            print(f"{mode:<8} {args.messages / elapsed:>9,.0f} msg/s  p50 {percentile_us(samples, 50):6.1f} us  p99 {percentile_us(samples, 99):6.1f} us  p999 {percentile_us(samples, 99.9):7.1f} us  drain {drain:5.2f} s  {lines:>7,} lines")
+            chat_server.tcp_socket.close(); chat_server.udp_socket.close()
+    finally:
+        devnull.close()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""Benchmark: what a mass reconnect costs with session resumption and with a full re-login.
+
+Starts the server on free ports, logs in --users clients that announce the resume feature,
+then drops the connections of --drop of them at once (as a network blip or a restarted
+proxy would), sends --away broadcasts from a client that stayed, and reconnects the
+dropped clients all together:
+
+- resume:  the server keeps the dropped sessions for SESSION_GRACE seconds; the clients
+           send RESUME with their token and get the broadcasts they missed
+- relogin: the server runs with --session-grace 0; the clients log in again, every one of
+           them is announced as leaving and joining, and the broadcasts are lost
+
+Reports the time until every dropped client is back, the roster frames and bytes every
+client received from the drop until the roster settled, and the share of the missed
+broadcasts that reached the dropped clients.
+
+Usage: python bench_reconnect.py [--users 500] [--drop 250] [--away 5]
+"""
+import argparse
+import logging
+import multiprocessing
+import selectors
+import socket
+import time
+
+import protocol
+import server
+
+SETTLE_TIME = 0.5  # seconds without roster traffic after which the roster counts as settled
+TIMEOUT = 30.0
+ROSTER_TYPES = (protocol.MSG_TYPE_USER_LIST_TCP, protocol.MSG_TYPE_ROSTER_DELTA_TCP)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0)); return sock.getsockname()[1]
+
+
+def serve(session_grace, tcp_port, udp_port):
+    logging.getLogger('ChatServer').setLevel(logging.ERROR)
+    server.ChatServer('127.0.0.1', tcp_port, udp_port, probe_interval=0, session_grace=session_grace).start()
+
+
+class Client:
+    """One simulated user: a TCP connection and what it has received."""
+    def __init__(self, name):
+        self.name = name; self.session = None; self.ready = False
+        self.roster_frames = self.roster_bytes = self.broadcasts = 0
+
+    def connect(self, selector, tcp_port, msg_type, payload):
+        self.sock = socket.create_connection(('127.0.0.1', tcp_port))
+        self.sock.sendall(protocol.pack_data(msg_type, self.name, 0, payload, protocol.CODEC_BINARY))
+        selector.register(self.sock, selectors.EVENT_READ, (self, protocol.FrameReader(self.sock)))
+
+    def login(self, selector, tcp_port):
+        self.ready = False
+        self.connect(selector, tcp_port, protocol.MSG_TYPE_LOGIN, {'codecs': [protocol.CODEC_BINARY], 'features': [protocol.FEATURE_ROSTER_DELTA, protocol.FEATURE_RESUME]})
+
+    def handle(self, frame):
+        payload = protocol.unpack_payload(frame.payload, frame.flags) or {}
+        if frame.msg_type in ROSTER_TYPES: self.roster_frames += 1; self.roster_bytes += len(frame.packet)
+        if frame.msg_type == protocol.MSG_TYPE_USER_LIST_TCP: self.session = payload.get('session'); self.ready = True
+        elif frame.msg_type == protocol.MSG_TYPE_RESUME_TCP:
+            if payload.get('session'): self.ready = True
+            else: self.sock.sendall(protocol.pack_data(protocol.MSG_TYPE_LOGIN, self.name, 0, {'codecs': [protocol.CODEC_BINARY], 'features': [protocol.FEATURE_ROSTER_DELTA, protocol.FEATURE_RESUME]}, protocol.CODEC_BINARY))
+        elif frame.msg_type == protocol.MSG_TYPE_TEXT_BROADCAST_UDP: self.broadcasts += 1
+
+
+def pump(selector, duration):
+    """Reads everything that arrives for duration seconds; returns when the last roster frame arrived, or None."""
+    last_roster = None; end = time.perf_counter() + duration
+    while (remaining := end - time.perf_counter()) > 0:
+        for key, _ in selector.select(remaining):
+            client, reader = key.data
+            try: frames = reader.read_frames()
+            except OSError: frames = None
+            if frames is None: selector.unregister(key.fileobj); continue
+            for frame in frames:
+                client.handle(frame)
+                if frame.msg_type in ROSTER_TYPES: last_roster = time.perf_counter()
+    return last_roster
+
+
+def run(mode, users, drop, away):
+    tcp_port, udp_port = free_port(), free_port()
+    server_process = multiprocessing.Process(target=serve, args=(protocol.SESSION_GRACE if mode == 'resume' else 0, tcp_port, udp_port)); server_process.start()
+    time.sleep(0.5)
+
+    selector = selectors.DefaultSelector()
+    clients = [Client(f'user{i}') for i in range(users)]
+    for client in clients: client.login(selector, tcp_port)
+    while not all(client.ready for client in clients): pump(selector, 0.1)
+    pump(selector, SETTLE_TIME)
+    for client in clients: client.roster_frames = client.roster_bytes = client.broadcasts = 0
+
+    dropped, stayed = clients[:drop], clients[drop:]
+    for client in dropped: selector.unregister(client.sock); client.sock.close(); client.ready = False
+    pump(selector, 0.2)
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for seq_num in range(1, away + 1): udp.sendto(protocol.pack_data(protocol.MSG_TYPE_TEXT_BROADCAST_UDP, stayed[0].name, seq_num, {'text': f'while you were away #{seq_num}'}, protocol.CODEC_BINARY), ('127.0.0.1', udp_port))
+    pump(selector, 0.2)
+
+    start = time.perf_counter()
+    for client in dropped:
+        if mode == 'resume': client.connect(selector, tcp_port, protocol.MSG_TYPE_RESUME_TCP, {'session': client.session})
+        else: client.login(selector, tcp_port)
+    recovered = last_roster = None
+    while time.perf_counter() - start < TIMEOUT:
+        last_roster = pump(selector, 0.05) or last_roster
+        if recovered is None and all(client.ready for client in dropped): recovered = time.perf_counter()
+        if recovered is not None and time.perf_counter() - max(recovered, last_roster or 0) > SETTLE_TIME: break
+
+    server_process.terminate(); server_process.join()
+    for client in clients: client.sock.close()
+    udp.close()
+    roster_frames = sum(client.roster_frames for client in clients); roster_bytes = sum(client.roster_bytes for client in clients)
+    delivered = sum(min(client.broadcasts, away) for client in dropped)
+    return (recovered or time.perf_counter()) - start, roster_frames, roster_bytes, delivered / (away * drop) if away and drop else 1.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--drop', type=int, default=250, help="Clients whose connections are dropped and reconnected.")
+    parser.add_argument('--away', type=int, default=5, help="Broadcasts sent while they are away.")
+    args = parser.parse_args()
+
+    logging.getLogger('ChatServer').setLevel(logging.ERROR)
+    print(f"{args.users} users, {args.drop} dropped and reconnected at once, {args.away} broadcasts while away")
+    print(f"{'mode':>8} {'recovery ms':>12} {'roster frames':>14} {'roster bytes':>13} {'missed delivered':>17}")
+    for mode in ('resume', 'relogin'):
+        elapsed, frames, size, delivered = run(mode, args.users, min(args.drop, args.users - 1), args.away)
+        print(f"{mode:>8} {elapsed * 1000:>12.1f} {frames:>14,} {size:>13,} {delivered:>16.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Benchmark: the client registry under contention from many routing threads.
+
+Runs T threads of mixed traffic against a registry of N users for a fixed time:
+
+- datagram:  look up the sender and refresh its UDP address, look up a private
+             recipient, look up the sender again for the ACK (most operations)
+- broadcast: collect every client except the sender
+- relogin:   log a user out and back in (rare)
+
+and compares two registries:
+
+- locked: a plain dict behind one lock taken for every read and write, with the UDP
+          address written on every datagram (the original scheme)
+- cow:    registry.ClientRegistry, lock-free copy-on-write snapshots, with the address
+          written only when it changes
+
+Usage: python bench_registry.py [--threads 8] [--users 1000] [--duration 3]
+"""
+import argparse
+import random
+import threading
+import time
+
+import registry
+
+ADDRESS = ('127.0.0.1', 40000)
+
+
+class LockedRegistry:
+    """The original scheme: every access to the client dict holds one lock."""
+    def __init__(self):
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def add(self, username, client_info):
+        with self.lock:
+            if username in self.clients: return False
+            self.clients[username] = client_info; return True
+
+    def remove(self, username, client_info):
+        with self.lock:
+            if self.clients.get(username) is client_info: del self.clients[username]
+
+    def get(self, username):
+        with self.lock: return self.clients.get(username)
+
+    def datagram(self, sender, recipient, addr):
+        with self.lock:
+            client_info = self.clients.get(sender)
+            if client_info: client_info['udp_address'] = addr
+        with self.lock: self.clients.get(recipient)
+        with self.lock: self.clients.get(sender)
+
+    def broadcast(self, sender):
+        with self.lock: return tuple(client_info for user, client_info in self.clients.items() if user != sender)
+
+
+class CowRegistry(registry.ClientRegistry):
+    """ClientRegistry used the way ChatServer uses it."""
+    def datagram(self, sender, recipient, addr):
+        client_info = self.get(sender)
+        if client_info and client_info.get('udp_address') != addr: client_info['udp_address'] = addr
+        self.get(recipient)
+        self.get(sender)
+
+    def broadcast(self, sender):
+        return tuple(client_info for user, client_info in self.items() if user != sender)
+
+
+def worker(clients, names, stop, broadcast_share, relogin_share, results):
+    rng = random.Random()
+    operations, samples = 0, []
+    while not stop.is_set():
+        sender = rng.choice(names); roll = rng.random()
+        start = time.perf_counter()
+        if roll < relogin_share:
+            client_info = clients.get(sender)
+            if client_info: clients.remove(sender, client_info); clients.add(sender, client_info)
+        elif roll < relogin_share + broadcast_share:
+            clients.broadcast(sender)
+        else:
+            clients.datagram(sender, rng.choice(names), ADDRESS)
+            samples.append(time.perf_counter() - start)
+        operations += 1
+    results.append((operations, samples))
+
+
+def run(kind, args):
+    clients = LockedRegistry() if kind == 'locked' else CowRegistry()
+    names = [f'user{i}' for i in range(args.users)]
+    for name in names: clients.add(name, {'username': name, 'udp_address': ADDRESS})
+    stop, results = threading.Event(), []
+    threads = [threading.Thread(target=worker, args=(clients, names, stop, args.broadcast_share, args.relogin_share, results)) for _ in range(args.threads)]
+    for thread in threads: thread.start()
+    time.sleep(args.duration); stop.set()
+    for thread in threads: thread.join()
+    operations = sum(count for count, _ in results)
+    samples = sorted(sample for _, thread_samples in results for sample in thread_samples)
+    p = lambda q: samples[min(int(q * len(samples)), len(samples) - 1)] * 1e6
+    print(f"{kind:<7} {operations / args.duration:>11,.0f} ops/s   datagram p50 {p(0.5):6.1f} us  p99 {p(0.99):7.1f} us  p999 {p(0.999):8.1f} us")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=3.0)
+    parser.add_argument('--broadcast-share', type=float, default=0.02, help="Fraction of operations that are broadcasts.")
+    parser.add_argument('--relogin-share', type=float, default=0.001, help="Fraction of operations that are a logout and login.")
+    args = parser.parse_args()
+    for kind in ('locked', 'cow'): run(kind, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Benchmark: routing cost of a message sent to everyone vs. to a room, as the server grows.
+
+Registers N logged-in users, split into rooms of M members (independent teams sharing
+one server), and times how long ChatServer takes to route messages from random users:
+
+- everyone: broadcast_message, the only way to reach a team before rooms (O(all clients))
+- room:     send_room_message to the sender's room, through the room index (O(members))
+
+Only the routing thread is timed; frames are queued but never written, so the numbers
+are the per-message work that grows with the number of clients online.
+
+Usage: python bench_rooms.py [--users 1000 10000] [--room-size 20] [--messages 2000]
+"""
+import argparse
+import logging
+import random
+import time
+
+import protocol
+import server
+
+
+def run(users, room_size, messages, mode):
+    chat_server = server.ChatServer('127.0.0.1', 0, 0, high_watermark=1 << 40, low_watermark=1 << 39)
+    names = [f'user{i}' for i in range(users)]
+    for i, name in enumerate(names):
+        client_info = {'username': name, 'tcp_address': ('127.0.0.1', i), 'rooms': set(), 'outbound': chat_server.create_outbound_queue()}
+        chat_server.clients.add(name, client_info)
+        chat_server.rooms.join(f'team{i // room_size}', name, client_info); client_info['rooms'].add(f'team{i // room_size}')
+
+    rng = random.Random(1)
+    senders = [rng.randrange(users) for _ in range(messages)]
+    frames = [protocol.pack_data(protocol.MSG_TYPE_ROOM_TEXT_UDP if mode == 'room' else protocol.MSG_TYPE_TEXT_BROADCAST_UDP, names[sender], seq, {'recipient': f'team{sender // room_size}', 'text': 'x' * 64} if mode == 'room' else {'text': 'x' * 64}) for seq, sender in enumerate(senders, 1)]
+    start = time.perf_counter()
+    for sender, frame in zip(senders, frames):
+        if mode == 'room': chat_server.send_room_message(frame, names[sender], f'team{sender // room_size}')
+        else: chat_server.broadcast_message(frame, names[sender])
+    elapsed = time.perf_counter() - start
+    queued = sum(len(client_info['outbound'].frames) for client_info in chat_server.clients.values())
+    chat_server.tcp_socket.close(); chat_server.udp_socket.close()
+    return elapsed / messages * 1e6, queued / messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--room-size', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=2000)
+    args = parser.parse_args()
+
+    logging.getLogger('ChatServer').setLevel(logging.WARNING)
+    print(f"{'users':>7} {'mode':>9} {'us/message':>11} {'frames/message':>15}")
+    for users in args.users:
+        for mode in ('everyone', 'room'):
+            per_message, frames = run(users, args.room_size, args.messages, mode)
+            print(f"{users:>7} {mode:>9} {per_message:>11.1f} {frames:>15.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""Benchmark: private-message throughput of the server with 1, 2, 4 and 8 worker processes.
+
+Starts the server on free ports (one ChatServer for 1 worker, sharded workers otherwise),
+logs in users from several load processes and has them send private UDP messages to
+random users, most of whom are owned by other workers, keeping a fixed window of
+unacknowledged messages in flight. Reports messages acknowledged and delivered per
+second, and the share of sent messages never acknowledged.
+
+Usage: python bench_shards.py [--workers 1 2 4 8] [--load-processes 4] [--users 50] [--duration 5]
+"""
+import argparse
+import logging
+import multiprocessing
+import random
+import selectors
+import socket
+import time
+
+import protocol
+import server
+import sharding
+
+WINDOW = 64
+STALL_TIMEOUT = 0.5
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0)); return sock.getsockname()[1]
+
+
+def serve(workers, tcp_port, udp_port):
+    logging.getLogger('ChatServer').setLevel(logging.ERROR)
+    if workers == 1:
+        server.ChatServer('127.0.0.1', tcp_port, udp_port).start()
+    else:
+        sharding.run_workers(workers, lambda worker_id, peers: server.ShardedChatServer('127.0.0.1', tcp_port, udp_port, worker_id=worker_id, peers=peers))
+
+
+def load(pipe, tcp_port, udp_port, names, everyone, duration):
+    """Logs in names, then keeps WINDOW private messages from them in flight for duration seconds.
+
+    A message leaves the window when its ACK arrives; if nothing is acknowledged for
+    STALL_TIMEOUT the window is assumed lost and reopened, so overload shows up as loss
+    rather than as a stalled load process.
+    """
+    selector = selectors.DefaultSelector()
+    for name in names:
+        conn = socket.create_connection(('127.0.0.1', tcp_port))
+        conn.sendall(protocol.pack_data(protocol.MSG_TYPE_LOGIN, name, 0, {'codecs': list(protocol.SUPPORTED_CODECS)}))
+        selector.register(conn, selectors.EVENT_READ, protocol.FrameReader(conn))
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    seq_nums = dict.fromkeys(names, 0)
+    pipe.send('ready'); pipe.recv()
+
+    sent = acked = delivered = in_flight = 0
+    start = last_progress = time.perf_counter(); end = start + duration
+    while time.perf_counter() < end:
+        while in_flight < WINDOW:
+            name = random.choice(names); seq_nums[name] += 1
+            udp.sendto(protocol.pack_data(protocol.MSG_TYPE_PRIVATE_TEXT_UDP, name, seq_nums[name], {'recipient': random.choice(everyone), 'text': 'x' * 64}, protocol.CODEC_BINARY), ('127.0.0.1', udp_port))
+            sent += 1; in_flight += 1
+        for key, _ in selector.select(STALL_TIMEOUT / 5):
+            frames = key.data.read_frames()
+            if frames is None: selector.unregister(key.fileobj); continue
+            for frame in frames:
+                if frame.msg_type == protocol.MSG_TYPE_ACK_TCP: acked += 1; in_flight = max(in_flight - 1, 0); last_progress = time.perf_counter()
+                elif frame.msg_type == protocol.MSG_TYPE_PRIVATE_TEXT_UDP: delivered += 1
+        if time.perf_counter() - last_progress > STALL_TIMEOUT: in_flight = 0; last_progress = time.perf_counter()
+    pipe.send((sent, acked, delivered, time.perf_counter() - start))
+
+
+def run(workers, load_processes, users, duration):
+    tcp_port, udp_port = free_port(), free_port()
+    server_process = multiprocessing.Process(target=serve, args=(workers, tcp_port, udp_port)); server_process.start()
+    time.sleep(0.5 + 0.1 * workers)
+
+    groups = [[f'p{p}u{u}' for u in range(users)] for p in range(load_processes)]
+    everyone = [name for names in groups for name in names]
+    pipes = []
+    for names in groups:
+        pipe, child_pipe = multiprocessing.Pipe()
+        multiprocessing.Process(target=load, args=(child_pipe, tcp_port, udp_port, names, everyone, duration), daemon=True).start()
+        pipes.append(pipe)
+    for pipe in pipes: pipe.recv()
+    time.sleep(1.0)  # let the workers exchange their rosters
+    for pipe in pipes: pipe.send('go')
+    results = [pipe.recv() for pipe in pipes]
+
+    server_process.terminate(); server_process.join()
+    sent, acked, delivered = (sum(result[i] for result in results) for i in range(3))
+    elapsed = max(result[3] for result in results)
+    return acked / elapsed, delivered / elapsed, 1 - acked / sent
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--load-processes', type=int, default=4)
+    parser.add_argument('--users', type=int, default=50, help="Users logged in by each load process.")
+    parser.add_argument('--duration', type=float, default=5.0, help="Seconds of load per worker count.")
+    args = parser.parse_args()
+
+    logging.getLogger('ChatServer').setLevel(logging.ERROR)
+    print(f"cores: {multiprocessing.cpu_count()}")
+    print(f"{'workers':>7} {'acked msg/s':>12} {'delivered msg/s':>16} {'lost %':>7}")
+    for workers in args.workers:
+        acked, delivered, lost = run(workers, args.load_processes, args.users, args.duration)
+        print(f"{workers:>7} {acked:>12,.0f} {delivered:>16,.0f} {lost * 100:>6.1f}%")
+
+
+if __name__ == '__main__':
+    main()
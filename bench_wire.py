@@ -0,0 +1,117 @@
+"""Benchmark: bytes on the wire and messages per second for the ways a client can send chat over UDP.
+
+Sends one corpus of chat messages (mostly short lines, some paragraphs, a few pasted logs
+and code of several KB) over loopback UDP, and receives, reassembles and decodes it the
+way the server does: on a protocol.udp_receive_socket(), with a recvfrom() of
+protocol.BUFFER_SIZE bytes, from a sender that pauses after every FRAGMENT_BURST datagrams:
+
+- json:       one uncompressed JSON frame per datagram (the original encoding); messages
+              longer than one datagram are truncated and lost
+- binary:     the binary codec, otherwise the same
+- compressed: binary codec, payloads above COMPRESS_THRESHOLD deflated with the chat
+              dictionary, long messages fragmented
+- batched:    bursts of --burst messages packed into BATCH datagrams, each deflated as a
+              whole, with the binary codec
+
+Wire bytes include 28 bytes of IPv4 and UDP header per datagram.
+
+Usage: python bench_wire.py [--messages 20000] [--burst 8] [--seed 1]
+"""
+import argparse
+import random
+import select
+import socket
+import time
+
+import protocol
+
+WORDS = ('the a to and of is it you that in for on this we be have are with not at can but so if just do was'
+         ' what about will there all get like think know meeting tomorrow today deploy build server client'
+         ' message thanks please yes no ok sure maybe later lunch review bug fix test branch merge release').split()
+UDP_OVERHEAD = 28
+SCHEMES = ('json', 'binary', 'compressed', 'batched')
+
+
+def sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize() + rng.choice('.?!')
+
+def paste(rng, lines):
+    """A chunk of log output or code, the kind of thing people paste into a chat."""
+    if rng.random() < 0.5:
+        return '\n'.join(f"2024-05-{rng.randint(1, 28):02d} {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d} {rng.choice(('INFO', 'WARNING', 'ERROR'))} worker-{rng.randint(1, 8)} {sentence(rng, rng.randint(4, 12))}" for _ in range(lines))
+    return '\n'.join(f"{'    ' * rng.randint(0, 3)}{rng.choice(('def', 'return', 'if', 'for', 'self.'))} {rng.choice(WORDS)}_{rng.choice(WORDS)}({rng.choice(WORDS)}, {rng.randint(0, 99)})" for _ in range(lines))
+
+def make_corpus(count, seed):
+    rng = random.Random(seed); corpus = []
+    for _ in range(count):
+        roll = rng.random()
+        if roll < 0.02: text = paste(rng, rng.randint(30, 300))
+        elif roll < 0.10: text = ' '.join(sentence(rng, rng.randint(8, 20)) for _ in range(rng.randint(3, 10)))
+        else: text = sentence(rng, rng.randint(1, 15))
+        corpus.append(text)
+    return corpus
+
+
+def encode(scheme, corpus, burst):
+    """Returns the datagrams that carry the corpus with one scheme."""
+    codec = protocol.CODEC_JSON if scheme == 'json' else protocol.CODEC_BINARY
+    compress = scheme == 'compressed'
+    packets = [protocol.pack_data(protocol.MSG_TYPE_TEXT_BROADCAST_UDP, 'bench', seq, {'text': text}, codec, compress) for seq, text in enumerate(corpus, 1)]
+    if scheme == 'batched': return [datagram for start in range(0, len(packets), burst) for datagram in protocol.pack_batch('bench', packets[start:start + burst], compress=True)]
+    if compress: return [datagram for packet in packets for datagram in protocol.fragment(packet)]
+    return packets
+
+
+def decode(data, reassembler, now):
+    """Returns the number of chat messages a received datagram completes."""
+    header = data[:protocol.HEADER_SIZE]
+    msg_type, _, seq_num, _ = protocol.unpack_header(header)
+    payload = memoryview(data)[protocol.HEADER_SIZE:]
+    if msg_type == protocol.MSG_TYPE_FRAGMENT_UDP:
+        packet = reassembler.add(seq_num, payload, now)
+        return decode(packet, reassembler, now) if packet else 0
+    if msg_type == protocol.MSG_TYPE_BATCH:
+        return sum(1 for frame in protocol.split_batch(payload, protocol.header_flags(header)) if (protocol.unpack_payload(frame.payload, frame.flags) or {}).get('text'))
+    return 1 if (protocol.unpack_payload(payload, protocol.header_flags(header)) or {}).get('text') else 0
+
+
+def run(scheme, corpus, burst):
+    start = time.perf_counter()
+    datagrams = encode(scheme, corpus, burst)
+    receiver = protocol.udp_receive_socket(); receiver.bind(('127.0.0.1', 0))
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM); address = receiver.getsockname()
+    reassembler = protocol.Reassembler(); delivered = 0
+    # Sent in bursts the way protocol.send_datagrams() paces them; the pause is this loop draining the receiver.
+    for first in range(0, len(datagrams), protocol.FRAGMENT_BURST):
+        chunk = datagrams[first:first + protocol.FRAGMENT_BURST]
+        for datagram in chunk: sender.sendto(datagram, address)
+        for _ in chunk:
+            if not select.select([receiver], [], [], 1.0)[0]: break
+            delivered += decode(receiver.recvfrom(protocol.BUFFER_SIZE)[0], reassembler, time.monotonic())
+    elapsed = time.perf_counter() - start
+    sender.close(); receiver.close()
+    wire = sum(len(datagram) + UDP_OVERHEAD for datagram in datagrams)
+    return len(datagrams), wire, delivered, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--burst', type=int, default=8, help="Messages sent together in the batched scheme.")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.messages, args.seed)
+    text_bytes = sum(len(text.encode('utf-8')) for text in corpus)
+    with protocol.udp_receive_socket() as sock: granted = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    print(f"{len(corpus)} messages, {text_bytes / len(corpus):.0f} bytes of text on average, {sum(len(text) > protocol.BUFFER_SIZE - 100 for text in corpus)} longer than a datagram; {granted:,} byte receive buffer")
+    print(f"{'scheme':>10} {'datagrams':>10} {'wire bytes':>12} {'bytes/msg':>10} {'vs json':>8} {'delivered':>10} {'msg/s':>10}")
+    baseline = None
+    for scheme in SCHEMES:
+        datagrams, wire, delivered, elapsed = run(scheme, corpus, args.burst)
+        baseline = baseline or wire
+        print(f"{scheme:>10} {datagrams:>10} {wire:>12,} {wire / len(corpus):>10.1f} {wire / baseline:>7.0%} {delivered:>10} {delivered / elapsed:>10,.0f}")
+
+
+if __name__ == '__main__':
+    main()
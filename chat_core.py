@@ -0,0 +1,348 @@
+import logging
+import random
+import socket
+import threading
+import time
+
+import protocol
+import reliability
+
+EVENTS = ('message', 'roster', 'rooms', 'history', 'ack', 'retransmit', 'ping', 'connection')
+LOGIN_FEATURES = (protocol.FEATURE_ACK_BATCH, protocol.FEATURE_ROSTER_DELTA, protocol.FEATURE_COMPRESSION, protocol.FEATURE_RESUME)
+
+log = logging.getLogger('ChatClient')
+
+
+class ChatCore:
+    """One user's connection to the chat server, without a user interface.
+
+    It owns login and session resumption, reliable UDP sending, the roster and room
+    state, history requests and latency probes, and imports nothing from the GUI, so
+    bots, tests and load tools can use it directly; client.py is one consumer of it.
+    Callbacks registered with on() are called on the network threads:
+
+        'message'     (sender, text, private, room)  a chat message; room is None outside rooms
+        'roster'      (joined, left)                 users who came online or left, as sorted lists
+        'rooms'       (rooms, joined)                every room, and the rooms this user is in (None if not included)
+        'history'     (payload,)                     a HISTORY_RESPONSE payload
+        'ack'         (seq_nums,)                    sent messages the server acknowledged
+        'retransmit'  (seq_nums, rto)                sent messages that timed out and went out again
+        'ping'        (peer, rtt, manual)            a probe or ping() answered, RTT in seconds
+        'connection'  (state, detail)                'lost', 'reconnect_failed', 'resumed', 'relogin' or 'closed'
+
+    asyncio programs can iterate over the same events instead, with
+    `async for event, args in core.events()`.
+    """
+    def __init__(self, username=None, host=protocol.SERVER_HOST, tcp_port=protocol.TCP_PORT, udp_port=protocol.UDP_PORT, probe=True):
+        self.username = username
+        self.host = host
+        self.tcp_port = tcp_port
+        self.udp_port = udp_port
+        self.probing = probe
+        self.tcp_socket = None
+        self.udp_socket = None
+        self.send_lock = threading.Lock()
+        self.seq_num = 0
+        self.codec = protocol.CODEC_JSON
+        self.compress = False
+        self.retransmits = reliability.RetransmitQueue()
+        self.unacked_lock = threading.Condition()
+        self.session = None  # token from the server, to resume after a dropped connection
+        self.reconnect_attempts = 0
+        self.closing = False
+
+        self.users = set()
+        self.roster_version = None
+        self.roster_sync_pending = False
+        self.joined_rooms = set()
+        self.latency = {}  # peer, or protocol.SERVER_NAME, -> reliability.LatencyStats from the probes
+        self.manual_pings = set()
+        self.probe_turn = 0
+        self.last_rtt_report = time.monotonic()
+        self.listeners = {event: [] for event in EVENTS}
+        self.subscribers = []
+
+    def on(self, event, callback):
+        """Calls callback(*args) for every `event` from now on; see the class docstring for the events and their arguments."""
+        self.listeners[event].append(callback)
+        return callback
+
+    def emit(self, event, *args):
+        for callback in self.listeners[event]: callback(*args)
+        for subscriber in list(self.subscribers): subscriber(event, args)
+
+    async def events(self):
+        """Yields (event, args) for every event from now on, on the running event loop, until the connection is closed."""
+        import asyncio  # only asyncio programs pay for importing it
+        loop = asyncio.get_running_loop(); queue = asyncio.Queue()
+        subscriber = lambda event, args: loop.call_soon_threadsafe(queue.put_nowait, (event, args))
+        self.subscribers.append(subscriber)
+        try:
+            while True:
+                event, args = await queue.get()
+                yield event, args
+                if event == 'connection' and args[0] == 'closed': return
+        finally:
+            self.subscribers.remove(subscriber)
+
+    def connect(self):
+        """Connects, logs in and starts the network threads; raises OSError if the server cannot be reached."""
+        self.tcp_socket = socket.create_connection((self.host, self.tcp_port))
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM); self.udp_socket.bind(('', 0))
+        self.tcp_socket.sendall(self.login_packet())
+        threading.Thread(target=self.listen_tcp, daemon=True).start()
+        threading.Thread(target=self.retransmit_checker, daemon=True).start()
+        if self.probing: threading.Thread(target=self.probe_loop, daemon=True).start()
+
+    def login_packet(self):
+        """The LOGIN packet, announcing every codec and feature this client supports."""
+        return protocol.pack_data(protocol.MSG_TYPE_LOGIN, self.username, 0, {'codecs': list(protocol.SUPPORTED_CODECS), 'features': list(LOGIN_FEATURES)})
+
+    def send_tcp(self, msg_type, payload):
+        """Sends one packet over the TCP connection; several threads send, so whole packets are written under a lock."""
+        with self.send_lock: self.tcp_socket.sendall(protocol.pack_data(msg_type, self.username, 0, payload, self.codec))
+
+    def send_text(self, text, recipient=None, room=None):
+        """Sends a chat message over UDP, to everyone, to one user or to a room, and returns its sequence number.
+
+        It is retransmitted until the server acknowledges it; raises OSError if it could not be sent at all.
+        """
+        payload = {'text': text}
+        if room is not None: payload['recipient'] = room; msg_type = protocol.MSG_TYPE_ROOM_TEXT_UDP
+        elif recipient is not None: payload['recipient'] = recipient; msg_type = protocol.MSG_TYPE_PRIVATE_TEXT_UDP
+        else: msg_type = protocol.MSG_TYPE_TEXT_BROADCAST_UDP
+        with self.unacked_lock: self.seq_num += 1; seq_num = self.seq_num
+        return self.send_udp(protocol.pack_data(msg_type, self.username, seq_num, payload, self.codec, self.compress), seq_num)
+
+    def send_udp(self, packet, seq_num):
+        """Sends a packed message and tracks it until it is acknowledged; returns its sequence number."""
+        # A long message goes out as several FRAGMENT datagrams; the server ACKs it once it has them all.
+        protocol.send_datagrams(self.udp_socket, protocol.fragment(packet), (self.host, self.udp_port))
+        with self.unacked_lock: self.retransmits.add(seq_num, packet, time.monotonic()); self.unacked_lock.notify()
+        return seq_num
+
+    def renumber_unacked(self):
+        """Numbers from 1 again after a fresh login, whose dedup window starts at 1, and resends what is still unacknowledged under the new numbers."""
+        with self.unacked_lock:
+            packets = [self.retransmits.packets[seq_num]['packet'] for seq_num in sorted(self.retransmits.packets)]
+            self.retransmits = reliability.RetransmitQueue(self.retransmits.estimator); self.seq_num = len(packets)
+        for seq_num, packet in enumerate(packets, 1):
+            _, sender_id, _, _ = protocol.unpack_header(packet[:protocol.HEADER_SIZE])
+            try: self.send_udp(protocol.pack_raw(packet[0], sender_id, seq_num, packet[protocol.HEADER_SIZE:]), seq_num)
+            except OSError: pass  # closed
+
+    def join_room(self, room):
+        """Asks the server to add this user to a room; the 'rooms' event confirms it."""
+        self.send_tcp(protocol.MSG_TYPE_ROOM_JOIN_TCP, {'room': room})
+
+    def leave_room(self, room):
+        """Asks the server to take this user out of a room."""
+        self.send_tcp(protocol.MSG_TYPE_ROOM_LEAVE_TCP, {'room': room})
+
+    def request_history(self, before=None, peer=None, room=None):
+        """Asks for the public messages (or those with peer, or of room) preceding message number `before`, the newest if None."""
+        payload = {'limit': protocol.HISTORY_PAGE_SIZE}
+        if before is not None: payload['before'] = before
+        if peer is not None: payload['peer'] = peer
+        if room is not None: payload['room'] = room
+        self.send_tcp(protocol.MSG_TYPE_HISTORY_REQUEST_TCP, payload)
+
+    def ping(self, target):
+        """Pings a user, or the server itself, on request; the answer comes as a 'ping' event with manual set."""
+        self.manual_pings.add(target); self.send_ping(target)
+
+    def send_ping(self, target):
+        """Sends a PING request stamped with time.monotonic_ns(); the response echoes the stamp back."""
+        self.send_tcp(protocol.MSG_TYPE_PING_REQUEST_TCP, {'recipient': target, 'sent': time.monotonic_ns()})
+
+    def logout(self):
+        """Logs out cleanly, ending the session on the server, and closes the connection; does nothing more once closed."""
+        if not self.closing and self.tcp_socket:
+            try: self.send_tcp(protocol.MSG_TYPE_LOGOUT_TCP, {})
+            except OSError: pass  # the connection is already gone
+        self.close()
+
+    def close(self):
+        """Closes the connection without logging out, as a network failure would; the server keeps the session for its grace period."""
+        self.closing = True
+        if self.tcp_socket:
+            # Shut down first: a close() alone leaves the connection open while listen_tcp is blocked reading it.
+            try: self.tcp_socket.shutdown(socket.SHUT_RDWR)
+            except OSError: pass
+        for sock in (self.tcp_socket, self.udp_socket):
+            if sock:
+                try: sock.close()
+                except OSError: pass
+        with self.unacked_lock: self.unacked_lock.notify()
+
+    def listen_tcp(self):
+        """Continuously listens for incoming data on the TCP socket, reconnecting and resuming the session if the connection drops."""
+        while True:
+            reader = protocol.FrameReader(self.tcp_socket)
+            while True:
+                try:
+                    frames = reader.read_frames()
+                    if frames is None: break
+                    for frame in frames: self.handle_frame(frame)
+                except (ConnectionResetError, ConnectionAbortedError, OSError):
+                    break
+                except Exception as e:
+                    log.error(f"TCP listen error: {e}", exc_info=True); self.logout(); break
+            if self.closing: break
+            self.emit('connection', 'lost', None)
+            if not self.session: break
+            sock = self.reconnect()
+            if sock is None: break
+            self.tcp_socket = sock
+        self.closing = True; self.emit('connection', 'closed', None)
+
+    def reconnect(self):
+        """Opens a new connection and asks to resume the session on it; None once the client is closing.
+
+        Attempt n first waits a random time of up to RECONNECT_BASE_DELAY * 2 ** n (full jitter),
+        so clients that lost the server together do not all come back at the same moment. The
+        socket keeps a RESUME_TIMEOUT timeout until the server answers, so a server that accepts
+        but never answers counts as a failed attempt.
+        """
+        while not self.closing:
+            time.sleep(random.uniform(0, min(protocol.RECONNECT_MAX_DELAY, protocol.RECONNECT_BASE_DELAY * 2 ** min(self.reconnect_attempts, 16))))
+            self.reconnect_attempts += 1
+            try:
+                sock = socket.create_connection((self.host, self.tcp_port), timeout=protocol.RESUME_TIMEOUT)
+                sock.sendall(protocol.pack_data(protocol.MSG_TYPE_RESUME_TCP, self.username, 0, {'session': self.session}, self.codec))
+                return sock
+            except OSError as e:
+                self.emit('connection', 'reconnect_failed', f"attempt {self.reconnect_attempts}: {e}")
+        return None
+
+    def handle_frame(self, frame):
+        """Processes a single frame received from the server."""
+        msg_type, sender_id, seq_num, flags = frame.msg_type, frame.sender_id, frame.seq_num, frame.flags
+        if msg_type == protocol.MSG_TYPE_BATCH:
+            for inner in protocol.split_batch(frame.payload, flags): self.handle_frame(inner)
+            return
+        payload = protocol.unpack_payload(frame.payload, flags)
+        if not isinstance(payload, dict): log.warning(f"Skipped a frame of type {msg_type:#04x} from '{sender_id}' whose payload could not be decoded."); return
+        # The server answers in the codec it negotiated at login; use the same one from then on.
+        if sender_id == protocol.SERVER_NAME and flags & protocol.FLAG_BINARY_PAYLOAD: self.codec = protocol.CODEC_BINARY
+
+        if msg_type == protocol.MSG_TYPE_ACK_TCP:
+            with self.unacked_lock: acked = self.retransmits.ack(seq_num, time.monotonic())
+            if acked: self.emit('ack', [seq_num])
+        elif msg_type == protocol.MSG_TYPE_ACK_BATCH_TCP:
+            with self.unacked_lock: acked = self.retransmits.ack_matching(reliability.acked_by(payload), time.monotonic())
+            if acked: self.emit('ack', acked)
+        elif msg_type == protocol.MSG_TYPE_PING_REQUEST_TCP:
+            # Answered right here, echoing the sender's timestamp.
+            response_payload = {'recipient': sender_id}
+            if 'sent' in payload: response_payload['sent'] = payload['sent']
+            self.send_tcp(protocol.MSG_TYPE_PING_RESPONSE_TCP, response_payload)
+        elif msg_type == protocol.MSG_TYPE_PING_RESPONSE_TCP:
+            # Timed before anything else happens, against the stamp carried in the payload.
+            rtt = reliability.probe_rtt(payload)
+            if rtt is not None:
+                self.latency.setdefault(sender_id, reliability.LatencyStats()).observe(rtt)
+                manual = sender_id in self.manual_pings; self.manual_pings.discard(sender_id)
+                self.emit('ping', sender_id, rtt, manual)
+        elif msg_type == protocol.MSG_TYPE_USER_LIST_TCP:
+            self.roster_version = payload.get('version'); self.roster_sync_pending = False
+            # Only the list sent to this client alone says which of its login features the server accepted.
+            if 'features' in payload: self.compress = protocol.FEATURE_COMPRESSION in payload['features']
+            if 'session' in payload: self.session = payload['session']
+            users = set(payload['users']); joined, left = users - self.users, self.users - users
+            self.users = users
+            if joined or left: self.emit('roster', sorted(joined), sorted(left))
+        elif msg_type == protocol.MSG_TYPE_ROSTER_DELTA_TCP:
+            version = payload['version']
+            if self.roster_version is not None and version == self.roster_version + 1:
+                # A delta can repeat users the login list already had; only real changes are reported.
+                joined, left = set(payload['joined']) - self.users, set(payload['left']) & self.users
+                self.roster_version = version; self.users = (self.users | joined) - left
+                if joined or left: self.emit('roster', sorted(joined), sorted(left))
+            elif (self.roster_version is None or version > self.roster_version) and not self.roster_sync_pending:
+                # A delta went missing; ask for a full list instead of guessing.
+                self.roster_sync_pending = True; self.send_tcp(protocol.MSG_TYPE_ROSTER_SYNC_TCP, {})
+        elif msg_type == protocol.MSG_TYPE_RESUME_TCP:
+            self.tcp_socket.settimeout(None); self.reconnect_attempts = 0
+            if payload.get('session'): self.emit('connection', 'resumed', None)
+            else:
+                # The session expired; log in again on the same connection.
+                self.session = None
+                with self.send_lock: self.tcp_socket.sendall(self.login_packet())
+                self.renumber_unacked()
+                self.emit('connection', 'relogin', None)
+        elif msg_type == protocol.MSG_TYPE_HISTORY_RESPONSE_TCP:
+            self.emit('history', payload)
+        elif msg_type == protocol.MSG_TYPE_ROOM_LIST_TCP:
+            if payload.get('joined') is not None: self.joined_rooms = set(payload['joined'])
+            self.emit('rooms', payload.get('rooms', []), payload.get('joined'))
+        elif msg_type == protocol.MSG_TYPE_ROOM_TEXT_UDP:
+            self.emit('message', sender_id, payload['text'], False, payload.get('recipient'))
+        elif msg_type in (protocol.MSG_TYPE_TEXT_BROADCAST_UDP, protocol.MSG_TYPE_PRIVATE_TEXT_UDP):
+            self.emit('message', sender_id, payload['text'], msg_type == protocol.MSG_TYPE_PRIVATE_TEXT_UDP, None)
+
+    def retransmit_checker(self):
+        """Retransmits unacknowledged UDP packets when their adaptive timeout expires."""
+        while not self.closing:
+            with self.unacked_lock:
+                now = time.monotonic(); due = self.retransmits.pop_due(now)
+                if not due: self.unacked_lock.wait(self.retransmits.time_until_next(now)); continue
+                rto = self.retransmits.estimator.rto
+            self.emit('retransmit', [seq_num for seq_num, _ in due], rto)
+            # Everything due at once shares as few datagrams as possible. They go out in a random order, so a
+            # server whose buffer overflows at the same point of every burst still gets the missing fragments.
+            datagrams = protocol.pack_batch(self.username, [packet for _, packet in due], compress=self.compress); random.shuffle(datagrams)
+            try:
+                protocol.send_datagrams(self.udp_socket, datagrams, (self.host, self.udp_port))
+            except OSError: pass  # closed; the loop ends
+
+    def probe_loop(self):
+        """Runs a probe() every PROBE_INTERVAL seconds until the client closes."""
+        while not self.closing:
+            time.sleep(protocol.PROBE_INTERVAL)
+            if not self.closing: self.probe()
+
+    def probe(self):
+        """Pings the server and the next PROBE_PEERS peers in turn, and reports the rolling RTTs to the server every RTT_REPORT_INTERVAL."""
+        peers = sorted(user for user in self.users if user != self.username)
+        for peer in list(self.latency):
+            if peer != protocol.SERVER_NAME and peer not in peers: self.latency.pop(peer, None)
+        targets = [protocol.SERVER_NAME] + [peers[(self.probe_turn + i) % len(peers)] for i in range(min(protocol.PROBE_PEERS, len(peers)))]
+        self.probe_turn += protocol.PROBE_PEERS
+        try:
+            for target in targets: self.send_ping(target)
+            if time.monotonic() - self.last_rtt_report >= protocol.RTT_REPORT_INTERVAL:
+                self.last_rtt_report = time.monotonic(); self.send_tcp(protocol.MSG_TYPE_RTT_REPORT_TCP, reliability.rtt_report(dict(self.latency)))
+        except OSError: pass  # disconnected; listen_tcp reconnects
+
+
+def main():
+    """A line-based chat client for terminals and scripts: prints what arrives, sends each line typed."""
+    import argparse
+    parser = argparse.ArgumentParser(description="Network Project Chat client without a GUI.")
+    parser.add_argument('username')
+    parser.add_argument('--host', default=protocol.SERVER_HOST)
+    parser.add_argument('--to', help="Send every line to this user instead of the public chat.")
+    parser.add_argument('--room', help="Join this room and send every line to it.")
+    args = parser.parse_args()
+
+    core = ChatCore(args.username, args.host)
+    def show_roster(joined, left):
+        for user in joined: print(f"* {user} joined", flush=True)
+        for user in left: print(f"* {user} left", flush=True)
+    core.on('message', lambda sender, text, private, room: print(f"[#{room}] {sender}: {text}" if room else f"{sender}{' (private)' if private else ''}: {text}", flush=True))
+    core.on('roster', show_roster)
+    core.on('connection', lambda state, detail: print(f"* connection {state}{': ' + detail if detail else ''}", flush=True))
+    core.connect()
+    if args.room: core.join_room(args.room)
+    try:
+        while True:
+            line = input().strip()
+            if line: core.send_text(line, args.to, args.room)
+    except (EOFError, KeyboardInterrupt):
+        pass
+    core.logout()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,55 @@
 import customtkinter as ctk
-import socket
-import threading
 import time
+import bisect
+import argparse
+import threading
 import protocol
+import transcript
+import chat_core
 from functools import partial
 
+UI_TICK_MS = 16    # calls posted by the network threads run together, at most once per tick
+LOG_HISTORY = 1000 # lines kept in the System Logs panel
+
 class ChatClient(ctk.CTk):
-    """The main application class for the client GUI."""
-    def __init__(self):
+    """The main application class for the client GUI; the networking lives in a chat_core.ChatCore."""
+    def __init__(self, login=True, username=None):
         super().__init__()
         self.title("Network Project Chat")
         self.geometry("1100x700")
         ctk.set_appearance_mode("dark")
 
-       
-        self.tcp_socket = None
-        self.udp_socket = None
-        self.username = None
-        self.seq_num = 0  
-        self.unacked_packets = {} 
-        self.unacked_lock = threading.Lock()
-        
-       
+        self.core = chat_core.ChatCore()
+        self.core.on('message', lambda sender, text, private, room: self.post(self.show_message, sender, text, private, room))
+        self.core.on('roster', lambda joined, left: self.post(self.apply_roster_delta, joined, left))
+        self.core.on('rooms', lambda rooms, joined: self.post(self.update_room_list, rooms, joined))
+        self.core.on('history', lambda payload: self.post(self.show_history, payload))
+        self.core.on('ack', lambda seq_nums: self.post(self.log_system_message, f"ACK received for UDP packet{'s' if len(seq_nums) > 1 else ''} #{', #'.join(map(str, seq_nums))}.", "cyan"))
+        self.core.on('retransmit', lambda seq_nums, rto: self.post(self.log_retransmits, seq_nums, rto))
+        self.core.on('ping', self.ping_answered)
+        self.core.on('connection', lambda state, detail: self.post(self.show_connection_state, state, detail))
+        self.closed = False
+        self.ui_calls = []
+        self.ui_lock = threading.Lock()
+
         self.private_target = None  
+        self.room_target = None
         self.user_buttons = {}     
+        self.room_buttons = {}
+        self.rooms = []
+        self.joined_rooms = set()
+        self.pending_room = None
+        self.sorted_users = []
         self.ping_window = None    
         self.ping_labels = {}
-        self.ping_start_times = {}
+        self.history_before = None
+        self.history_pending = False
 
         self.create_widgets()
         self.protocol("WM_DELETE_WINDOW", self.on_closing) 
-        self.after(100, self.show_login_dialog) 
+        # A username known up front connects as soon as the main loop runs, without waiting for the window to be drawn.
+        if username: self.after(0, self.start_session, username)
+        elif login: self.after(100, self.show_login_dialog) 
 
     def create_widgets(self):
         """Creates and arranges all the GUI widgets in the main window."""
@@ -45,12 +64,17 @@ class ChatClient(ctk.CTk):
         self.theme_button = ctk.CTkButton(header_frame, text="☀️", font=("Arial", 18), width=30, command=self.toggle_theme); self.theme_button.grid(row=0, column=1, sticky="e")
         self.target_label = ctk.CTkLabel(self.left_frame, text="Public Chat", font=("Arial", 14, "bold"), text_color=("#00838F", "cyan")); self.target_label.grid(row=1, column=0, columnspan=2, padx=10, pady=(0,10), sticky="w")
         self.user_list_frame = ctk.CTkScrollableFrame(self.left_frame, label_text="Online Users"); self.user_list_frame.grid(row=2, column=0, columnspan=2, padx=10, pady=10, sticky="nsew")
-        self.control_frame = ctk.CTkFrame(self.left_frame); self.control_frame.grid(row=3, column=0, columnspan=2, padx=10, pady=(10,0), sticky="ew"); self.control_frame.grid_columnconfigure((0, 1), weight=1)
+        self.room_list_frame = ctk.CTkScrollableFrame(self.left_frame, label_text="Rooms", height=110); self.room_list_frame.grid(row=3, column=0, columnspan=2, padx=10, pady=(0,5), sticky="ew")
+        room_bar = ctk.CTkFrame(self.left_frame, fg_color="transparent"); room_bar.grid(row=4, column=0, columnspan=2, padx=10, pady=(0,5), sticky="ew"); room_bar.grid_columnconfigure(0, weight=1)
+        self.room_entry = ctk.CTkEntry(room_bar, placeholder_text="Room name"); self.room_entry.grid(row=0, column=0, padx=(0,5), sticky="ew"); self.room_entry.bind("<Return>", lambda event: self.join_room())
+        ctk.CTkButton(room_bar, text="Join", width=50, command=self.join_room).grid(row=0, column=1, padx=(0,5))
+        self.leave_room_button = ctk.CTkButton(room_bar, text="Leave", width=50, state="disabled", command=self.leave_room); self.leave_room_button.grid(row=0, column=2)
+        self.control_frame = ctk.CTkFrame(self.left_frame); self.control_frame.grid(row=5, column=0, columnspan=2, padx=10, pady=(10,0), sticky="ew"); self.control_frame.grid_columnconfigure((0, 1), weight=1)
         self.ping_button = ctk.CTkButton(self.control_frame, text="Ping Test", command=self.open_ping_window); self.ping_button.grid(row=0, column=0, padx=(0,5), sticky="ew")
         self.logout_button = ctk.CTkButton(self.control_frame, text="Logout", fg_color="#D32F2F", hover_color="#B71C1C", command=self.logout); self.logout_button.grid(row=0, column=1, padx=(5,0), sticky="ew")
 
         
-        self.chat_area = ctk.CTkScrollableFrame(self, fg_color="transparent"); self.chat_area.grid(row=0, column=1, padx=(0, 10), pady=(10,5), sticky="nsew"); self.chat_area.grid_columnconfigure(0, weight=1)
+        self.chat_area = transcript.Transcript(self, on_reach_top=self.load_older_history, fg_color="transparent"); self.chat_area.grid(row=0, column=1, padx=(0, 10), pady=(10,5), sticky="nsew")
         self.bottom_frame = ctk.CTkFrame(self, fg_color="transparent"); self.bottom_frame.grid(row=1, column=1, padx=(0, 10), pady=0, sticky="ew"); self.bottom_frame.grid_columnconfigure(0, weight=1)
         self.message_entry = ctk.CTkEntry(self.bottom_frame, placeholder_text="Type your message here...", font=("Arial", 14)); self.message_entry.grid(row=0, column=0, padx=(0,5), sticky="ew"); self.message_entry.bind("<Return>", lambda event: self.send_message())
         self.send_button = ctk.CTkButton(self.bottom_frame, text="Send", width=120, command=self.send_message); self.send_button.grid(row=0, column=1, padx=5)
@@ -62,67 +86,57 @@ class ChatClient(ctk.CTk):
         if current_mode == "Dark": ctk.set_appearance_mode("Light"); self.theme_button.configure(text="🌙")
         else: ctk.set_appearance_mode("Dark"); self.theme_button.configure(text="☀️")
        
-        self.update_user_list(list(self.user_buttons.keys() - {"__PUBLIC__"}))
+        for user in self.sorted_users: self.style_user_button(self.user_buttons[user])
+        for button in self.room_buttons.values(): self.style_user_button(button)
+        self.refresh_selection()
             
     def display_message(self, message, sender):
         """Displays a regular chat message in a styled bubble."""
-        is_own_message = sender.startswith("You")
-      
-        if is_own_message:
-            justify = "right"; anchor = "e"; padx = (50, 5)
-            bubble_color = ("#3B8ED0", "#1F6AA5"); text_color = "white"
-        else:
-            justify = "left"; anchor = "w"; padx = (5, 50)
-            bubble_color = ("#1565C0", "#1f2b38"); text_color = ("white", "#E0E0E0")
-        
-      
-        bubble_frame = ctk.CTkFrame(self.chat_area, fg_color=bubble_color, corner_radius=10); bubble_frame.grid(row=self.chat_area.grid_size()[1], column=0, padx=padx, pady=4, sticky=anchor)
-        
-        timestamp = time.strftime("%H:%M"); header_text = f"{sender} - {timestamp}"
-        header_label = ctk.CTkLabel(bubble_frame, text=header_text, font=("Arial", 10), text_color=text_color); header_label.pack(anchor=anchor, padx=10, pady=(5,0))
-     
-        message_label = ctk.CTkLabel(bubble_frame, text=message, font=("Arial", 14), text_color=text_color, wraplength=self.winfo_width() * 0.4, justify=justify); message_label.pack(anchor=anchor, padx=10, pady=(0,5), fill="x")
-        
-        self.after(10, self.scroll_to_bottom)
+        self.chat_area.add_message(transcript.KIND_OWN if sender.startswith("You") else transcript.KIND_OTHER, sender, message)
         
-    def scroll_to_bottom(self): self.chat_area._parent_canvas.yview_moveto(1.0)
+    def scroll_to_bottom(self): self.chat_area.scroll_to_bottom()
+
+    def post(self, func, *args):
+        """Runs func(*args) on the Tk thread; everything posted within one tick shares a single callback."""
+        if self.closed: return
+        with self.ui_lock:
+            self.ui_calls.append((func, args))
+            if len(self.ui_calls) > 1: return
+        self.after(UI_TICK_MS, self.flush_ui)
+
+    def flush_ui(self):
+        with self.ui_lock: calls, self.ui_calls = self.ui_calls, []
+        for func, args in calls: func(*args)
     
     def send_message(self):
-        """Prepares and sends a message packet to the server via UDP."""
+        """Sends the typed message to the selected room, user or the public chat."""
         message = self.message_entry.get().strip()
-        if not message or not self.tcp_socket: return
-        self.seq_num += 1
-        payload = {'text': message}
-       
-        if self.private_target is not None:
-            payload['recipient'] = self.private_target; msg_type = protocol.MSG_TYPE_PRIVATE_TEXT_UDP
+        if not message or not self.core.tcp_socket: return
+        if self.room_target is not None:
+            display_sender = f"You -> #{self.room_target}"; self.log_system_message(f"Sending message to room '{self.room_target}' via UDP.", "white")
+        elif self.private_target is not None:
             display_sender = f"You -> {self.private_target}"; self.log_system_message(f"Sending PM to '{self.private_target}' via UDP.", "white")
         else:
-            msg_type = protocol.MSG_TYPE_TEXT_BROADCAST_UDP; display_sender = "You"
-            self.log_system_message(f"Sending public message via UDP.", "white")
-        
-        packet = protocol.pack_data(msg_type, self.username, self.seq_num, payload)
+            display_sender = "You"; self.log_system_message(f"Sending public message via UDP.", "white")
         try:
-            self.udp_socket.sendto(packet, (protocol.SERVER_HOST, protocol.UDP_PORT))
-            
-            with self.unacked_lock: self.unacked_packets[self.seq_num] = {'packet': packet, 'time': time.time()}
+            self.core.send_text(message, self.private_target, self.room_target)
         except Exception as e:
             self.display_message_system(f"Message could not be sent: {e}", "ERROR"); self.log_system_message(f"Failed to send message: {e}", "red"); return
         
-        self.display_message(message, display_sender); self.message_entry.delete(0, 'end')
+        self.display_message(message, display_sender); self.scroll_to_bottom(); self.message_entry.delete(0, 'end')
+
+    def show_message(self, sender, text, private, room):
+        """Displays a message from another user, marked with its room or as private."""
+        self.display_message(text, f"{sender} (#{room})" if room else f"{sender} (Private)" if private else sender)
 
     def display_message_system(self, message, sender):
         """Displays a system or error message in the center of the chat area."""
-        bubble_frame = ctk.CTkFrame(self.chat_area, fg_color="transparent"); bubble_frame.grid(row=self.chat_area.grid_size()[1], column=0, pady=5, sticky="ew")
-        system_color = ("#00838F", "#00BCD4"); error_color = ("#C62828", "#F44336")
-        color = system_color if sender == "SYSTEM" else error_color
-        label = ctk.CTkLabel(bubble_frame, text=message, text_color=color, font=("Arial", 12, "italic")); label.pack()
-        self.after(10, self.scroll_to_bottom)
+        self.chat_area.add_message(transcript.KIND_SYSTEM if sender == "SYSTEM" else transcript.KIND_ERROR, sender, message)
 
     def show_login_dialog(self):
         """Prompts the user for a username before connecting."""
         dialog = ctk.CTkInputDialog(text="Enter your username:", title="Login"); username = dialog.get_input()
-        if username and username.strip(): self.username = username.strip(); self.title(f"Network Project Chat - {self.username}"); self.connect_to_server()
+        if username and username.strip(): self.start_session(username.strip())
         else: self.destroy()
 
     def log_system_message(self, message, color="white"):
@@ -133,83 +147,85 @@ class ChatClient(ctk.CTk):
         light_colors = {"green": "#00695C", "red": "#C62828", "yellow": "#B96F00", "cyan": "#00838F", "orange": "#E65100", "white": "#000000"}
         colors = light_colors if mode == "Light" else dark_colors
         for c_name, c_hex in colors.items(): self.log_box.tag_config(f"log_{c_name}", foreground=c_hex)
-        self.log_box.insert("end", f"({timestamp}) {message}\n", f"log_{color}"); self.log_box.see("end"); self.log_box.configure(state="disabled")
+        self.log_box.insert("end", f"({timestamp}) {message}\n", f"log_{color}")
+        lines = int(self.log_box.index("end-1c").split(".")[0]) - 1
+        if lines > LOG_HISTORY: self.log_box.delete("1.0", f"{lines - LOG_HISTORY + 1}.0")
+        self.log_box.see("end"); self.log_box.configure(state="disabled")
+
+    def start_session(self, username):
+        """Connects as username from a background thread, so the window stays responsive while it does."""
+        self.core.username = username; self.title(f"Network Project Chat - {username}")
+        threading.Thread(target=self.connect_to_server, daemon=True).start()
 
     def connect_to_server(self):
-        """Establishes TCP and UDP sockets and connects to the server."""
-        self.log_system_message(f"Connecting to {protocol.SERVER_HOST}:{protocol.TCP_PORT}...", "yellow")
+        """Connects the core to the server and loads the latest history."""
+        self.post(self.log_system_message, f"Connecting to {self.core.host}:{self.core.tcp_port}...", "yellow")
         try:
-            self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM); self.tcp_socket.connect((protocol.SERVER_HOST, protocol.TCP_PORT)); self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM); self.udp_socket.bind(('', 0)); self.log_system_message("Connection successful.", "green")
-            login_packet = protocol.pack_data(protocol.MSG_TYPE_LOGIN, self.username, 0, {}); self.tcp_socket.sendall(login_packet)
-            
-            threading.Thread(target=self.listen_tcp, daemon=True).start()
-            threading.Thread(target=self.retransmit_checker, daemon=True).start()
-            self.display_message_system(f"Welcome to the chat, {self.username}!", "SYSTEM")
+            self.core.connect(); self.post(self.log_system_message, "Connection successful.", "green")
+            self.request_history()
+            self.post(self.display_message_system, f"Welcome to the chat, {self.core.username}!", "SYSTEM")
         except Exception as e:
-            self.log_system_message(f"Connection failed: {e}", "red"); self.display_message_system(f"Could not connect to the server.", "ERROR"); self.after(2000, self.destroy)
-
-    def listen_tcp(self):
-        """Continuously listens for incoming data on the TCP socket."""
-        while True:
-            try:
-                header_bytes = self.tcp_socket.recv(protocol.HEADER_SIZE);
-                if not header_bytes: break
-                msg_type, sender_id, seq_num, payload_len = protocol.unpack_header(header_bytes); payload_bytes = b'';
-                if payload_len > 0: read_len = 0;
-                while read_len < payload_len: chunk = self.tcp_socket.recv(payload_len-read_len); payload_bytes += chunk; read_len += len(chunk)
-                payload = protocol.unpack_payload(payload_bytes)
-                
-                
-                if msg_type == protocol.MSG_TYPE_ACK_TCP:
-                    with self.unacked_lock:
-                        if seq_num in self.unacked_packets: del self.unacked_packets[seq_num]
-                    self.after(0, self.log_system_message, f"ACK received for UDP packet #{seq_num}.", "cyan")
-                elif msg_type == protocol.MSG_TYPE_PING_REQUEST_TCP:
-                    self.after(0, self.log_system_message, f"Received PING request from '{sender_id}'. Responding...", "cyan")
-                    response_payload = {'recipient': sender_id}; response_packet = protocol.pack_data(protocol.MSG_TYPE_PING_RESPONSE_TCP, self.username, 0, response_payload); self.tcp_socket.sendall(response_packet)
-                elif msg_type == protocol.MSG_TYPE_PING_RESPONSE_TCP:
-                    end_time = time.time()
-                    if sender_id in self.ping_start_times: start_time = self.ping_start_times.pop(sender_id); rtt = (end_time - start_time) * 1000; self.after(0, self.log_system_message, f"PING response from '{sender_id}' received. RTT: {rtt:.0f} ms.", "cyan"); self.after(0, self.update_ping_label, sender_id, f"{rtt:.0f} ms")
-                elif msg_type == protocol.MSG_TYPE_USER_LIST_TCP:
-                    self.after(0, self.update_user_list, payload['users'])
-                elif msg_type in [protocol.MSG_TYPE_TEXT_BROADCAST_UDP, protocol.MSG_TYPE_PRIVATE_TEXT_UDP]:
-                    is_private_msg = msg_type == protocol.MSG_TYPE_PRIVATE_TEXT_UDP
-                    display_sender = f"{sender_id} (Private)" if is_private_msg else sender_id
-                    self.after(0, self.display_message, payload['text'], display_sender)
-            except (ConnectionResetError, ConnectionAbortedError, OSError):
-                self.after(0, self.log_system_message, "Connection to server lost.", "red"); self.after(0, self.display_message_system, "You have been disconnected.", "ERROR"); break
-            except Exception as e:
-                print(f"TCP listen error: {e}"); break
-            
-    def retransmit_checker(self):
-        """Periodically checks for unacknowledged UDP packets and retransmits them."""
-        while True:
-            time.sleep(1); now = time.time()
-            with self.unacked_lock:
-                for seq_num, info in list(self.unacked_packets.items()):
-                    if now - info['time'] > protocol.RETRANSMIT_TIMEOUT:
-                        self.after(0, self.log_system_message, f"Packet #{seq_num} timed out. Retransmitting...", "yellow")
-                        self.udp_socket.sendto(info['packet'], (protocol.SERVER_HOST, protocol.UDP_PORT))
-                        info['time'] = now
-                        
-    def update_user_list(self, new_users_list):
-        """Redraws the online user list, applying correct theme colors."""
-        current_users = set(self.user_buttons.keys() - {"__PUBLIC__"}); new_users_set = set(new_users_list)
-        joined = new_users_set - current_users; left = current_users - new_users_set
+            self.post(self.log_system_message, f"Connection failed: {e}", "red"); self.post(self.display_message_system, f"Could not connect to the server.", "ERROR"); self.post(self.after, 2000, self.destroy)
+
+    def log_retransmits(self, seq_nums, rto):
+        for seq_num in seq_nums: self.log_system_message(f"Packet #{seq_num} timed out. Retransmitting (RTO {rto:.2f}s)...", "yellow")
+
+    def show_connection_state(self, state, detail):
+        """Reports a change in the connection to the server."""
+        if state == 'lost':
+            self.log_system_message("Connection to server lost.", "red")
+            if self.core.session: self.display_message_system("Connection lost, reconnecting...", "ERROR")
+        elif state == 'reconnect_failed': self.log_system_message(f"Reconnect failed ({detail}).", "red")
+        elif state == 'resumed': self.log_system_message("Session resumed; anything sent while away follows.", "green"); self.display_message_system("Reconnected.", "SYSTEM")
+        elif state == 'relogin': self.log_system_message("Session expired; logging in again.", "yellow")
+        elif state == 'closed': self.display_message_system("You have been disconnected.", "ERROR")
+
+    def request_history(self, before=None):
+        """Asks the server for the public messages preceding message number `before` (the newest if None)."""
+        self.history_pending = True; self.core.request_history(before)
+
+    def load_older_history(self):
+        """Fetches the next page of scrollback once the oldest loaded message comes into view."""
+        if self.history_before is not None and not self.history_pending:
+            try: self.request_history(self.history_before)
+            except OSError: self.history_pending = False
+
+    def show_history(self, payload):
+        """Puts a page of stored messages above everything in the chat area."""
+        entries = []
+        for message in payload.get('messages', []):
+            sender = message['sender']; recipient = message.get('recipient'); room = message.get('room'); own = sender == self.core.username
+            if room: display_sender = f"You -> #{room}" if own else f"{sender} (#{room})"
+            elif own: display_sender = f"You -> {recipient}" if recipient else "You"
+            else: display_sender = f"{sender} (Private)" if recipient else sender
+            entries.append((transcript.KIND_OWN if own else transcript.KIND_OTHER, display_sender, message['text'], message['time']))
+        self.chat_area.prepend_messages(entries)
+        self.history_before = payload.get('before') if payload.get('more') else None; self.history_pending = False
+
+    def apply_roster_delta(self, joined, left):
+        """Adds and removes user buttons for the users that joined or left, leaving the rest untouched."""
         for user in joined: self.log_system_message(f"User '{user}' has joined the chat.", "green")
         for user in left: self.log_system_message(f"User '{user}' has left the chat.", "orange")
-        for widget in self.user_list_frame.winfo_children(): widget.destroy()
-        self.user_buttons.clear()
 
+        if "__PUBLIC__" not in self.user_buttons:
+            public_chat_fg_color = ("#EAECEE", "#343638")
+            public_button = ctk.CTkButton(self.user_list_frame, text="Public Chat", command=lambda: self.select_user(None), fg_color=public_chat_fg_color); public_button.pack(fill="x", padx=5, pady=2); self.user_buttons["__PUBLIC__"] = public_button
+        for user in left:
+            if user in self.user_buttons: self.user_buttons.pop(user).destroy(); self.sorted_users.remove(user)
+        for user in sorted(joined):
+            if user in self.user_buttons: continue
+            index = bisect.bisect(self.sorted_users, user); self.sorted_users.insert(index, user)
+            button = ctk.CTkButton(self.user_list_frame, text=user, command=partial(self.select_user, user)); self.style_user_button(button); self.user_buttons[user] = button
+            if index + 1 < len(self.sorted_users): button.pack(fill="x", padx=5, pady=2, before=self.user_buttons[self.sorted_users[index + 1]])
+            else: button.pack(fill="x", padx=5, pady=2)
+        self.refresh_selection()
+
+    def style_user_button(self, button):
+        """Applies the current theme's colors to a user button."""
         mode = ctk.get_appearance_mode()
-        public_chat_fg_color = ("#EAECEE", "#343638")
         user_button_fg_color = "#AED6F1" if mode == "Light" else "transparent"
         user_button_text_color = "black" if mode == "Light" else "white"
-
-        public_button = ctk.CTkButton(self.user_list_frame, text="Public Chat", command=lambda: self.select_user(None), fg_color=public_chat_fg_color); public_button.pack(fill="x", padx=5, pady=2); self.user_buttons["__PUBLIC__"] = public_button
-        for user in sorted(list(new_users_set)):
-            button = ctk.CTkButton(self.user_list_frame, text=user, fg_color=user_button_fg_color, text_color=user_button_text_color, border_width=1 if mode == "Dark" else 0, command=partial(self.select_user, user)); button.pack(fill="x", padx=5, pady=2); self.user_buttons[user] = button
-        self.select_user(self.private_target)
+        button.configure(fg_color=user_button_fg_color, text_color=user_button_text_color, border_width=1 if mode == "Dark" else 0)
 
     def select_user(self, username):
         """Highlights the selected user in the list and sets them as the private message target."""
@@ -221,8 +237,10 @@ class ChatClient(ctk.CTk):
         if "__PUBLIC__" in self.user_buttons: self.user_buttons["__PUBLIC__"].configure(fg_color=public_chat_fg_color)
         for user, button in self.user_buttons.items():
             if user != "__PUBLIC__": button.configure(fg_color=user_button_fg_color)
+        for button in self.room_buttons.values(): button.configure(fg_color=user_button_fg_color)
 
-        self.private_target = username
+        self.private_target = username; self.room_target = None
+        self.leave_room_button.configure(state="disabled")
         private_color = ("#AF601A", "yellow")
         
         if username:
@@ -231,11 +249,65 @@ class ChatClient(ctk.CTk):
         else:
             self.target_label.configure(text="Public Chat", text_color=("#00838F", "cyan"))
             if "__PUBLIC__" in self.user_buttons: self.user_buttons["__PUBLIC__"].configure(fg_color=selected_color)
+
+    def select_room(self, room):
+        """Highlights a joined room in the room list and sets it as the message target."""
+        self.select_user(None)
+        if "__PUBLIC__" in self.user_buttons: self.user_buttons["__PUBLIC__"].configure(fg_color=("#EAECEE", "#343638"))
+        self.room_target = room
+        self.target_label.configure(text=f"#{room}", text_color=("#1E8449", "lightgreen"))
+        if room in self.room_buttons: self.room_buttons[room].configure(fg_color=("#2980B9", "#1F6AA5"))
+        self.leave_room_button.configure(state="normal")
+
+    def refresh_selection(self):
+        """Re-applies the current target's highlight after the lists or the theme changed."""
+        if self.room_target is not None: self.select_room(self.room_target)
+        else: self.select_user(self.private_target)
+
+    def update_room_list(self, rooms, joined=None):
+        """Rebuilds the room list; joined, when given, is the set of rooms this user is a member of."""
+        if joined is not None:
+            joined = set(joined)
+            for room in sorted(joined - self.joined_rooms): self.log_system_message(f"Joined room '{room}'.", "green")
+            for room in sorted(self.joined_rooms - joined): self.log_system_message(f"Left room '{room}'.", "orange")
+            self.joined_rooms = joined
+        self.rooms = sorted(set(rooms) | self.joined_rooms)
+        for button in self.room_buttons.values(): button.destroy()
+        self.room_buttons = {}
+        for room in self.rooms:
+            # Rooms this user is in are selectable targets; clicking any other room joins it.
+            button = ctk.CTkButton(self.room_list_frame, text=f"# {room}" if room in self.joined_rooms else f"+ {room}", anchor="w", command=partial(self.room_clicked, room))
+            self.style_user_button(button); button.pack(fill="x", padx=5, pady=2); self.room_buttons[room] = button
+        if self.pending_room in self.joined_rooms: self.room_target = self.pending_room; self.pending_room = None
+        if self.room_target not in self.joined_rooms: self.room_target = None
+        self.refresh_selection()
+
+    def room_clicked(self, room):
+        if room in self.joined_rooms: self.select_room(room)
+        else: self.join_room(room)
+
+    def join_room(self, room=None):
+        """Asks the server to add this user to a room (the one typed in the room entry if None)."""
+        if room is None: room = self.room_entry.get().strip()
+        if not self.core.tcp_socket or not room: return
+        if not protocol.valid_room_name(room): self.log_system_message(f"Room names are 1 to {protocol.MAX_ROOM_NAME} bytes long, without surrounding spaces.", "red"); return
+        if room in self.joined_rooms: self.select_room(room); return
+        self.pending_room = room; self.room_entry.delete(0, 'end')
+        try: self.core.join_room(room)
+        except OSError as e: self.log_system_message(f"Could not join room '{room}': {e}", "red")
+
+    def leave_room(self):
+        """Leaves the selected room and goes back to the public chat."""
+        room = self.room_target
+        if room is None or not self.core.tcp_socket: return
+        try: self.core.leave_room(room)
+        except OSError as e: self.log_system_message(f"Could not leave room '{room}': {e}", "red"); return
+        self.select_user(None)
             
     def logout(self):
         """Logs out from the server and closes the application."""
-        if self.tcp_socket:
-            try: self.log_system_message("Logging out...", "orange"); self.tcp_socket.sendall(protocol.pack_data(protocol.MSG_TYPE_LOGOUT_TCP, self.username, 0, {}))
+        if self.core.tcp_socket:
+            try: self.log_system_message("Logging out...", "orange"); self.core.logout()
             except Exception as e: print(f"Error during logout: {e}")
             finally: self.on_closing()
             
@@ -244,23 +316,27 @@ class ChatClient(ctk.CTk):
         if self.ping_window is not None and self.ping_window.winfo_exists(): self.ping_window.lift(); return
         self.ping_window = ctk.CTkToplevel(self); self.ping_window.title("Network Topology - Ping Test"); self.ping_window.geometry("350x400"); self.ping_window.transient(self); self.ping_window.resizable(False, True)
         main_frame = ctk.CTkScrollableFrame(self.ping_window, label_text="Ping a User"); main_frame.pack(expand=True, fill="both", padx=10, pady=10); main_frame.grid_columnconfigure(0, weight=1)
-        self.ping_labels.clear(); online_users = list(self.user_buttons.keys() - {"__PUBLIC__"})
-        if not online_users: ctk.CTkLabel(main_frame, text="No other users in chat.").pack(pady=20); return
-        for i, user in enumerate(sorted(online_users)):
+        self.ping_labels.clear(); online_users = [protocol.SERVER_NAME] + sorted(self.sorted_users)
+        for i, user in enumerate(online_users):
             row_frame = ctk.CTkFrame(main_frame, fg_color="transparent"); row_frame.grid(row=i, column=0, pady=5, sticky="ew"); row_frame.grid_columnconfigure(0, weight=1)
             ctk.CTkLabel(row_frame, text=user).grid(row=0, column=0, padx=5, sticky="w")
-            ping_label = ctk.CTkLabel(row_frame, text="- ms", width=70); ping_label.grid(row=0, column=1, padx=5); self.ping_labels[user] = ping_label
+            stats = self.core.latency.get(user)
+            ping_label = ctk.CTkLabel(row_frame, text=f"{stats.last * 1000:.1f} ms" if stats else "- ms", width=70); ping_label.grid(row=0, column=1, padx=5); self.ping_labels[user] = ping_label
             ping_btn = ctk.CTkButton(row_frame, text="Ping", width=60, command=partial(self.send_ping_request, user)); ping_btn.grid(row=0, column=2, padx=5)
             
     def send_ping_request(self, target_user):
         """Sends a PING request to a specific user."""
         try:
             self.log_system_message(f"Sending PING request to '{target_user}'.", "white")
-            self.ping_start_times[target_user] = time.time()
             if self.ping_window and self.ping_window.winfo_exists() and target_user in self.ping_labels: self.ping_labels[target_user].configure(text="...")
-            self.tcp_socket.sendall(protocol.pack_data(protocol.MSG_TYPE_PING_REQUEST_TCP, self.username, 0, {'recipient': target_user}))
+            self.core.ping(target_user)
         except Exception as e: print(f"Could not send ping request: {e}"); self.log_system_message(f"Failed to send PING to '{target_user}'.", "red")
-        
+
+    def ping_answered(self, peer, rtt, manual):
+        """Shows a probe or ping RTT in the ping window, and logs answers to the pings sent from it."""
+        if manual: self.post(self.log_system_message, f"PING response from '{peer}' received. RTT: {rtt * 1000:.1f} ms.", "cyan")
+        self.post(self.update_ping_label, peer, f"{rtt * 1000:.1f} ms")
+
     def update_ping_label(self, user, text):
         """Updates the RTT label in the ping window."""
         if self.ping_window and self.ping_window.winfo_exists() and user in self.ping_labels:
@@ -268,13 +344,56 @@ class ChatClient(ctk.CTk):
             
     def on_closing(self):
         """Handles cleanup when the main window is closed."""
+        self.closed = True
         if self.ping_window is not None: self.ping_window.destroy()
-        if self.tcp_socket:
-            try: self.tcp_socket.close()
-            except: pass
-        if self.udp_socket: self.udp_socket.close()
+        # Closing the window is leaving: log out rather than leave a session waiting to be resumed.
+        self.core.logout()
         self.destroy()
 
+def run_stress(rate, duration):
+    """Feeds synthetic messages through the network receive path at `rate` per second and reports UI frame times.
+
+    A heartbeat re-arms itself every UI_TICK_MS; the gap between beats is the frame time,
+    so anything that keeps the Tk loop busy shows up as frames well over the tick.
+    """
+    app = ChatClient(login=False); app.core.username = "stress"
+    frame_times = []; render_times = []; state = {'last': time.perf_counter(), 'sent': 0, 'running': True}
+    render = app.chat_area.render
+    def timed_render(): start = time.perf_counter(); render(); render_times.append(time.perf_counter() - start)
+    app.chat_area.render = timed_render
+
+    def feed():
+        frames = protocol.FrameReader(); interval = 1 / rate; next_time = time.perf_counter(); end = next_time + duration
+        while time.perf_counter() < end:
+            state['sent'] += 1; next_time += interval
+            packet = protocol.pack_data(protocol.MSG_TYPE_TEXT_BROADCAST_UDP, f"user{state['sent'] % 20}", state['sent'], {'text': f"Stress message #{state['sent']} " + "lorem ipsum " * (state['sent'] % 8)})
+            for frame in frames.feed(packet): app.core.handle_frame(frame)
+            time.sleep(max(0.0, next_time - time.perf_counter()))
+        state['running'] = False
+
+    def beat():
+        now = time.perf_counter(); frame_times.append(now - state['last']); state['last'] = now
+        if state['running']: app.after(UI_TICK_MS, beat)
+        else: app.after(500, app.quit)
+
+    app.after(500, lambda: (threading.Thread(target=feed, daemon=True).start(), beat()))
+    app.mainloop()
+
+    def count_widgets(widget): return 1 + sum(count_widgets(child) for child in widget.winfo_children())
+    ms = lambda values, p: sorted(values)[min(int(p / 100 * len(values)), len(values) - 1)] * 1000 if values else 0.0
+    print(f"messages: {state['sent']} in {duration:.0f}s ({rate:.0f}/s), stored: {len(app.chat_area.messages)}, widgets: {count_widgets(app)}")
+    print(f"frame time ms: p50 {ms(frame_times, 50):.1f}  p99 {ms(frame_times, 99):.1f}  max {ms(frame_times, 100):.1f}  (tick {UI_TICK_MS} ms, {sum(t > 2 * UI_TICK_MS / 1000 for t in frame_times)} of {len(frame_times)} frames over 2 ticks)")
+    print(f"render ms: p50 {ms(render_times, 50):.2f}  p99 {ms(render_times, 99):.2f}  ({len(render_times)} renders)")
+    app.destroy()
+
 if __name__ == "__main__":
-    app = ChatClient()
-    app.mainloop()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Network Project Chat client.")
+    parser.add_argument('--user', help="Log in with this username right away instead of asking for one.")
+    parser.add_argument('--stress', action='store_true', help="Measure UI frame time under a synthetic message flood instead of connecting.")
+    parser.add_argument('--rate', type=float, default=100.0, help="Messages per second in stress mode.")
+    parser.add_argument('--duration', type=float, default=10.0, help="Seconds of stress.")
+    args = parser.parse_args()
+    if args.stress: run_stress(args.rate, args.duration)
+    else:
+        app = ChatClient(username=args.user)
+        app.mainloop()
@@ -0,0 +1,157 @@
+import os
+import mmap
+import time
+import struct
+import bisect
+import threading
+from array import array
+
+# Every record is a fixed header, the conversation key and the message frame exactly as
+# the server received it, so storing a message never decodes its payload.
+RECORD_HEADER_FORMAT = '! d I H'  # timestamp, frame length, conversation key length
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER_FORMAT)
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+SEGMENT_PREFIX = 'segment-'
+SEGMENT_SUFFIX = '.log'
+OFFSET_BITS = 40  # a position is (segment number << OFFSET_BITS) | offset in the segment
+
+PUBLIC = 'public'
+ROOM_PREFIX = '#'
+MAX_PAGE_SIZE = 500
+
+
+def conversation_key(sender, recipient=None, room=None):
+    """PUBLIC for broadcasts; the room name after ROOM_PREFIX for a room; the two usernames in sorted order for a private conversation."""
+    if room is not None: return ROOM_PREFIX + room
+    return PUBLIC if recipient is None else '\0'.join(sorted((sender, recipient)))
+
+
+class Segment:
+    """One append-only file of records, read through a memory map of its current contents."""
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a+b')
+        self.size = self.file.tell()
+        self.map = None
+        self.dirty = False
+
+    def append(self, record):
+        offset = self.size
+        self.file.write(record); self.size += len(record); self.dirty = True
+        return offset
+
+    def mapped(self, end):
+        """The memory map, re-mapped first if the file has grown past it and `end` lies beyond the old map."""
+        if self.map is None or end > len(self.map):
+            if self.dirty: self.file.flush(); self.dirty = False
+            if self.map is not None: self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map
+
+    def read_header(self, offset):
+        return struct.unpack_from(RECORD_HEADER_FORMAT, self.mapped(offset + RECORD_HEADER_SIZE), offset)
+
+    def read(self, offset, length):
+        return self.mapped(offset + length)[offset:offset + length]
+
+    def truncate(self, size):
+        """Drops a partly written record left at the end of the file by a crash."""
+        if self.map is not None: self.map.close(); self.map = None
+        self.file.truncate(size); self.size = size
+
+    def seal(self):
+        """Stops appending; the segment stays readable."""
+        if self.dirty: self.file.flush(); self.dirty = False
+
+    def close(self):
+        if self.map is not None: self.map.close(); self.map = None
+        self.file.close()
+
+
+class HistoryStore:
+    """Append-only message history split into segment files, indexed by conversation.
+
+    The index keeps, per conversation, the timestamp and file position of every message
+    in two flat arrays (16 bytes a message), so a page of scrollback is a bisect plus
+    one mmap slice per message, however many millions are stored. The index is rebuilt
+    by scanning the segments when the store is opened. Writes go to the page cache, not
+    to disk: a crash of the machine, not just the server, can lose the newest messages.
+    """
+    def __init__(self, directory, segment_size=SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.segments = []
+        self.index = {}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        names = sorted(name for name in os.listdir(directory) if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX))
+        for name in names: self.load_segment(os.path.join(directory, name))
+        if not self.segments: self.open_segment()
+
+    def segment_path(self, number):
+        return os.path.join(self.directory, f'{SEGMENT_PREFIX}{number:06d}{SEGMENT_SUFFIX}')
+
+    def open_segment(self):
+        if self.segments: self.segments[-1].seal()
+        self.segments.append(Segment(self.segment_path(len(self.segments))))
+
+    def load_segment(self, path):
+        """Opens an existing segment and adds its records to the index."""
+        segment = Segment(path); number = len(self.segments); self.segments.append(segment)
+        offset = 0
+        while offset + RECORD_HEADER_SIZE <= segment.size:
+            timestamp, frame_len, key_len = segment.read_header(offset)
+            end = offset + RECORD_HEADER_SIZE + key_len + frame_len
+            if end > segment.size: break
+            key = segment.read(offset + RECORD_HEADER_SIZE, key_len).decode('utf-8')
+            self.add_to_index(key, timestamp, number << OFFSET_BITS | offset)
+            offset = end
+        if offset < segment.size: segment.truncate(offset)
+
+    def add_to_index(self, key, timestamp, position):
+        timestamps, positions = self.index.setdefault(key, (array('d'), array('Q')))
+        # Keeps each conversation sorted by time even if the wall clock steps backwards.
+        timestamps.append(max(timestamp, timestamps[-1]) if timestamps else timestamp); positions.append(position)
+
+    def append(self, key, frame, timestamp=None):
+        """Stores one message frame under a conversation key; returns its number within the conversation."""
+        timestamp = time.time() if timestamp is None else timestamp
+        key_bytes = key.encode('utf-8')
+        record = struct.pack(RECORD_HEADER_FORMAT, timestamp, len(frame), len(key_bytes)) + key_bytes + bytes(frame)
+        with self.lock:
+            if self.segments[-1].size and self.segments[-1].size + len(record) > self.segment_size: self.open_segment()
+            offset = self.segments[-1].append(record)
+            self.add_to_index(key, timestamp, (len(self.segments) - 1) << OFFSET_BITS | offset)
+            return len(self.index[key][0]) - 1
+
+    def count(self, key):
+        with self.lock:
+            return len(self.index[key][0]) if key in self.index else 0
+
+    def find(self, key, timestamp):
+        """The number of the first message in the conversation at or after timestamp."""
+        with self.lock:
+            return bisect.bisect_left(self.index[key][0], timestamp) if key in self.index else 0
+
+    def page(self, key, before=None, limit=50):
+        """Returns (start, [(timestamp, frame bytes), ...]) for up to limit messages before message number `before`.
+
+        Messages are numbered from 0 in each conversation and returned oldest first; pass
+        the returned start as `before` to fetch the page preceding this one.
+        """
+        with self.lock:
+            if key not in self.index: return 0, []
+            timestamps, positions = self.index[key]
+            end = len(timestamps) if before is None else min(max(before, 0), len(timestamps))
+            start = max(end - min(limit, MAX_PAGE_SIZE), 0)
+            messages = []
+            for i in range(start, end):
+                segment = self.segments[positions[i] >> OFFSET_BITS]; offset = positions[i] & ((1 << OFFSET_BITS) - 1)
+                _, frame_len, key_len = segment.read_header(offset)
+                messages.append((timestamps[i], segment.read(offset + RECORD_HEADER_SIZE + key_len, frame_len)))
+            return start, messages
+
+    def close(self):
+        with self.lock:
+            for segment in self.segments: segment.close()
@@ -0,0 +1,312 @@
+"""Load generator: simulated users driving a running chat server over the real wire protocol.
+
+Every simulated user logs in over TCP exactly like client.py (same codecs and features),
+sends broadcast and private messages over UDP with the client's retransmission logic,
+answers and issues PINGs, and records:
+
+- ack latency:      first send of a UDP message until its ACK arrives (includes retransmissions)
+- delivery latency: first send until each recipient receives the message over TCP
+- ping RTT:         PING_REQUEST until the matching PING_RESPONSE, timed by the
+                    time.monotonic_ns() stamp that the response echoes back
+
+as log-bucketed histograms with p50/p99/p999. Send timestamps travel inside the
+message text, so all users must run in one process (they share one monotonic clock).
+--loss drops that fraction of outgoing datagrams before they are sent, to exercise
+retransmission. Results are written as JSON for comparison between server versions.
+
+--text-size pads every message to that many characters of chat-like text, to load
+compression and, above one datagram, fragmentation.
+
+Usage: python loadgen.py [--users 1000] [--duration 30] [--rate 500] [--private-ratio 0.5]
+                         [--ping-rate 10] [--loss 0.0] [--codec binary] [--text-size 0]
+                         [--output results.json]
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import sys
+import time
+
+import protocol
+import reliability
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+STAMP_PREFIX = 'loadgen:'
+FILLER_WORDS = 'the quick brown fox jumps over lazy dog and then some more chat text about the meeting tomorrow'.split()
+RETRANSMIT_TICK = 0.02
+CONNECT_CONCURRENCY = 200
+
+
+class LatencyHistogram:
+    """Latency samples counted in log-spaced buckets.
+
+    Each bucket is GROWTH times wider than the one before, so every reported
+    percentile is within 2% of the true sample while memory stays a few hundred
+    counters however many samples are recorded.
+    """
+    GROWTH = 1.02
+    RESOLUTION = 1e-6
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def record(self, seconds):
+        bucket = int(math.log(max(seconds, self.RESOLUTION) / self.RESOLUTION, self.GROWTH))
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1; self.total += seconds
+        self.min = min(self.min, seconds); self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        """The smallest bucket bound at or below which p percent of the samples fall, in seconds."""
+        if not self.count: return None
+        rank = math.ceil(p / 100 * self.count); seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank: return min(self.RESOLUTION * self.GROWTH ** (bucket + 1), self.max)
+        return self.max
+
+    def summary(self):
+        """Count and milliseconds for min, mean, p50, p90, p99, p999 and max."""
+        if not self.count: return {'count': 0}
+        ms = lambda seconds: round(seconds * 1000, 3)
+        return {'count': self.count, 'min': ms(self.min), 'mean': ms(self.total / self.count),
+                'p50': ms(self.percentile(50)), 'p90': ms(self.percentile(90)), 'p99': ms(self.percentile(99)),
+                'p999': ms(self.percentile(99.9)), 'max': ms(self.max)}
+
+
+class SimulatedUser:
+    """One headless chat client."""
+    def __init__(self, generator, name):
+        self.generator = generator
+        self.name = name
+        self.seq_num = 0
+        self.codec = protocol.CODEC_JSON
+        self.compress = False
+        self.retransmits = reliability.RetransmitQueue()
+        self.sent_at = {}
+        self.pending_pings = set()
+        self.writer = None
+
+    async def connect(self):
+        gen = self.generator
+        reader, self.writer = await asyncio.open_connection(gen.args.host, gen.args.tcp_port)
+        codecs = [gen.args.codec] if gen.args.codec != protocol.CODEC_JSON else []
+        self.writer.write(protocol.pack_data(protocol.MSG_TYPE_LOGIN, self.name, 0, {'codecs': codecs + [protocol.CODEC_JSON], 'features': [protocol.FEATURE_ACK_BATCH, protocol.FEATURE_ROSTER_DELTA, protocol.FEATURE_COMPRESSION]}))
+        asyncio.get_running_loop().create_task(self.listen(reader))
+
+    async def listen(self, reader):
+        frames = protocol.FrameReader()
+        try:
+            while True:
+                data = await reader.read(protocol.READ_BUFFER_SIZE)
+                if not data: break
+                for frame in frames.feed(data): self.handle_frame(frame)
+        except OSError:
+            pass
+        if self.generator.running: self.generator.stats['disconnects'] += 1
+
+    def handle_frame(self, frame):
+        gen = self.generator; now = time.monotonic()
+        if frame.msg_type == protocol.MSG_TYPE_BATCH:
+            for inner in protocol.split_batch(frame.payload, frame.flags): self.handle_frame(inner)
+            return
+        if frame.flags & protocol.FLAG_BINARY_PAYLOAD: self.codec = protocol.CODEC_BINARY
+        if frame.msg_type == protocol.MSG_TYPE_ACK_TCP:
+            self.acked([frame.seq_num] if self.retransmits.ack(frame.seq_num, now) else [], now)
+        elif frame.msg_type == protocol.MSG_TYPE_ACK_BATCH_TCP:
+            payload = protocol.unpack_payload(frame.payload, frame.flags) or {}
+            self.acked(self.retransmits.ack_matching(reliability.acked_by(payload), now), now)
+        elif frame.msg_type in (protocol.MSG_TYPE_TEXT_BROADCAST_UDP, protocol.MSG_TYPE_PRIVATE_TEXT_UDP):
+            text = (protocol.unpack_payload(frame.payload, frame.flags) or {}).get('text', '')
+            if text.startswith(STAMP_PREFIX):
+                gen.stats['deliveries_received'] += 1
+                if gen.measuring: gen.delivery_latency.record(now - float(text[len(STAMP_PREFIX):].split(' ', 1)[0]))
+        elif frame.msg_type == protocol.MSG_TYPE_USER_LIST_TCP:
+            payload = protocol.unpack_payload(frame.payload, frame.flags) or {}
+            if 'features' in payload: self.compress = protocol.FEATURE_COMPRESSION in payload['features']
+        elif frame.msg_type == protocol.MSG_TYPE_PING_REQUEST_TCP:
+            # Includes the server's own latency probes.
+            payload = protocol.unpack_payload(frame.payload, frame.flags) or {}; response = {'recipient': frame.sender_id}
+            if 'sent' in payload: response['sent'] = payload['sent']
+            self.writer.write(protocol.pack_data(protocol.MSG_TYPE_PING_RESPONSE_TCP, self.name, 0, response, self.codec))
+        elif frame.msg_type == protocol.MSG_TYPE_PING_RESPONSE_TCP:
+            rtt = reliability.probe_rtt(protocol.unpack_payload(frame.payload, frame.flags))
+            if frame.sender_id in self.pending_pings and rtt is not None:
+                self.pending_pings.discard(frame.sender_id); gen.stats['pings_answered'] += 1
+                if gen.measuring: gen.ping_rtt.record(rtt)
+
+    def acked(self, seq_nums, now):
+        gen = self.generator
+        for seq_num in seq_nums:
+            sent = self.sent_at.pop(seq_num, None)
+            if sent is None: continue
+            gen.stats['acked'] += 1
+            if gen.measuring: gen.ack_latency.record(now - sent)
+
+    def send_text(self, recipient=None):
+        self.seq_num += 1; now = time.monotonic()
+        payload = {'text': f'{STAMP_PREFIX}{now!r}{self.generator.filler}'}
+        if recipient: payload['recipient'] = recipient
+        msg_type = protocol.MSG_TYPE_PRIVATE_TEXT_UDP if recipient else protocol.MSG_TYPE_TEXT_BROADCAST_UDP
+        packet = protocol.pack_data(msg_type, self.name, self.seq_num, payload, self.codec, self.compress)
+        self.retransmits.add(self.seq_num, packet, now); self.sent_at[self.seq_num] = now
+        for datagram in protocol.fragment(packet): self.generator.send_datagram(datagram)
+
+    def send_ping(self, target):
+        if target in self.pending_pings: return False
+        self.pending_pings.add(target)
+        self.writer.write(protocol.pack_data(protocol.MSG_TYPE_PING_REQUEST_TCP, self.name, 0, {'recipient': target, 'sent': time.monotonic_ns()}, self.codec))
+        return True
+
+
+class LoadGenerator:
+    """Connects the simulated users and drives traffic at the configured rates."""
+    def __init__(self, args):
+        self.args = args
+        self.filler = ' ' + ' '.join(random.choice(FILLER_WORDS) for _ in range(args.text_size // 5))[:args.text_size] if args.text_size else ''
+        self.users = []
+        self.udp = None
+        self.running = False
+        self.measuring = False
+        self.ack_latency = LatencyHistogram()
+        self.delivery_latency = LatencyHistogram()
+        self.ping_rtt = LatencyHistogram()
+        self.connect_time = LatencyHistogram()
+        self.stats = dict.fromkeys(('broadcasts_sent', 'privates_sent', 'acked', 'deliveries_expected', 'deliveries_received',
+                                    'udp_datagrams_sent', 'udp_datagrams_dropped', 'retransmissions', 'pings_sent', 'pings_answered',
+                                    'connect_failures', 'disconnects'), 0)
+
+    def send_datagram(self, packet):
+        if random.random() < self.args.loss: self.stats['udp_datagrams_dropped'] += 1; return
+        self.stats['udp_datagrams_sent'] += 1
+        self.udp.sendto(packet)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.udp, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=(self.args.host, self.args.udp_port))
+        self.running = True
+        await self.connect_users()
+        await asyncio.sleep(self.args.settle)
+        retransmitter = loop.create_task(self.retransmit_loop())
+
+        self.measuring = True; start = time.monotonic()
+        traffic = [loop.create_task(self.paced(self.args.rate, self.send_random_message))]
+        if self.args.ping_rate: traffic.append(loop.create_task(self.paced(self.args.ping_rate, self.send_random_ping)))
+        await asyncio.sleep(self.args.duration)
+        for task in traffic: task.cancel()
+        elapsed = time.monotonic() - start
+        await asyncio.sleep(self.args.drain)
+        self.measuring = False; self.running = False
+        retransmitter.cancel()
+        for user in self.users: user.writer.close()
+        return self.report(elapsed)
+
+    async def connect_users(self):
+        limit = asyncio.Semaphore(CONNECT_CONCURRENCY)
+        interval = self.args.ramp / self.args.users
+
+        async def connect(index):
+            await asyncio.sleep(index * interval)
+            user = SimulatedUser(self, f'{self.args.prefix}{index}')
+            async with limit:
+                start = time.monotonic()
+                try:
+                    await user.connect()
+                except OSError as e:
+                    self.stats['connect_failures'] += 1
+                    if self.stats['connect_failures'] == 1: print(f"Connection failed: {e}", file=sys.stderr)
+                    return
+                self.connect_time.record(time.monotonic() - start)
+                self.users.append(user)
+        await asyncio.gather(*(connect(index) for index in range(self.args.users)))
+        if len(self.users) < 2: raise SystemExit(f"Only {len(self.users)} users could connect; is the server running on {self.args.host}:{self.args.tcp_port}?")
+
+    async def paced(self, rate, action):
+        """Calls action() rate times per second on an absolute schedule, catching up after oversleeping."""
+        interval = 1 / rate; next_time = time.monotonic()
+        while True:
+            now = time.monotonic()
+            while next_time <= now: action(); next_time += interval
+            await asyncio.sleep(next_time - now)
+
+    def send_random_message(self):
+        sender = random.choice(self.users)
+        if random.random() < self.args.private_ratio:
+            recipient = random.choice(self.users)
+            while recipient is sender: recipient = random.choice(self.users)
+            sender.send_text(recipient.name); self.stats['privates_sent'] += 1; self.stats['deliveries_expected'] += 1
+        else:
+            sender.send_text(); self.stats['broadcasts_sent'] += 1; self.stats['deliveries_expected'] += len(self.users) - 1
+
+    def send_random_ping(self):
+        sender, target = random.sample(self.users, 2)
+        if sender.send_ping(target.name): self.stats['pings_sent'] += 1
+
+    async def retransmit_loop(self):
+        while True:
+            await asyncio.sleep(RETRANSMIT_TICK)
+            now = time.monotonic()
+            for user in self.users:
+                due = user.retransmits.pop_due(now)
+                if not due: continue
+                self.stats['retransmissions'] += len(due)
+                for datagram in protocol.pack_batch(user.name, [packet for _, packet in due], compress=user.compress): self.send_datagram(datagram)
+
+    def report(self, elapsed):
+        sent = self.stats['broadcasts_sent'] + self.stats['privates_sent']
+        return {
+            'config': {key: value for key, value in vars(self.args).items() if key != 'output'},
+            'connected_users': len(self.users),
+            'elapsed': round(elapsed, 3),
+            'throughput': {'messages_per_s': round(sent / elapsed, 1), 'deliveries_per_s': round(self.stats['deliveries_received'] / elapsed, 1)},
+            'counts': dict(self.stats, unacked=sum(len(user.retransmits) for user in self.users)),
+            'latency_ms': {'ack': self.ack_latency.summary(), 'delivery': self.delivery_latency.summary(),
+                           'ping_rtt': self.ping_rtt.summary(), 'connect': self.connect_time.summary()},
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default=protocol.SERVER_HOST)
+    parser.add_argument('--tcp-port', type=int, default=protocol.TCP_PORT)
+    parser.add_argument('--udp-port', type=int, default=protocol.UDP_PORT)
+    parser.add_argument('--users', type=int, default=1000, help="Simulated users to log in.")
+    parser.add_argument('--prefix', default='load', help="Username prefix; usernames are <prefix><index>.")
+    parser.add_argument('--ramp', type=float, default=2.0, help="Seconds over which the users connect.")
+    parser.add_argument('--settle', type=float, default=1.0, help="Seconds to wait after connecting before sending.")
+    parser.add_argument('--duration', type=float, default=30.0, help="Seconds of measured traffic.")
+    parser.add_argument('--drain', type=float, default=3.0, help="Seconds to keep receiving after traffic stops.")
+    parser.add_argument('--rate', type=float, default=500.0, help="UDP messages per second across all users.")
+    parser.add_argument('--private-ratio', type=float, default=0.5, help="Share of messages sent privately rather than broadcast.")
+    parser.add_argument('--ping-rate', type=float, default=10.0, help="PING requests per second across all users (0 disables).")
+    parser.add_argument('--loss', type=float, default=0.0, help="Fraction of outgoing UDP datagrams to drop before sending.")
+    parser.add_argument('--codec', choices=protocol.SUPPORTED_CODECS, default=protocol.CODEC_BINARY, help="Payload codec to offer at login.")
+    parser.add_argument('--text-size', type=int, default=0, help="Pad each message with this many characters of filler text.")
+    parser.add_argument('--seed', type=int, help="Random seed, for repeatable traffic.")
+    parser.add_argument('--output', help="Write the JSON results to this file instead of stdout.")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    if resource:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    results = asyncio.run(LoadGenerator(args).run())
+    if args.output:
+        with open(args.output, 'w') as f: json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2); print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,318 @@
+import os
+import sys
+import json
+import time
+import bisect
+import logging
+import threading
+import collections
+import http.server
+import urllib.parse
+import protocol
+
+log = logging.getLogger('ChatServer')
+
+# Upper bounds, in seconds, for latency histograms: 10 us to 10 s.
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+SNAPSHOT_INTERVAL = 10.0
+LOCK_SAMPLE_EVERY = 16  # TimedLock times one acquisition in this many
+PROFILE_INTERVAL = 0.005  # seconds between stack samples
+MAX_PROFILE_SECONDS = 300
+
+MSG_TYPE_NAMES = {value: name[len('MSG_TYPE_'):].lower() for name, value in vars(protocol).items() if name.startswith('MSG_TYPE_') and name != 'MSG_TYPE_MASK'}
+
+
+def format_labels(names, values):
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, values)) + '}' if names else ''
+
+
+class Counter:
+    """A monotonically increasing count, optionally split by the value of one label."""
+    kind = 'counter'
+
+    def __init__(self, name, help, label=None):
+        self.name, self.help, self.label = name, help, label
+        self.values = collections.defaultdict(int)
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, label_value=None):
+        with self.lock: self.values[label_value] += amount
+
+    def total(self):
+        with self.lock: return sum(self.values.values())
+
+    def samples(self):
+        with self.lock: values = dict(self.values)
+        if not values and self.label is None: values[None] = 0
+        return [(self.name, format_labels((self.label,), (value,)) if self.label else '', count) for value, count in sorted(values.items(), key=lambda item: str(item[0]))]
+
+    def snapshot(self):
+        with self.lock: return dict(self.values) if self.label else self.values.get(None, 0)
+
+
+class Gauge:
+    """A value read from a function whenever the metrics are collected."""
+    kind = 'gauge'
+
+    def __init__(self, name, help, read):
+        self.name, self.help, self.read = name, help, read
+
+    def samples(self): return [(self.name, '', self.read())]
+
+    def snapshot(self): return self.read()
+
+
+class Histogram:
+    """Counts of observed values in fixed buckets, plus their sum, as Prometheus expects."""
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.buckets = name, help, tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last bucket is +Inf
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock: self.counts[i] += 1; self.sum += value
+
+    def read(self):
+        with self.lock: return list(self.counts), self.sum
+
+    def samples(self):
+        counts, total = self.read()
+        samples, cumulative = [], 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count; samples.append((self.name + '_bucket', f'{{le="{bound}"}}', cumulative))
+        return samples + [(self.name + '_sum', '', total), (self.name + '_count', '', cumulative)]
+
+    def quantile(self, q, counts=None):
+        """The upper bound of the bucket holding the q-quantile (None without observations)."""
+        counts = counts or self.read()[0]
+        target, cumulative = q * sum(counts), 0
+        if not target: return None
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            if cumulative >= target: return bound
+
+    def snapshot(self):
+        counts, total = self.read(); count = sum(counts)
+        return {'count': count, 'sum': total, 'p50': self.quantile(0.5, counts), 'p99': self.quantile(0.99, counts)}
+
+
+class Registry:
+    """A set of metrics rendered together, in Prometheus text format or as a JSON-friendly snapshot."""
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric); return metric
+
+    def counter(self, name, help, label=None): return self.add(Counter(name, help, label))
+
+    def gauge(self, name, help, read): return self.add(Gauge(name, help, read))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS): return self.add(Histogram(name, help, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}'); lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(f'{name}{labels} {value}' for name, labels, value in metric.samples())
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+
+
+class TimedLock:
+    """A threading.Lock that records how long callers wait for it and how long they hold it.
+
+    Timing an acquisition costs several times as much as the acquisition itself, so only
+    one in `sample_every` is timed; the histograms are a sample of the lock's traffic.
+    """
+    def __init__(self, wait, hold, sample_every=LOCK_SAMPLE_EVERY):
+        self.lock = threading.Lock()
+        self.wait, self.hold, self.sample_every = wait, hold, sample_every
+        self.acquisitions = 0
+        self.acquired_at = None  # set while a timed acquisition holds the lock
+
+    def acquire(self, blocking=True, timeout=-1):
+        self.acquisitions += 1
+        if self.acquisitions % self.sample_every: return self.lock.acquire(blocking, timeout)
+        start = time.perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        if acquired: self.acquired_at = time.perf_counter(); self.wait.observe(self.acquired_at - start)
+        return acquired
+
+    def release(self):
+        acquired_at, self.acquired_at = self.acquired_at, None
+        if acquired_at is None: self.lock.release(); return
+        held = time.perf_counter() - acquired_at
+        self.lock.release()
+        self.hold.observe(held)
+
+    def locked(self): return self.lock.locked()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc_info): self.release()
+
+
+class ServerMetrics(Registry):
+    """Everything a ChatServer measures about itself; online_count() and slow_count() return the number of users logged in and of those marked slow."""
+    def __init__(self, online_count, slow_count=lambda: 0):
+        super().__init__()
+        self.connected_clients = self.gauge('chat_connected_clients', "Users logged in to this server process.", online_count)
+        self.slow_clients = self.gauge('chat_slow_clients', "Users whose probed RTT is above --slow-rtt; their outbound buffer is smaller.", slow_count)
+        self.udp_datagrams = self.counter('chat_udp_datagrams_total', "UDP datagrams received, by message type.", 'type')
+        self.fanout = self.histogram('chat_broadcast_fanout', "Recipients of each broadcast.", SIZE_BUCKETS)
+        self.room_fanout = self.histogram('chat_room_fanout', "Local recipients of each room message.", SIZE_BUCKETS)
+        self.send_seconds = self.histogram('chat_send_seconds', "Time spent in one socket write to a client (sendmsg, or writelines on the asyncio engine).")
+        self.lock_wait = self.histogram('chat_clients_lock_wait_seconds', "Time spent waiting for the client registry's writer lock (logins and logouts).")
+        self.lock_hold = self.histogram('chat_clients_lock_hold_seconds', "Time the client registry's writer lock was held.")
+        self.ack_latency = self.histogram('chat_ack_latency_seconds', "From receiving a UDP message to queueing its ACK; for ACK batches, the oldest message in the batch.")
+        self.dropped_frames = self.counter('chat_dropped_frames_total', "Frames dropped or refused by send_to_client, by slow-consumer policy.", 'policy')
+        self.duplicates = self.counter('chat_duplicate_messages_total', "Retransmitted UDP messages that were suppressed as duplicates.")
+        self.client_rtt = self.histogram('chat_client_rtt_seconds', "Round trip of the server's latency probes to clients, including the time spent in their outbound buffers.")
+
+    def count_datagram(self, msg_type):
+        self.udp_datagrams.inc(1, MSG_TYPE_NAMES.get(msg_type, f'0x{msg_type:02x}'))
+
+
+class RttMatrix:
+    """The RTTs users measure to the server and to each other, from their RTT_REPORTs.
+
+    Each row is one reporter's latest report: peer -> (srtt, jitter) in seconds. Reports
+    replace the whole row, so a peer that went offline drops out with the next report.
+    """
+    def __init__(self):
+        self.rows = {}
+        self.lock = threading.Lock()
+
+    def update(self, reporter, peers):
+        with self.lock: self.rows[reporter] = (time.monotonic(), peers)
+
+    def forget(self, reporter):
+        with self.lock: self.rows.pop(reporter, None)
+
+    def snapshot(self, user=None):
+        """Rows as JSON-friendly dicts in milliseconds; with user, only what user reported and what was reported about user."""
+        now = time.monotonic()
+        with self.lock: rows = dict(self.rows)
+        return {reporter: {'age': round(now - reported, 1), 'peers': {peer: {'rtt_ms': round(rtt * 1000, 2), 'jitter_ms': round(jitter * 1000, 2)} for peer, (rtt, jitter) in peers.items() if user in (None, reporter, peer)}}
+                for reporter, (reported, peers) in sorted(rows.items()) if user in (None, reporter) or user in peers}
+
+
+class SnapshotWriter:
+    """Writes the registry's snapshot to a JSON file every `interval` seconds.
+
+    Counters are also reported as per-second rates over the last interval. The file
+    is replaced atomically, so readers never see a partial snapshot.
+    """
+    def __init__(self, registry, path, interval=SNAPSHOT_INTERVAL):
+        self.registry, self.path, self.interval = registry, path, interval
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        previous, previous_time = self.registry.snapshot(), time.monotonic()
+        while True:
+            time.sleep(self.interval)
+            snapshot, now = self.registry.snapshot(), time.monotonic()
+            rates = {}
+            for metric in self.registry.metrics:
+                if metric.kind != 'counter': continue
+                current, before = snapshot[metric.name], previous.get(metric.name)
+                if isinstance(current, dict): rates[metric.name] = {key: (value - before.get(key, 0)) / (now - previous_time) for key, value in current.items()}
+                else: rates[metric.name] = (current - before) / (now - previous_time)
+            try:
+                with open(self.path + '.tmp', 'w') as f: json.dump({'time': time.time(), 'pid': os.getpid(), 'metrics': snapshot, 'rates_per_second': rates}, f, indent=1, default=str)
+                os.replace(self.path + '.tmp', self.path)
+            except OSError as e:
+                log.warning(f"Could not write metrics snapshot to {self.path}: {e}")
+            previous, previous_time = snapshot, now
+
+
+class SamplingProfiler:
+    """Samples the stack of every other thread at a fixed interval while it is running.
+
+    The result is in collapsed-stack format (one 'frame;frame;frame count' line per
+    distinct stack, outermost first), which flame graph tools read directly. Nothing
+    is sampled, and nothing costs, until start() is called.
+    """
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.running = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Starts sampling; returns False if the profiler is already running."""
+        with self.lock:
+            if self.running.is_set(): return False
+            self.stacks = collections.Counter(); self.running.set()
+            self.thread = threading.Thread(target=self.run, daemon=True); self.thread.start()
+            return True
+
+    def stop(self):
+        """Stops sampling and returns the collapsed stacks, most frequent first."""
+        with self.lock:
+            self.running.clear()
+            if self.thread: self.thread.join(); self.thread = None
+            return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def toggle(self, path):
+        """Starts the profiler, or stops it and writes the stacks to path (the SIGUSR2 handler)."""
+        if self.start(): log.info(f"Sampling profiler started; send the signal again to write {path}."); return
+        with open(path, 'w') as f: f.write(self.stop())
+        log.info(f"Sampling profiler stopped; stacks written to {path}.")
+
+    def run(self):
+        me = threading.get_ident()
+        while self.running.is_set():
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me: continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code; stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}'); frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """GET /metrics for Prometheus, /snapshot for JSON, /profile?seconds=N for a CPU profile, /rtt[?user=NAME] for the RTT matrix."""
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        registry, profiler = self.server.registry, self.server.profiler
+        if url.path == '/metrics': self.reply(registry.render(), 'text/plain; version=0.0.4')
+        elif url.path == '/snapshot': self.reply(json.dumps(registry.snapshot(), default=str), 'application/json')
+        elif url.path == '/profile':
+            try: seconds = min(float(urllib.parse.parse_qs(url.query).get('seconds', ['10'])[0]), MAX_PROFILE_SECONDS)
+            except ValueError: self.send_error(400, "seconds must be a number"); return
+            if not profiler.start(): self.send_error(409, "The profiler is already running"); return
+            time.sleep(seconds)
+            self.reply(profiler.stop(), 'text/plain')
+        elif url.path == '/rtt' and self.server.rtt: self.reply(json.dumps(self.server.rtt(urllib.parse.parse_qs(url.query).get('user', [None])[0])), 'application/json')
+        else: self.send_error(404)
+
+    def reply(self, body, content_type):
+        data = body.encode('utf-8')
+        self.send_response(200); self.send_header('Content-Type', content_type); self.send_header('Content-Length', str(len(data))); self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args): pass
+
+
+def serve_metrics(registry, profiler, port, host='127.0.0.1', rtt=None):
+    """Serves the metrics endpoint from a background thread; returns the HTTP server. rtt(user) returns the RTT matrix for /rtt."""
+    httpd = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    httpd.daemon_threads = True
+    httpd.registry, httpd.profiler, httpd.rtt = registry, profiler, rtt
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    log.info(f"Metrics available at http://{host}:{httpd.server_address[1]}/metrics")
+    return httpd
@@ -0,0 +1,231 @@
+import time
+import socket
+import selectors
+import threading
+import logging
+import itertools
+from collections import deque
+
+log = logging.getLogger('ChatServer')
+
+POLICY_DROP_OLDEST = 'drop_oldest'
+POLICY_COALESCE = 'coalesce'
+POLICY_DISCONNECT = 'disconnect'
+POLICIES = (POLICY_DROP_OLDEST, POLICY_COALESCE, POLICY_DISCONNECT)
+
+DEFAULT_HIGH_WATERMARK = 256 * 1024
+DEFAULT_LOW_WATERMARK = 64 * 1024
+
+# Windows has no per-call non-blocking flag; there a stalled peer can still block the
+# writer thread, but never the threads that route messages.
+SEND_FLAGS = getattr(socket, 'MSG_DONTWAIT', 0)
+
+# Frames gathered into one sendmsg() call; well below the usual IOV_MAX of 1024.
+MAX_BATCH_FRAMES = 64
+
+
+def send_buffers(sock, buffers):
+    """Writes a list of buffers with one scatter-gather syscall where the platform supports it."""
+    if hasattr(sock, 'sendmsg'): return sock.sendmsg(buffers, (), SEND_FLAGS)
+    return sock.send(buffers[0], SEND_FLAGS)
+
+
+class OutboundQueue:
+    """A bounded buffer of frames waiting to be written to one client.
+
+    Once the buffered bytes pass the high watermark the queue is congested and the
+    slow-consumer policy applies to every new frame until the writer drains it below
+    the low watermark:
+
+    - drop_oldest: discard the oldest unsent frames to make room.
+    - coalesce: a frame pushed with a key replaces queued frames with the same key
+      (e.g. an older user list); if that is not enough, fall back to drop_oldest.
+    - disconnect: refuse the frame; the caller should drop the connection.
+    """
+    def __init__(self, high_watermark=DEFAULT_HIGH_WATERMARK, low_watermark=DEFAULT_LOW_WATERMARK, policy=POLICY_DROP_OLDEST, on_ready=None, sock=None):
+        if policy not in POLICIES: raise ValueError(f"Unknown slow-consumer policy: {policy!r}")
+        if low_watermark > high_watermark: raise ValueError("low_watermark must not exceed high_watermark")
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.policy = policy
+        self.on_ready = on_ready
+        self.sock = sock
+        self.frames = deque()
+        self.size = 0
+        self.offset = 0
+        self.congested = False
+        self.closed = False
+        self.retired = False
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def set_watermarks(self, high_watermark, low_watermark):
+        """Resizes the buffer, e.g. to hold less for a client known to be slow; applies from the next push."""
+        if low_watermark > high_watermark: raise ValueError("low_watermark must not exceed high_watermark")
+        with self.lock:
+            self.high_watermark = high_watermark; self.low_watermark = low_watermark
+            if self.congested and self.size <= low_watermark: self.congested = False
+
+    def push(self, frame, key=None):
+        """Queues a frame; frames pushed to a closed queue are discarded.
+
+        Returns False only when this frame overflowed a queue under the disconnect
+        policy, in which case the caller should drop the connection.
+        """
+        with self.lock:
+            if self.closed: return True
+            if self.size + len(frame) > self.high_watermark: self.congested = True
+            if self.congested:
+                if self.policy == POLICY_DISCONNECT: self.closed = True; return False
+                if self.policy == POLICY_COALESCE and key is not None: self._coalesce(key)
+                self._drop_oldest(len(frame))
+            was_idle = not self.frames
+            self.frames.append((frame, key)); self.size += len(frame)
+        if was_idle and self.on_ready: self.on_ready(self)
+        return True
+
+    def _coalesce(self, key):
+        """Removes queued frames superseded by a newer frame with the same key."""
+        kept = deque()
+        for i, (frame, frame_key) in enumerate(self.frames):
+            if frame_key == key and not (i == 0 and self.offset):
+                self.size -= len(frame); self.dropped += 1
+            else:
+                kept.append((frame, frame_key))
+        self.frames = kept
+
+    def _drop_oldest(self, incoming):
+        """Discards the oldest frames until the incoming frame fits under the high watermark."""
+        start = 1 if self.offset else 0
+        while len(self.frames) > start and self.size + incoming > self.high_watermark:
+            frame, _ = self.frames[start]; del self.frames[start]
+            self.size -= len(frame); self.dropped += 1
+
+    def peek(self, max_frames=MAX_BATCH_FRAMES):
+        """Returns the unsent frames at the front of the queue as memoryviews, oldest first."""
+        with self.lock:
+            views = [memoryview(frame) for frame, _ in itertools.islice(self.frames, max_frames)]
+            if views and self.offset: views[0] = views[0][self.offset:]
+            return views
+
+    def take_all(self):
+        """Removes and returns every queued frame, for transports that buffer internally."""
+        with self.lock:
+            frames = [frame for frame, _ in self.frames]
+            if frames and self.offset: frames[0] = memoryview(frames[0])[self.offset:]
+            self.frames.clear(); self.size = 0; self.offset = 0; self.congested = False
+            return frames
+
+    def consume(self, nbytes):
+        """Marks nbytes at the front of the queue as written."""
+        with self.lock:
+            self.offset += nbytes
+            while self.frames and self.offset >= len(self.frames[0][0]):
+                frame, _ = self.frames.popleft()
+                self.offset -= len(frame); self.size -= len(frame)
+            if self.congested and self.size <= self.low_watermark: self.congested = False
+
+    def close(self):
+        """Discards everything queued and refuses further frames."""
+        with self.lock:
+            self.closed = True; self.frames.clear(); self.size = 0; self.offset = 0
+
+    def detach(self):
+        """Closes the queue and returns the (frame, key) pairs that had not started to go out, for another queue to send."""
+        with self.lock:
+            frames = list(self.frames)[1 if self.offset else 0:]
+            self.closed = True; self.frames.clear(); self.size = 0; self.offset = 0
+            return frames
+
+    def requeue(self, frames):
+        """Puts (frame, key) pairs back at the front of the queue, ahead of everything queued since."""
+        with self.lock:
+            if self.closed or not frames: return
+            was_idle = not self.frames
+            self.frames.extendleft(reversed(frames)); self.size += sum(len(frame) for frame, _ in frames)
+            if self.size > self.high_watermark: self.congested = True; self._drop_oldest(0)
+        if was_idle and self.on_ready: self.on_ready(self)
+
+    def attach(self, on_ready, sock=None):
+        """Hands a queue that has been buffering without a connection to a new one, which then sends everything queued."""
+        with self.lock:
+            self.on_ready = on_ready; self.sock = sock
+            pending = bool(self.frames)
+        if pending and on_ready: on_ready(self)
+
+
+class OutboundWriter:
+    """A single thread that drains every client's OutboundQueue without blocking on slow peers.
+
+    Queues announce new data through notify(); every frame pending for a client then goes
+    out in one sendmsg() call. Sockets that cannot take more bytes are parked in a
+    selector until they become writable again. If given, send_timer(seconds) is called
+    with the duration of every sendmsg() call.
+    """
+    def __init__(self, send_timer=None):
+        self.send_timer = send_timer
+        self.selector = selectors.DefaultSelector()
+        self.pending = deque()
+        self.lock = threading.Lock()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False); self.wakeup_send.setblocking(False)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def notify(self, queue):
+        """Schedules a queue to be flushed (or retired, if it has been closed)."""
+        with self.lock:
+            self.pending.append(queue)
+            wake = len(self.pending) == 1
+        if wake:
+            try: self.wakeup_send.send(b'\0')
+            except BlockingIOError: pass
+
+    def retire(self, queue):
+        """Closes a queue once its reader is done and lets the writer thread close its socket."""
+        queue.close(); queue.retired = True; self.notify(queue)
+
+    def run(self):
+        while True:
+            ready = []
+            for key, _ in self.selector.select():
+                if key.fileobj is self.wakeup_recv:
+                    try: self.wakeup_recv.recv(4096)
+                    except BlockingIOError: pass
+                else:
+                    self.selector.unregister(key.fileobj); ready.append(key.data)
+            with self.lock:
+                ready.extend(self.pending); self.pending.clear()
+            for queue in ready: self.flush(queue)
+
+    def flush(self, queue):
+        """Writes as much of a queue as its socket accepts right now."""
+        if queue.retired: self._release(queue); return
+        try:
+            while True:
+                buffers = queue.peek()
+                if not buffers: return
+                start = time.perf_counter(); sent = send_buffers(queue.sock, buffers)
+                if self.send_timer: self.send_timer(time.perf_counter() - start)
+                queue.consume(sent)
+        except BlockingIOError:
+            if not self._registered(queue): self.selector.register(queue.sock, selectors.EVENT_WRITE, queue)
+        except OSError as e:
+            log.warning(f"Dropping outbound data for a disconnected client: {e}")
+            queue.close()
+            try: queue.sock.shutdown(socket.SHUT_RDWR)
+            except OSError: pass
+
+    def _registered(self, queue):
+        try: self.selector.get_key(queue.sock); return True
+        except (KeyError, ValueError): return False
+
+    def _release(self, queue):
+        """Unregisters and closes a retired queue's socket."""
+        if queue.sock is None: return
+        if self._registered(queue): self.selector.unregister(queue.sock)
+        try: queue.sock.close()
+        except OSError: pass
+        queue.sock = None
@@ -1,5 +1,10 @@
 import struct
 import json
+import socket
+import threading
+import time
+import zlib
+from collections import namedtuple
 
 
 SERVER_HOST = '127.0.0.1'  
@@ -16,43 +21,469 @@ MSG_TYPE_PRIVATE_TEXT_UDP = 0x06
 MSG_TYPE_LOGOUT_TCP = 0x09
 MSG_TYPE_PING_REQUEST_TCP = 0x0A
 MSG_TYPE_PING_RESPONSE_TCP = 0x0B
+MSG_TYPE_ACK_BATCH_TCP = 0x0C
+MSG_TYPE_ROSTER_DELTA_TCP = 0x0D
+MSG_TYPE_ROSTER_SYNC_TCP = 0x0E
+MSG_TYPE_HISTORY_REQUEST_TCP = 0x0F
+MSG_TYPE_HISTORY_RESPONSE_TCP = 0x10
+MSG_TYPE_ROOM_JOIN_TCP = 0x11
+MSG_TYPE_ROOM_LEAVE_TCP = 0x12
+MSG_TYPE_ROOM_TEXT_UDP = 0x13      # carries the room name as its 'recipient', so it routes like a private message
+MSG_TYPE_ROOM_LIST_TCP = 0x14
+MSG_TYPE_BATCH = 0x15              # payload is several complete frames back to back; over UDP or TCP
+MSG_TYPE_FRAGMENT_UDP = 0x16       # one piece of a packet too large for a datagram; see fragment()
+MSG_TYPE_RTT_REPORT_TCP = 0x17     # a client's rolling RTT and jitter to the server and its peers
+MSG_TYPE_RESUME_TCP = 0x18         # instead of LOGIN on a new connection: take over a session by its token
+
+# Optional behaviours a client can announce in its login 'features' list.
+FEATURE_ACK_BATCH = 'ack_batch'
+FEATURE_ROSTER_DELTA = 'roster_delta'
+FEATURE_COMPRESSION = 'deflate'
+FEATURE_RESUME = 'resume'
+# Features the server echoes back, in the login user list, when a client announces them.
+ACKNOWLEDGED_FEATURES = (FEATURE_COMPRESSION, FEATURE_RESUME)
+
+# Messages of stored history returned by default for one HISTORY_REQUEST.
+HISTORY_PAGE_SIZE = 50
+
+MAX_ROOM_NAME = 32  # bytes of UTF-8
+
+# Latency probes: PING_REQUEST carries the sender's time.monotonic_ns() as 'sent', and the
+# PING_RESPONSE echoes it back. A 'recipient' of SERVER_NAME is answered by the server itself.
+SERVER_NAME = "SERVER"
+PROBE_INTERVAL = 5.0        # seconds between probe rounds, on the client and on the server
+PROBE_PEERS = 3             # peers a client probes per round, in turn
+RTT_REPORT_INTERVAL = 15.0  # seconds between a client's RTT_REPORTs
+
+# Sessions: a client with the resume feature gets a 'session' token in its login user list. If
+# its connection drops, the server keeps it logged in for SESSION_GRACE seconds, buffering what
+# is sent to it, and a RESUME with the token on a new connection picks up where it left off.
+SESSION_GRACE = 30.0
+RESUME_TIMEOUT = 5.0         # seconds a client waits for the answer to its RESUME
+RECONNECT_BASE_DELAY = 0.5   # reconnect backoff: attempt n waits uniformly up to base * 2 ** n,
+RECONNECT_MAX_DELAY = 30.0   # capped here, so that clients dropped together do not return together
 
 HEADER_FORMAT = '! B 16s I I'
 HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
 
-def pack_data(msg_type, sender_id, seq_num, payload_data):
+READ_BUFFER_SIZE = 65536    # most bytes taken from a stream per read
+FRAME_BUFFER_SIZE = 4096    # a FrameReader's buffer until a frame or a burst needs more
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# The two high bits of the MSG_TYPE byte say how the payload is encoded; the rest is the type.
+MSG_TYPE_MASK = 0x3F
+FLAG_BINARY_PAYLOAD = 0x80
+FLAG_COMPRESSED = 0x40
+
+# Payloads of at least COMPRESS_THRESHOLD bytes are sent as raw deflate streams primed with
+# COMPRESSION_DICTIONARY, when both sides announced FEATURE_COMPRESSION and it saves bytes.
+# The dictionary holds strings common in chat payloads, most frequent last, so that even a
+# few hundred bytes of text compress; changing it breaks compatibility with older peers.
+COMPRESS_THRESHOLD = 200
+COMPRESS_LEVEL = 3  # 3% larger output than level 6 on chat text, for a quarter less time
+# An 8 KB window and a small hash table: setting up a full-size compressor costs 5x more than
+# compressing a chat message with it. Any window size inflates with the default one.
+COMPRESS_WBITS = 13
+COMPRESS_MEMLEVEL = 5
+COMPRESSION_DICTIONARY = (
+    b'def return self None True False import from class for in if else elif while try except with as print('
+    b' ERROR WARNING INFO DEBUG Traceback (most recent call last): File line error failed exception '
+    b'http://https://www. .com .org github stackoverflow '
+    b'could would should about there their where which because think thanks thank please sorry '
+    b'really actually maybe today tomorrow yesterday meeting message everyone someone something anyone '
+    b'hello hi hey okay ok yes no lol :) :D haha good great nice cool sure right know just like what when '
+    b'this that have with will your from they them then than been were was are you the and for but not '
+    b'"users": ["version": "features": ["rooms": ["joined": ["room": "peer": "before": "limit": '
+    b'"messages": [{"sender": "time": "text": "recipient": "text": "'
+)
+
+# FRAGMENT payload: index and count of the piece, then the piece's bytes. The pieces of one
+# packet share its sequence number; reassembled, they are the original packet.
+FRAGMENT_FORMAT = '! H H'
+FRAGMENT_HEADER_SIZE = struct.calcsize(FRAGMENT_FORMAT)
+MAX_FRAGMENTS = 64
+REASSEMBLY_TIMEOUT = 10.0
+MAX_REASSEMBLIES = 8  # packets being reassembled at once per sender
+# A packet of MAX_FRAGMENTS datagrams overflows a default-sized UDP receive buffer if it arrives
+# in one burst, and a retransmission would lose the same tail again. So the server asks for a
+# large buffer, and senders pause after every FRAGMENT_BURST datagrams; the receiver keeps the
+# fragments it has, so each retransmission only has to fill the gaps.
+UDP_RECEIVE_BUFFER = 4 * 1024 * 1024
+FRAGMENT_BURST = 8
+FRAGMENT_BURST_GAP = 0.001
+
+CODEC_JSON = 'json'
+CODEC_BINARY = 'binary'
+SUPPORTED_CODECS = (CODEC_BINARY, CODEC_JSON)
+
+# Binary payloads are a sequence of (field id, value) pairs in ascending id order, so a
+# 'recipient' field is always at offset 0 and can be routed on without decoding the rest.
+#   str:      1 byte id, 4 byte length, UTF-8 bytes
+#   strlist:  same as str, with the items joined by NUL characters
+#   uint:     1 byte id, 4 byte value
+#   uintlist: 1 byte id, 4 byte count, then count 4 byte values
+#   u64:      1 byte id, 8 byte value
+FIELD_STR_FORMAT = '! B I'
+FIELD_STR_SIZE = struct.calcsize(FIELD_STR_FORMAT)
+FIELD_U64_FORMAT = '! B Q'
+FIELD_U64_SIZE = struct.calcsize(FIELD_U64_FORMAT)
+
+BINARY_FIELDS = {
+    'recipient': (0x01, 'str'),
+    'text': (0x02, 'str'),
+    'users': (0x03, 'strlist'),
+    'codecs': (0x04, 'strlist'),
+    'features': (0x05, 'strlist'),
+    'cumulative': (0x06, 'uint'),
+    'ranges': (0x07, 'uintlist'),
+    'version': (0x08, 'uint'),
+    'joined': (0x09, 'strlist'),
+    'left': (0x0A, 'strlist'),
+    'peer': (0x0B, 'str'),
+    'before': (0x0C, 'uint'),
+    'limit': (0x0D, 'uint'),
+    'room': (0x0E, 'str'),
+    'rooms': (0x0F, 'strlist'),
+    'sent': (0x10, 'u64'),
+    'rtts': (0x11, 'uintlist'),
+    'jitters': (0x12, 'uintlist'),
+    'session': (0x13, 'str'),
+}
+UINT_MAX = 0xFFFFFFFF
+U64_MAX = 0xFFFFFFFFFFFFFFFF
+BINARY_FIELDS_BY_ID = {field_id: (name, kind) for name, (field_id, kind) in BINARY_FIELDS.items()}
+FIELD_RECIPIENT = BINARY_FIELDS['recipient'][0]
+
+def pack_data(msg_type, sender_id, seq_num, payload_data, codec=CODEC_JSON, compress=False):
     """
     Packs the given data into a binary packet according to the protocol.
-    The payload is converted to a JSON string.
+    The payload is converted to a JSON string, or to the compact binary layout when
+    codec is CODEC_BINARY and every field has a binary encoding. With compress, a large
+    payload is deflated (see COMPRESS_THRESHOLD).
     """
 
-    sender_id_bytes = sender_id.encode('utf-8')
-    padded_sender_id = sender_id_bytes.ljust(16, b'\0')
 
-    payload_json = json.dumps(payload_data)
-    payload_bytes = payload_json.encode('utf-8')
+    payload_bytes = encode_binary_payload(payload_data) if codec == CODEC_BINARY else None
+    if payload_bytes is None:
+        payload_json = json.dumps(payload_data)
+        payload_bytes = payload_json.encode('utf-8')
+    else:
+        msg_type |= FLAG_BINARY_PAYLOAD
+    return pack_raw(msg_type, sender_id, seq_num, payload_bytes, compress)
 
+def pack_raw(msg_type, sender_id, seq_num, payload_bytes, compress=False):
+    """
+    Packs an already encoded payload; msg_type may carry FLAG_BINARY_PAYLOAD. With compress,
+    payloads of at least COMPRESS_THRESHOLD bytes are deflated if that makes them smaller.
+    """
+    if compress and len(payload_bytes) >= COMPRESS_THRESHOLD:
+        compressed = compress_payload(payload_bytes)
+        if len(compressed) < len(payload_bytes): payload_bytes = compressed; msg_type |= FLAG_COMPRESSED
+    padded_sender_id = sender_id.encode('utf-8').ljust(16, b'\0')
     header = struct.pack(HEADER_FORMAT, msg_type, padded_sender_id, seq_num, len(payload_bytes))
 
     return header + payload_bytes
 
+def compress_packet(packet):
+    """Returns a packed frame with its payload deflated, if it is large enough and that makes it smaller."""
+    if packet[0] & FLAG_COMPRESSED: return packet
+    _, sender_id, seq_num, _ = unpack_header(packet[:HEADER_SIZE])
+    return pack_raw(packet[0], sender_id, seq_num, packet[HEADER_SIZE:], True)
+
+def compress_payload(payload_bytes):
+    """Deflates a payload with the shared chat dictionary."""
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -COMPRESS_WBITS, COMPRESS_MEMLEVEL, zdict=COMPRESSION_DICTIONARY)
+    return compressor.compress(payload_bytes) + compressor.flush()
+
+def decompress_payload(payload_bytes):
+    """Inflates a compressed payload; raises ValueError if it is corrupt or would exceed MAX_FRAME_SIZE."""
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=COMPRESSION_DICTIONARY)
+    try: payload = decompressor.decompress(payload_bytes, MAX_FRAME_SIZE)
+    except zlib.error as e: raise ValueError(f"Corrupt compressed payload: {e}")
+    if decompressor.unconsumed_tail: raise ValueError(f"Compressed payload inflates to more than {MAX_FRAME_SIZE} bytes")
+    return payload
+
+def encode_binary_payload(payload_data):
+    """
+    Encodes a payload dictionary in the binary layout.
+    Returns None if some field cannot be encoded, so the caller can fall back to JSON.
+    """
+    if any(name not in BINARY_FIELDS for name in payload_data): return None
+    parts = []
+    for name in sorted(payload_data, key=lambda key: BINARY_FIELDS[key][0]):
+        field_id, kind = BINARY_FIELDS[name]; value = payload_data[name]
+        if kind == 'uint':
+            if not _is_uint(value): return None
+            parts.append(struct.pack(FIELD_STR_FORMAT, field_id, value)); continue
+        if kind == 'u64':
+            if not _is_uint(value, U64_MAX): return None
+            parts.append(struct.pack(FIELD_U64_FORMAT, field_id, value)); continue
+        if kind == 'uintlist':
+            if not isinstance(value, (list, tuple)) or not all(_is_uint(item) for item in value): return None
+            parts.append(struct.pack(FIELD_STR_FORMAT, field_id, len(value))); parts.append(struct.pack(f'!{len(value)}I', *value)); continue
+        if kind == 'strlist':
+            if not isinstance(value, (list, tuple)) or not all(isinstance(item, str) and item and '\0' not in item for item in value): return None
+            value = '\0'.join(value)
+        if not isinstance(value, str): return None
+        encoded = value.encode('utf-8'); parts.append(struct.pack(FIELD_STR_FORMAT, field_id, len(encoded))); parts.append(encoded)
+    return b''.join(parts)
+
+def _is_uint(value, maximum=UINT_MAX):
+    return isinstance(value, int) and not isinstance(value, bool) and 0 <= value <= maximum
+
+def decode_binary_payload(payload_bytes):
+    """Decodes a binary-layout payload into a dictionary."""
+    payload = {}; offset = 0; end = len(payload_bytes)
+    while offset < end:
+        name, kind = BINARY_FIELDS_BY_ID[payload_bytes[offset]]
+        if kind == 'u64': payload[name] = struct.unpack_from(FIELD_U64_FORMAT, payload_bytes, offset)[1]; offset += FIELD_U64_SIZE; continue
+        field_id, length = struct.unpack_from(FIELD_STR_FORMAT, payload_bytes, offset); offset += FIELD_STR_SIZE
+        if kind == 'uint': payload[name] = length; continue
+        if kind == 'uintlist':
+            payload[name] = list(struct.unpack_from(f'!{length}I', payload_bytes, offset)); offset += 4 * length; continue
+        value = str(payload_bytes[offset:offset + length], 'utf-8'); offset += length
+        if kind == 'strlist': value = value.split('\0') if value else []
+        payload[name] = value
+    if offset > end: raise ValueError("Truncated binary payload")
+    return payload
+
 def unpack_header(header_bytes):
     """
     Unpacks the binary header and returns its components as a tuple.
+    The payload encoding flag is masked out of msg_type; see header_flags().
     """
     msg_type, padded_sender_id, seq_num, payload_len = struct.unpack(HEADER_FORMAT, header_bytes)
     
     
     sender_id = padded_sender_id.decode('utf-8').strip('\x00')
     
-    return msg_type, sender_id, seq_num, payload_len
+    return msg_type & MSG_TYPE_MASK, sender_id, seq_num, payload_len
 
-def unpack_payload(payload_bytes):
+def header_flags(header_bytes):
     """
-    Unpacks the payload from a JSON byte string into a Python dictionary.
+    Returns the flag bits of a packet's MSG_TYPE byte.
+    """
+    return header_bytes[0] & ~MSG_TYPE_MASK
+
+def unpack_payload(payload_bytes, flags=0):
+    """
+    Unpacks the payload from a JSON (or, if flagged, binary) byte string into a Python dictionary.
     """
     try:
-        return json.loads(payload_bytes.decode('utf-8'))
-    except (json.JSONDecodeError, UnicodeDecodeError):
+        if flags & FLAG_COMPRESSED: payload_bytes = decompress_payload(payload_bytes)
+        if flags & FLAG_BINARY_PAYLOAD: return decode_binary_payload(payload_bytes)
+        return json.loads(bytes(payload_bytes).decode('utf-8'))
+    except (json.JSONDecodeError, UnicodeDecodeError, KeyError, ValueError, struct.error):
         
-        return None
\ No newline at end of file
+        return None
+
+def peek_recipient(payload_bytes, flags=0):
+    """
+    Returns the 'recipient' of a payload. Binary payloads are read at a fixed offset
+    without decoding anything else; JSON and compressed payloads have to be parsed.
+    """
+    if flags & FLAG_BINARY_PAYLOAD and not flags & FLAG_COMPRESSED:
+        if len(payload_bytes) < FIELD_STR_SIZE or payload_bytes[0] != FIELD_RECIPIENT: return None
+        _, length = struct.unpack_from(FIELD_STR_FORMAT, payload_bytes, 0)
+        try: return str(payload_bytes[FIELD_STR_SIZE:FIELD_STR_SIZE + length], 'utf-8')
+        except UnicodeDecodeError: return None
+    payload = unpack_payload(payload_bytes, flags)
+    return payload.get('recipient') if isinstance(payload, dict) else None
+
+def valid_room_name(room):
+    """
+    Checks that a room name is a non-empty string of at most MAX_ROOM_NAME bytes, without NULs or surrounding spaces.
+    """
+    return isinstance(room, str) and 0 < len(room.encode('utf-8')) <= MAX_ROOM_NAME and '\0' not in room and room == room.strip()
+
+def frame_codec(packet):
+    """
+    Returns the codec a packed frame's payload is encoded with.
+    """
+    return CODEC_BINARY if packet[0] & FLAG_BINARY_PAYLOAD else CODEC_JSON
+
+def transcode(packet, codec, compress=False):
+    """
+    Re-encodes a packed frame's payload for a peer that takes codec and, if compress, compressed
+    payloads, keeping the header fields. A frame the peer can already read is returned as is;
+    raises ValueError if the payload has to be decoded and cannot be.
+    """
+    compressed = packet[0] & FLAG_COMPRESSED
+    if frame_codec(packet) == codec and (compress or not compressed): return packet
+    msg_type, sender_id, seq_num, _ = unpack_header(packet[:HEADER_SIZE])
+    if frame_codec(packet) == codec: return pack_raw(packet[0] & ~FLAG_COMPRESSED, sender_id, seq_num, decompress_payload(packet[HEADER_SIZE:]))
+    payload = unpack_payload(packet[HEADER_SIZE:], header_flags(packet[:HEADER_SIZE]))
+    if payload is None: raise ValueError(f"Undecodable {frame_codec(packet)} payload")
+    return pack_data(msg_type, sender_id, seq_num, payload, codec, compress)
+
+def pack_batch(sender_id, packets, max_size=BUFFER_SIZE, compress=False):
+    """
+    Groups packets into as few datagrams of at most max_size bytes as it can. Several packets
+    that fit together become one BATCH frame; a packet alone is sent by itself, in fragments
+    if it is too large. With compress, each BATCH or lone packet is deflated as a whole.
+    """
+    datagrams = []; group = []; group_size = HEADER_SIZE
+    def flush():
+        if len(group) == 1: datagrams.extend(fragment(compress_packet(group[0]) if compress else group[0], max_size))
+        elif group:
+            batch = pack_raw(MSG_TYPE_BATCH, sender_id, 0, b''.join(group), compress)
+            datagrams.extend(fragment(batch, max_size) if len(batch) > max_size else [batch])
+    for packet in packets:
+        if group and group_size + len(packet) > max_size: flush(); group = []; group_size = HEADER_SIZE
+        group.append(packet); group_size += len(packet)
+    flush()
+    return datagrams
+
+def split_batch(payload_bytes, flags=0):
+    """
+    Returns the Frames packed in a BATCH payload, ignoring a truncated last one. Each
+    Frame's packet is a copy, so it stays valid after the batch is gone.
+    """
+    if flags & FLAG_COMPRESSED: payload_bytes = decompress_payload(payload_bytes)
+    frames = []; offset = 0; end = len(payload_bytes)
+    while end - offset >= HEADER_SIZE:
+        header = payload_bytes[offset:offset + HEADER_SIZE]
+        msg_type, sender_id, seq_num, payload_len = unpack_header(header)
+        if offset + HEADER_SIZE + payload_len > end: break
+        packet = bytes(payload_bytes[offset:offset + HEADER_SIZE + payload_len]); offset += HEADER_SIZE + payload_len
+        frames.append(Frame(msg_type, sender_id, seq_num, header_flags(header), memoryview(packet)[HEADER_SIZE:], packet))
+    return frames
+
+def fragment(packet, max_size=BUFFER_SIZE):
+    """
+    Splits a packet longer than max_size into FRAGMENT datagrams of at most max_size bytes,
+    carrying its sender and sequence number. Shorter packets are returned as they are.
+    """
+    if len(packet) <= max_size: return [packet]
+    _, sender_id, seq_num, _ = unpack_header(packet[:HEADER_SIZE])
+    chunk = max_size - HEADER_SIZE - FRAGMENT_HEADER_SIZE
+    count = -(-len(packet) // chunk)
+    if count > MAX_FRAGMENTS: raise ValueError(f"Packet of {len(packet)} bytes needs more than {MAX_FRAGMENTS} fragments")
+    return [pack_raw(MSG_TYPE_FRAGMENT_UDP, sender_id, seq_num, struct.pack(FRAGMENT_FORMAT, index, count) + packet[index * chunk:(index + 1) * chunk]) for index in range(count)]
+
+def send_datagrams(sock, datagrams, address):
+    """
+    Sends datagrams to address, pausing FRAGMENT_BURST_GAP seconds after every FRAGMENT_BURST of them.
+    """
+    for index, datagram in enumerate(datagrams):
+        if index and not index % FRAGMENT_BURST: time.sleep(FRAGMENT_BURST_GAP)
+        sock.sendto(datagram, address)
+
+def udp_receive_socket():
+    """
+    A UDP socket asking for a UDP_RECEIVE_BUFFER receive buffer; the kernel may grant less
+    (on Linux, up to net.core.rmem_max), which the caller can read back with getsockopt().
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try: sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RECEIVE_BUFFER)
+    except OSError: pass
+    return sock
+
+class Reassembler:
+    """
+    Rebuilds one sender's fragmented packets. At most MAX_REASSEMBLIES packets are pending at
+    once, and a packet whose fragments stop arriving for REASSEMBLY_TIMEOUT is dropped.
+    """
+    def __init__(self):
+        self.pending = {}  # seq_num -> [last fragment time, count, {index: bytes}]
+        self.lock = threading.Lock()
+
+    def add(self, seq_num, payload_bytes, now):
+        """
+        Stores the fragment in a FRAGMENT payload; returns the whole packet once its last fragment arrives, else None.
+        """
+        if len(payload_bytes) < FRAGMENT_HEADER_SIZE: return None
+        index, count = struct.unpack_from(FRAGMENT_FORMAT, payload_bytes)
+        if not 1 < count <= MAX_FRAGMENTS or index >= count: return None
+        with self.lock:
+            for stale in [seq for seq, (seen, _, _) in self.pending.items() if now - seen > REASSEMBLY_TIMEOUT]: del self.pending[stale]
+            entry = self.pending.get(seq_num)
+            if entry is None or entry[1] != count:
+                if len(self.pending) >= MAX_REASSEMBLIES: del self.pending[min(self.pending, key=lambda seq: self.pending[seq][0])]
+                entry = self.pending[seq_num] = [now, count, {}]
+            entry[0] = now; entry[2][index] = bytes(payload_bytes[FRAGMENT_HEADER_SIZE:])
+            if len(entry[2]) < count: return None
+            del self.pending[seq_num]
+        return b''.join(entry[2][i] for i in range(count))
+
+def negotiate_codec(offered):
+    """
+    Picks the first codec from a client's login offer that this side supports.
+    """
+    for codec in offered or ():
+        if codec in SUPPORTED_CODECS: return codec
+    return CODEC_JSON
+
+Frame = namedtuple('Frame', ['msg_type', 'sender_id', 'seq_num', 'flags', 'payload', 'packet'])
+
+class FrameReader:
+    """
+    Splits a TCP byte stream into protocol frames, however the bytes arrive.
+
+    Data is read with recv_into() into one bytearray, and every complete frame in the
+    buffer is returned per call. The payload and packet of each Frame are memoryviews
+    into that buffer: they stay valid only until the next read, so copy anything that
+    has to outlive it. The buffer starts at buffer_size and grows only for a frame that
+    does not fit; once such a frame has been returned and nothing is left, a new buffer
+    of buffer_size replaces it, so an idle connection costs a few KB whatever it received.
+    """
+    def __init__(self, sock=None, buffer_size=FRAME_BUFFER_SIZE):
+        self.sock = sock
+        self.buffer_size = buffer_size
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.missing = 1
+
+    def read_frames(self):
+        """
+        Blocks for one recv_into() on the socket and returns the complete frames now buffered.
+        Returns None once the peer has closed the connection.
+        """
+        self._make_room(self.missing)
+        received = self.sock.recv_into(self.view[self.end:])
+        if not received: return None
+        self.end += received
+        return self._parse()
+
+    def feed(self, data):
+        """
+        Appends bytes obtained elsewhere (e.g. from an asyncio stream) and returns the complete frames now buffered.
+        """
+        self._make_room(len(data))
+        self.view[self.end:self.end + len(data)] = data; self.end += len(data)
+        return self._parse()
+
+    def _make_room(self, needed):
+        """Ensures at least `needed` free bytes after the buffered data, compacting or growing the buffer."""
+        if self.start == self.end: self.start = self.end = 0
+        free = len(self.buffer) - self.end
+        if free >= needed and (free >= len(self.buffer) // 4 or not self.start): return
+        pending = self.end - self.start
+        if len(self.buffer) - pending >= needed:
+            self.view[:pending] = self.view[self.start:self.end]
+        else:
+            buffer = bytearray(max(len(self.buffer) * 2, pending + needed))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = buffer; self.view = memoryview(buffer)
+        self.start = 0; self.end = pending
+
+    def _parse(self):
+        frames = []
+        while self.end - self.start >= HEADER_SIZE:
+            header = self.view[self.start:self.start + HEADER_SIZE]
+            msg_type, sender_id, seq_num, payload_len = unpack_header(header)
+            if payload_len > MAX_FRAME_SIZE: raise ValueError(f"Frame payload of {payload_len} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+            frame_end = self.start + HEADER_SIZE + payload_len
+            if frame_end > self.end:
+                self.missing = frame_end - self.end
+                break
+            frames.append(Frame(msg_type, sender_id, seq_num, header_flags(header), self.view[self.start + HEADER_SIZE:frame_end], self.view[self.start:frame_end]))
+            self.start = frame_end
+        else:
+            self.missing = max(1, HEADER_SIZE - (self.end - self.start))
+        if self.start == self.end and len(self.buffer) > self.buffer_size:
+            # The returned frames keep the large buffer alive only as long as they are used.
+            self.buffer = bytearray(self.buffer_size); self.view = memoryview(self.buffer); self.start = self.end = 0
+        return frames
@@ -0,0 +1,105 @@
+import threading
+
+
+class ClientRegistry:
+    """The logged-in clients by username, readable without taking a lock.
+
+    Readers use the current snapshot: a dict that is never modified once it has been
+    published, so a lookup or an iteration is a plain dict operation, however many
+    threads route messages at the same time. Logins and logouts copy the snapshot,
+    change the copy and publish it under the writer lock. That costs O(users) per
+    change, which is cheap next to taking a lock on every datagram.
+
+    Per-client state (addresses, queues) lives in each client's info dict, not in the
+    registry, so updating it never publishes a new version.
+    """
+    def __init__(self, lock=None):
+        self.snapshot = {}
+        self.version = 0
+        self.lock = lock or threading.Lock()
+
+    def get(self, username): return self.snapshot.get(username)
+
+    def __contains__(self, username): return username in self.snapshot
+
+    def __len__(self): return len(self.snapshot)
+
+    def names(self): return list(self.snapshot)
+
+    def values(self): return self.snapshot.values()
+
+    def items(self): return self.snapshot.items()
+
+    def add(self, username, client_info):
+        """Registers a client; returns False, changing nothing, if the name is taken."""
+        with self.lock:
+            if username in self.snapshot: return False
+            clients = dict(self.snapshot); clients[username] = client_info
+            self.snapshot = clients; self.version += 1
+            return True
+
+    def remove(self, username, client_info):
+        """Unregisters a client if it is still the one registered under its name."""
+        with self.lock:
+            if self.snapshot.get(username) is not client_info: return False
+            clients = dict(self.snapshot); del clients[username]
+            self.snapshot = clients; self.version += 1
+            return True
+
+    def replace(self, username, client_info, new_info):
+        """Registers new_info in place of client_info, e.g. when a session moves to a new connection."""
+        with self.lock:
+            if self.snapshot.get(username) is not client_info: return False
+            clients = dict(self.snapshot); clients[username] = new_info
+            self.snapshot = clients; self.version += 1
+            return True
+
+
+class RoomIndex:
+    """Room name -> members, readable without taking a lock, in the same way as ClientRegistry.
+
+    Each room's members are an immutable dict of username -> client info, so sending to
+    a room touches its members and nobody else. Joins and leaves copy the room's
+    members and the room table, and publish the copies; a room exists while it has
+    members.
+    """
+    def __init__(self, lock=None):
+        self.snapshot = {}
+        self.lock = lock or threading.Lock()
+
+    def members(self, room): return self.snapshot.get(room, {})
+
+    def names(self): return list(self.snapshot)
+
+    def __contains__(self, room): return room in self.snapshot
+
+    def __len__(self): return len(self.snapshot)
+
+    def join(self, room, username, client_info):
+        """Adds a member; returns (joined, created): False if they already were one, and whether the room is new."""
+        with self.lock:
+            members = self.snapshot.get(room, {})
+            if username in members: return False, False
+            rooms = dict(self.snapshot); rooms[room] = {**members, username: client_info}
+            self.snapshot = rooms
+            return True, not members
+
+    def leave(self, room, username):
+        """Removes a member; returns (left, removed): False if they were not one, and whether the room is now gone."""
+        with self.lock:
+            members = self.snapshot.get(room, {})
+            if username not in members: return False, False
+            rooms = dict(self.snapshot)
+            if len(members) == 1: del rooms[room]
+            else: rooms[room] = {user: client_info for user, client_info in members.items() if user != username}
+            self.snapshot = rooms
+            return True, len(members) == 1
+
+    def replace(self, room, username, client_info):
+        """Points an existing member at new client info; returns False if they are not a member."""
+        with self.lock:
+            members = self.snapshot.get(room, {})
+            if username not in members: return False
+            rooms = dict(self.snapshot); rooms[room] = {**members, username: client_info}
+            self.snapshot = rooms
+            return True
@@ -0,0 +1,218 @@
+import heapq
+import itertools
+import threading
+import time
+
+import protocol
+
+DEDUP_WINDOW_SIZE = 1024
+
+
+class DedupWindow:
+    """Remembers which sequence numbers of one sender have already been seen.
+
+    Everything up to `cumulative` has been seen; a bitmap covers the `size` numbers
+    after it, bit i being set when (cumulative + 1 + i) has been seen, and slides on
+    as the gaps at its start fill in. Memory stays constant however long the session
+    runs, and nothing is ever reported as seen that was not. UDP senders are not
+    authenticated, so a number beyond the window is refused rather than allowed to
+    move it: a spoofed datagram can mark one number, never silence the real sender.
+    A sender cannot get more than `size` messages ahead of its oldest unacknowledged one.
+    """
+    def __init__(self, size=DEDUP_WINDOW_SIZE):
+        self.size = size
+        self.highest = 0
+        self.bitmap = 0
+        self.cumulative = 0
+        self.duplicates = 0
+
+    def check_and_mark(self, seq_num):
+        """Records seq_num and returns True if it had not been seen before; raises ValueError if it is beyond the window."""
+        offset = seq_num - self.cumulative - 1
+        if offset >= self.size: raise ValueError(f"sequence number {seq_num} is beyond the window, which ends at {self.cumulative + self.size}")
+        if offset < 0 or self.bitmap >> offset & 1:
+            self.duplicates += 1
+            return False
+        self.bitmap |= 1 << offset; self.highest = max(self.highest, seq_num)
+        # Slides the window past the run of seen numbers at its start.
+        seen = (~self.bitmap & (self.bitmap + 1)).bit_length() - 1
+        self.bitmap >>= seen; self.cumulative += seen
+        return True
+
+
+ACK_DELAY = 0.02
+ACK_BATCH_LIMIT = 64
+
+
+class AckBatcher:
+    """Collects the sequence numbers to acknowledge for one client so they can go out in one frame."""
+    def __init__(self):
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def add(self, seq_num):
+        """Queues seq_num and returns how many acknowledgements are now pending."""
+        with self.lock:
+            self.pending.append(seq_num)
+            return len(self.pending)
+
+    def take(self, cumulative):
+        """Returns an ACK_BATCH payload for everything pending, or None if nothing is.
+
+        Everything up to `cumulative` is covered by that single number; the rest is sent
+        as flattened inclusive [start, end, start, end, ...] ranges.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if not pending: return None
+        ranges = []
+        for seq_num in sorted(set(pending)):
+            if seq_num <= cumulative: continue
+            if ranges and ranges[-1] == seq_num - 1: ranges[-1] = seq_num
+            else: ranges.extend((seq_num, seq_num))
+        return {'cumulative': cumulative, 'ranges': ranges}
+
+
+def acked_by(payload):
+    """Returns a predicate telling whether an ACK_BATCH payload acknowledges a sequence number."""
+    cumulative = payload.get('cumulative', 0); ranges = payload.get('ranges', [])
+    pairs = list(zip(ranges[0::2], ranges[1::2]))
+    return lambda seq_num: seq_num <= cumulative or any(start <= seq_num <= end for start, end in pairs)
+
+
+MIN_RTO = 0.2
+MAX_RTO = 60.0
+CLOCK_GRANULARITY = 0.01
+
+
+class RttEstimator:
+    """Retransmission timeout from smoothed RTT samples, as in RFC 6298."""
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+
+    def __init__(self, initial_rto=protocol.RETRANSMIT_TIMEOUT):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+
+    def observe(self, rtt):
+        """Feeds one RTT sample, in seconds, taken from a packet that was never retransmitted."""
+        if self.srtt is None:
+            self.srtt = rtt; self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.rto = min(max(self.srtt + max(CLOCK_GRANULARITY, self.K * self.rttvar), MIN_RTO), MAX_RTO)
+
+    def backoff_timeout(self, attempts):
+        """The timeout for a packet already retransmitted `attempts` times, doubling each time."""
+        return min(self.rto * 2 ** attempts, MAX_RTO)
+
+
+MAX_PROBE_RTT = 3600.0  # echoed timestamps further back than this are not ours
+
+
+def probe_rtt(payload, now_ns=None):
+    """The RTT, in seconds, of a PING_RESPONSE echoing the 'sent' time.monotonic_ns() of our request; None without one."""
+    sent = payload.get('sent') if isinstance(payload, dict) else None
+    if not isinstance(sent, int) or isinstance(sent, bool): return None
+    rtt = ((time.monotonic_ns() if now_ns is None else now_ns) - sent) / 1e9
+    return rtt if 0 <= rtt <= MAX_PROBE_RTT else None
+
+
+class LatencyStats:
+    """Rolling RTT and jitter to one peer, from latency probes.
+
+    srtt is smoothed like RttEstimator's; jitter is the smoothed difference between
+    consecutive samples, as RTP's interarrival jitter (RFC 3550).
+    """
+    ALPHA = 1 / 8
+    JITTER_GAIN = 1 / 16
+
+    def __init__(self):
+        self.srtt = None
+        self.jitter = 0.0
+        self.last = None
+        self.min = None
+        self.samples = 0
+
+    def observe(self, rtt):
+        """Feeds one RTT sample, in seconds."""
+        if self.srtt is None: self.srtt = rtt
+        else:
+            self.srtt += self.ALPHA * (rtt - self.srtt)
+            self.jitter += self.JITTER_GAIN * (abs(rtt - self.last) - self.jitter)
+        self.last = rtt; self.min = rtt if self.min is None else min(self.min, rtt); self.samples += 1
+
+
+MAX_REPORT_PEERS = 1000
+
+
+def rtt_report(latency):
+    """An RTT_REPORT payload from peer -> LatencyStats, with srtt and jitter in microseconds."""
+    peers = sorted(peer for peer, stats in latency.items() if stats.srtt is not None)[:MAX_REPORT_PEERS]
+    micros = lambda seconds: min(round(seconds * 1e6), protocol.UINT_MAX)
+    return {'users': peers, 'rtts': [micros(latency[peer].srtt) for peer in peers], 'jitters': [micros(latency[peer].jitter) for peer in peers]}
+
+
+def read_rtt_report(payload):
+    """peer -> (srtt, jitter) in seconds from an RTT_REPORT payload; None if it is malformed."""
+    users, rtts, jitters = payload.get('users'), payload.get('rtts'), payload.get('jitters')
+    if not all(isinstance(values, list) for values in (users, rtts, jitters)) or not len(users) == len(rtts) == len(jitters) or len(users) > MAX_REPORT_PEERS: return None
+    if not all(isinstance(user, str) for user in users) or not all(type(value) is int and value >= 0 for value in rtts + jitters): return None
+    return {user: (rtt / 1e6, jitter / 1e6) for user, rtt, jitter in zip(users, rtts, jitters)}
+
+
+class RetransmitQueue:
+    """Unacknowledged packets ordered by retransmission deadline.
+
+    Deadlines live in a heap, so finding what is due never scans every outstanding
+    packet; entries for packets acknowledged in the meantime are skipped lazily.
+    Each packet backs off exponentially on its own, so a burst of losses does not
+    inflate the timeout of packets that are getting through. Not thread-safe:
+    callers hold their own lock.
+    """
+    def __init__(self, estimator=None):
+        self.estimator = estimator or RttEstimator()
+        self.packets = {}
+        self.deadlines = []
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.packets)
+
+    def add(self, seq_num, packet, now):
+        """Tracks a packet that has just been sent for the first time."""
+        self.packets[seq_num] = {'packet': packet, 'sent': now, 'attempts': 0, 'token': next(self.counter)}
+        heapq.heappush(self.deadlines, (now + self.estimator.rto, self.packets[seq_num]['token'], seq_num))
+
+    def ack(self, seq_num, now):
+        """Forgets an acknowledged packet; returns False if it was not outstanding."""
+        info = self.packets.pop(seq_num, None)
+        if info is None: return False
+        if not info['attempts']: self.estimator.observe(now - info['sent'])
+        return True
+
+    def ack_matching(self, predicate, now):
+        """Forgets every outstanding packet whose sequence number satisfies predicate; returns them sorted."""
+        acked = sorted(seq_num for seq_num in self.packets if predicate(seq_num))
+        for seq_num in acked: self.ack(seq_num, now)
+        return acked
+
+    def pop_due(self, now):
+        """Returns (seq_num, packet) for every packet whose deadline has passed and re-arms their timers."""
+        due = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, token, seq_num = heapq.heappop(self.deadlines)
+            info = self.packets.get(seq_num)
+            if info is None or info['token'] != token: continue
+            due.append((seq_num, info['packet']))
+            info['attempts'] += 1; info['token'] = next(self.counter)
+            heapq.heappush(self.deadlines, (now + self.estimator.backoff_timeout(info['attempts']), info['token'], seq_num))
+        return due
+
+    def time_until_next(self, now):
+        """Seconds until the earliest deadline, or None if nothing is outstanding."""
+        while self.deadlines and self.deadlines[0][2] not in self.packets: heapq.heappop(self.deadlines)
+        return max(0.0, self.deadlines[0][0] - now) if self.deadlines else None
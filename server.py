@@ -1,43 +1,123 @@
 import socket
 import threading
+import asyncio
+import heapq
+import itertools
+import select
+import os
+import time
+import signal
+import argparse
+import secrets
 import protocol
+import outbound
+import reliability
+import sharding
+import history
+import metrics
+import registry
+import serverlog
 import logging
 import sys
 
 log = logging.getLogger('ChatServer')
 log.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+events = serverlog.EventLog(log)  # per-message lines, rate limited
 
-file_handler = logging.FileHandler('server.log', mode='a')
-file_handler.setFormatter(formatter)
+TCP_BACKLOG = 1024
+ROSTER_DEBOUNCE = 0.05
+DEFAULT_SLOW_RTT = 1.0  # seconds of probed RTT above which a client counts as slow
+# What a resumed session carries over from the connection it replaces.
+SESSION_STATE = ('username', 'codec', 'features', 'compress', 'dedup', 'acks', 'oldest_ack', 'rooms', 'fragments', 'session', 'udp_address')
 
-stream_handler = logging.StreamHandler(sys.stdout)
-stream_handler.setFormatter(formatter)
-log.addHandler(file_handler)
-log.addHandler(stream_handler)
+
+class TimerThread:
+    """Runs callbacks after a delay on a single background thread."""
+    def __init__(self):
+        self.timers = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def call_later(self, delay, callback, *args):
+        with self.condition:
+            heapq.heappush(self.timers, (time.monotonic() + delay, next(self.counter), callback, args))
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.timers or self.timers[0][0] > time.monotonic():
+                    self.condition.wait(self.timers[0][0] - time.monotonic() if self.timers else None)
+                _, _, callback, args = heapq.heappop(self.timers)
+            try:
+                callback(*args)
+            except Exception as e:
+                log.error(f"Error in timer callback: {e}", exc_info=True)
 
 
 class ChatServer:
     """The main class for the chat server."""
-    def __init__(self, host, tcp_port, udp_port):
+    def __init__(self, host, tcp_port, udp_port, outbound_policy=outbound.POLICY_DROP_OLDEST, high_watermark=outbound.DEFAULT_HIGH_WATERMARK, low_watermark=outbound.DEFAULT_LOW_WATERMARK, reuse_port=False, history_dir=None, probe_interval=protocol.PROBE_INTERVAL, slow_rtt=DEFAULT_SLOW_RTT, slow_high_watermark=None, session_grace=protocol.SESSION_GRACE):
         self.host = host
         self.tcp_port = tcp_port
         self.udp_port = udp_port
         self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket = protocol.udp_receive_socket()
+        granted = self.udp_socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        if granted < protocol.UDP_RECEIVE_BUFFER: log.warning(f"UDP receive buffer is {granted} bytes, not {protocol.UDP_RECEIVE_BUFFER}; raise net.core.rmem_max so bursts of fragments are not dropped.")
+        if reuse_port:
+            # Lets several worker processes bind the same ports; the kernel spreads connections and datagrams between them.
+            self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.readers = []
        
-        self.clients = {} 
-        self.clients_lock = threading.Lock()
+        self.metrics = metrics.ServerMetrics(self.online_count, self.slow_count)
+        self.clients = registry.ClientRegistry(metrics.TimedLock(self.metrics.lock_wait, self.metrics.lock_hold, sample_every=1))
+        self.profiler = metrics.SamplingProfiler()
+
+        self.outbound_policy = outbound_policy
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        # Clients whose probes show them falling behind get a smaller buffer, so the policy applies to them sooner.
+        self.slow_high_watermark = high_watermark // 4 if slow_high_watermark is None else slow_high_watermark
+        self.slow_low_watermark = self.slow_high_watermark * low_watermark // high_watermark
+        self.slow_rtt = slow_rtt
+        self.probe_interval = probe_interval
+        self.rtt_matrix = metrics.RttMatrix()
+        self.writer = outbound.OutboundWriter(self.metrics.send_seconds.observe)
+        self.timers = TimerThread()
+        self.history = history.HistoryStore(history_dir) if history_dir else None
+
+        self.session_grace = session_grace
+        self.sessions = {}  # token -> client info, for RESUME
+        self.session_lock = threading.RLock()
+
+        self.roster_version = 0
+        self.published_roster = frozenset()
+        self.roster_tick_pending = False
+        self.roster_lock = threading.Lock()
+
+        self.rooms = registry.RoomIndex()
+        self.published_rooms = frozenset()
+        self.room_tick_pending = False
+        self.room_list_lock = threading.Lock()
 
     def start(self):
         """Binds sockets and starts listening for connections."""
-        self.tcp_socket.bind((self.host, self.tcp_port)); self.tcp_socket.listen()
+        self.tcp_socket.bind((self.host, self.tcp_port)); self.tcp_socket.listen(TCP_BACKLOG)
         log.info(f"TCP Server listening on {self.host}:{self.tcp_port}")
         self.udp_socket.bind((self.host, self.udp_port))
         log.info(f"UDP Server listening on {self.host}:{self.udp_port}")
 
         
+        self.writer.start()
+        self.timers.start()
+        self.start_probing()
         threading.Thread(target=self.handle_udp_messages, daemon=True).start()
+        for sock, callback in self.readers: threading.Thread(target=self.watch_reader, args=(sock, callback), daemon=True).start()
 
         try:
             while True:
@@ -56,116 +136,706 @@ class ChatServer:
         while True:
             try:
                 data, addr = self.udp_socket.recvfrom(protocol.BUFFER_SIZE)
-                header_bytes = data[:protocol.HEADER_SIZE]
-                payload_bytes = data[protocol.HEADER_SIZE:]
-                msg_type, sender_id, seq_num, _ = protocol.unpack_header(header_bytes)
-                payload = protocol.unpack_payload(payload_bytes)
-
-         
-                with self.clients_lock:
-                    if sender_id in self.clients: self.clients[sender_id]['udp_address'] = addr
-
-                if msg_type == protocol.MSG_TYPE_TEXT_BROADCAST_UDP:
-                    log.info(f"Received public UDP message (Seq:{seq_num}) from '{sender_id}', forwarding.")
-                    self.broadcast_message(data, sender_id)
-                    self.send_ack(sender_id, seq_num)
-                elif msg_type == protocol.MSG_TYPE_PRIVATE_TEXT_UDP:
-                    recipient = payload.get('recipient')
-                    if recipient:
-                        log.info(f"Received private UDP message (Seq:{seq_num}) from '{sender_id}' to '{recipient}', forwarding.")
-                        self.send_private_message(data, recipient)
-                        self.send_ack(sender_id, seq_num)
+                self.process_udp_packet(data, addr)
             except Exception as e:
                 log.error(f"Error in UDP handler: {e}", exc_info=True)
 
+    def add_reader(self, sock, callback):
+        """Registers callback() to be run whenever sock is readable, on whichever engine serves the server."""
+        self.readers.append((sock, callback))
+
+    def watch_reader(self, sock, callback):
+        """Runs a reader callback from its own thread (the threaded engine's add_reader)."""
+        while True:
+            select.select([sock], [], [])
+            try:
+                callback()
+            except Exception as e:
+                log.error(f"Error in reader callback: {e}", exc_info=True)
+
+    def export_metrics(self, port=None, path=None, interval=metrics.SNAPSHOT_INTERVAL, host='127.0.0.1'):
+        """Serves the metrics and the profiler on a local HTTP port, and/or writes a snapshot to path every interval seconds."""
+        if port is not None: metrics.serve_metrics(self.metrics, self.profiler, port, host, self.rtt_snapshot)
+        if path: metrics.SnapshotWriter(self.metrics, path, interval).start()
+        if hasattr(signal, 'SIGUSR2'): signal.signal(signal.SIGUSR2, lambda signum, frame: self.profiler.toggle(f'profile-{os.getpid()}.folded'))
+
+    def process_udp_packet(self, data, addr):
+        """Routes a single UDP datagram. Shared by both server engines."""
+        received = time.perf_counter()
+        header_bytes = data[:protocol.HEADER_SIZE]
+        payload_bytes = memoryview(data)[protocol.HEADER_SIZE:]
+        msg_type, sender_id, seq_num, _ = protocol.unpack_header(header_bytes)
+        self.metrics.count_datagram(msg_type)
+ 
+        client_info = self.clients.get(sender_id)
+        if client_info and client_info.get('udp_address') != addr: client_info['udp_address'] = addr
+
+        if msg_type == protocol.MSG_TYPE_FRAGMENT_UDP:
+            packet = client_info['fragments'].add(seq_num, payload_bytes, time.monotonic()) if client_info else None
+            if packet: self.process_udp_packet(packet, addr)
+            return
+        if msg_type == protocol.MSG_TYPE_BATCH:
+            try: frames = protocol.split_batch(payload_bytes, protocol.header_flags(header_bytes))
+            except ValueError as e: log.warning(f"Dropped a UDP batch from '{sender_id}': {e}"); return
+            for frame in frames: self.process_udp_packet(frame.packet, addr)
+            return
+
+        if client_info and msg_type in (protocol.MSG_TYPE_TEXT_BROADCAST_UDP, protocol.MSG_TYPE_PRIVATE_TEXT_UDP, protocol.MSG_TYPE_ROOM_TEXT_UDP):
+            try: fresh = client_info['dedup'].check_and_mark(seq_num)
+            except ValueError as e: events.info('udp_seq_rejected', "Dropped UDP message from '%s': %s.", sender_id, str(e), user=sender_id, seq=seq_num); return
+        else: fresh = True
+        if not fresh:
+            self.metrics.duplicates.inc()
+            events.info('udp_duplicate', "Suppressed duplicate UDP message (Seq:%d) from '%s', re-sending ACK.", seq_num, sender_id, user=sender_id, seq=seq_num)
+            self.send_ack(sender_id, seq_num, received)
+            return
+
+        if msg_type == protocol.MSG_TYPE_TEXT_BROADCAST_UDP:
+            events.info('udp_broadcast', "Received public UDP message (Seq:%d) from '%s', forwarding.", seq_num, sender_id, user=sender_id, seq=seq_num)
+            self.broadcast_message(data, sender_id)
+            self.record_history(data, sender_id)
+            self.send_ack(sender_id, seq_num, received)
+        elif msg_type == protocol.MSG_TYPE_PRIVATE_TEXT_UDP:
+            recipient = protocol.peek_recipient(payload_bytes, protocol.header_flags(header_bytes))
+            if recipient:
+                events.info('udp_private', "Received private UDP message (Seq:%d) from '%s' to '%s', forwarding.", seq_num, sender_id, recipient, user=sender_id, seq=seq_num, recipient=recipient)
+                self.send_private_message(data, recipient)
+                self.record_history(data, sender_id, recipient)
+                self.send_ack(sender_id, seq_num, received)
+        elif msg_type == protocol.MSG_TYPE_ROOM_TEXT_UDP:
+            room = protocol.peek_recipient(payload_bytes, protocol.header_flags(header_bytes))
+            if room and client_info and room in client_info['rooms']:
+                events.info('udp_room', "Received room UDP message (Seq:%d) from '%s' to room '%s', forwarding.", seq_num, sender_id, room, user=sender_id, seq=seq_num, room=room)
+                self.send_room_message(data, sender_id, room)
+                self.record_history(data, sender_id, room=room)
+            elif room:
+                # Still ACKed, so the client stops retransmitting a message that will never be delivered.
+                events.info('udp_room_rejected', "Dropped room UDP message (Seq:%d) from '%s': not a member of room '%s'.", seq_num, sender_id, room, user=sender_id, seq=seq_num, room=room)
+            if room: self.send_ack(sender_id, seq_num, received)
+
     def handle_tcp_client(self, conn, addr):
         """Manages a single client's entire lifecycle via their TCP connection."""
-        username = None
+        client_info = {'tcp_socket': conn, 'tcp_address': addr, 'outbound': self.create_outbound_queue(on_ready=self.writer.notify, sock=conn)}
         log.info(f"New TCP connection from {addr}, waiting for login...")
+        reader = protocol.FrameReader(conn)
         try:
             while True:
            
-                header_bytes = conn.recv(protocol.HEADER_SIZE)
-                if not header_bytes: break
-                
-                msg_type, sender_id, _, payload_len = protocol.unpack_header(header_bytes)
-                payload_bytes = b''
-                if payload_len > 0: payload_bytes = conn.recv(payload_len)
-                payload = protocol.unpack_payload(payload_bytes)
-                full_packet = header_bytes + payload_bytes
-
-                if msg_type == protocol.MSG_TYPE_LOGIN:
-                    with self.clients_lock:
-                        if sender_id in self.clients: log.warning(f"Login failed for {addr}: Username '{sender_id}' is already taken."); conn.close(); return
-                        username = sender_id
-                        self.clients[username] = {'tcp_socket': conn, 'tcp_address': addr}
-                    log.info(f"User '{username}' logged in successfully from {addr}.")
-                    self.broadcast_user_list()
-                
-                elif msg_type == protocol.MSG_TYPE_LOGOUT_TCP:
-                    log.info(f"User '{sender_id}' initiated a clean logout."); break
-                
-                elif msg_type == protocol.MSG_TYPE_PING_REQUEST_TCP:
-                    recipient = payload.get('recipient')
-                    if recipient: log.info(f"PING Request: Forwarding from '{sender_id}' to '{recipient}'."); self.send_private_message(full_packet, recipient)
-
-                elif msg_type == protocol.MSG_TYPE_PING_RESPONSE_TCP:
-                    recipient = payload.get('recipient')
-                    if recipient: log.info(f"PING Response: Forwarding from '{sender_id}' to '{recipient}'."); self.send_private_message(full_packet, recipient)
+                frames = reader.read_frames()
+                if frames is None: break
+                if not self.process_frames(client_info, frames): break
+                del frames  # the views would keep a large frame's buffer alive while the next read blocks
 
         except (ConnectionResetError, BrokenPipeError, OSError):
-            log.warning(f"Connection with '{username if username else addr}' dropped unexpectedly.")
+            log.warning(f"Connection with '{client_info.get('username', addr)}' dropped unexpectedly.")
         except Exception as e:
-            log.error(f"An error occurred with client '{username if username else addr}': {e}", exc_info=True)
+            log.error(f"An error occurred with client '{client_info.get('username', addr)}': {e}", exc_info=True)
         finally:
-         
-            if username:
-                with self.clients_lock:
-                    if username in self.clients: del self.clients[username]
-                self.broadcast_user_list()
-                log.info(f"Cleaned up resources for user '{username}'.")
-            conn.close()
+            self.end_connection(client_info)
+
+    def process_frames(self, client_info, frames):
+        """Handles every frame parsed from one read of a client's TCP stream. Returns False if the connection should be closed."""
+        for frame in frames:
+            if frame.msg_type == protocol.MSG_TYPE_BATCH:
+                if not self.process_frames(client_info, protocol.split_batch(frame.payload, frame.flags)): return False
+                continue
+            payload = protocol.unpack_payload(frame.payload, frame.flags) or {}
+            if not self.process_tcp_packet(client_info, frame.msg_type, frame.sender_id, payload, frame.packet): return False
+        return True
+
+    def process_tcp_packet(self, client_info, msg_type, sender_id, payload, full_packet):
+        """Handles one packet from a client's TCP stream. Returns False if the connection should be closed.
+
+        full_packet is a view into the connection's read buffer; it is copied before being forwarded.
+        """
+        addr = client_info['tcp_address']
+        if msg_type == protocol.MSG_TYPE_LOGIN:
+            if 'username' in client_info:
+                log.warning(f"Ignored a second login as '{sender_id}' from {addr}, already logged in as '{client_info['username']}'."); return True
+            client_info['username'] = sender_id
+            client_info['codec'] = protocol.negotiate_codec(payload.get('codecs'))
+            client_info['features'] = set(payload.get('features') or ())
+            client_info['dedup'] = reliability.DedupWindow()
+            client_info['acks'] = reliability.AckBatcher()
+            client_info['rooms'] = set()
+            client_info['compress'] = protocol.FEATURE_COMPRESSION in client_info['features']
+            client_info['fragments'] = protocol.Reassembler()
+            client_info['latency'] = reliability.LatencyStats()
+            client_info['slow'] = False
+            if sender_id == protocol.SERVER_NAME:
+                del client_info['username']
+                log.warning(f"Login failed for {addr}: Username '{sender_id}' is reserved."); return False
+            with self.session_lock:
+                existing = self.clients.get(sender_id)
+                if existing is not None and existing.get('suspended'):
+                    log.info(f"User '{sender_id}' logged in again; ending their suspended session."); self.expire_session(existing, existing['suspended'])
+                if not self.clients.add(sender_id, client_info):
+                    del client_info['username']
+                    log.warning(f"Login failed for {addr}: Username '{sender_id}' is already taken."); return False
+                if self.session_grace and protocol.FEATURE_RESUME in client_info['features']:
+                    client_info['session'] = secrets.token_hex(16); self.sessions[client_info['session']] = client_info
+            log.info(f"User '{sender_id}' logged in successfully from {addr} ({client_info['codec']} payloads{', compressed' if client_info['compress'] else ''}).")
+            self.send_user_list(client_info)
+            self.send_room_list(client_info)
+            self.roster_changed()
+        
+        elif msg_type == protocol.MSG_TYPE_ROSTER_SYNC_TCP:
+            if 'username' in client_info: log.info(f"User '{sender_id}' missed a roster update, sending a full user list."); self.send_user_list(client_info)
+
+        elif msg_type == protocol.MSG_TYPE_HISTORY_REQUEST_TCP:
+            if 'username' not in client_info: pass
+            elif payload.get('room') and not (protocol.valid_room_name(payload['room']) and payload['room'] in client_info['rooms']): log.warning(f"User '{sender_id}' requested the history of room '{payload['room']}' without being a member.")
+            else: log.info(f"User '{sender_id}' requested history{' with ' + repr(payload['peer']) if payload.get('peer') else ''}{' of room ' + repr(payload['room']) if payload.get('room') else ''}."); self.send_history(client_info, payload)
+
+        elif msg_type == protocol.MSG_TYPE_ROOM_JOIN_TCP:
+            if 'username' in client_info: self.join_room(client_info, payload.get('room'))
+
+        elif msg_type == protocol.MSG_TYPE_ROOM_LEAVE_TCP:
+            if 'username' in client_info: self.leave_room(client_info, payload.get('room'))
+
+        elif msg_type == protocol.MSG_TYPE_RESUME_TCP:
+            if 'username' not in client_info: self.resume_session(client_info, sender_id, payload.get('session'))
+
+        elif msg_type == protocol.MSG_TYPE_LOGOUT_TCP:
+            client_info['logged_out'] = True
+            log.info(f"User '{sender_id}' initiated a clean logout."); return False
+        
+        elif msg_type == protocol.MSG_TYPE_RTT_REPORT_TCP:
+            peers = reliability.read_rtt_report(payload) if 'username' in client_info else None
+            if peers is not None: self.rtt_matrix.update(client_info['username'], peers)
+
+        elif msg_type == protocol.MSG_TYPE_PING_REQUEST_TCP:
+            recipient = payload.get('recipient')
+            if recipient == protocol.SERVER_NAME:
+                # Answered here, echoing the timestamp, so clients can measure their RTT to the server itself.
+                response = {'recipient': sender_id}
+                if 'sent' in payload: response['sent'] = payload['sent']
+                if 'username' in client_info: self.send_to_client(protocol.pack_data(protocol.MSG_TYPE_PING_RESPONSE_TCP, protocol.SERVER_NAME, 0, response, client_info['codec']), client_info)
+            elif recipient: events.info('ping_request', "PING Request: Forwarding from '%s' to '%s'.", sender_id, recipient, user=sender_id, recipient=recipient); self.send_private_message(bytes(full_packet), recipient)
+
+        elif msg_type == protocol.MSG_TYPE_PING_RESPONSE_TCP:
+            recipient = payload.get('recipient')
+            if recipient == protocol.SERVER_NAME:
+                # The answer to one of our probes; clients that predate timestamps answer without 'sent'.
+                rtt = reliability.probe_rtt(payload)
+                if client_info.pop('probe_sent', None) is not None and rtt is not None: self.observe_rtt(client_info, rtt)
+            elif recipient: events.info('ping_response', "PING Response: Forwarding from '%s' to '%s'.", sender_id, recipient, user=sender_id, recipient=recipient); self.send_private_message(bytes(full_packet), recipient)
+        return True
+
+    def end_connection(self, client_info):
+        """Cleans up after a client's TCP connection has ended; a client that can resume keeps its session for session_grace seconds."""
+        with self.session_lock:
+            if client_info.get('superseded'): return
+            queue = client_info['outbound']
+            if self.session_grace and client_info.get('session') and not client_info.get('logged_out'): self.suspend_client(client_info)
+            else: self.remove_client(client_info)
+        self.release_outbound(queue)
+
+    def release_outbound(self, queue):
+        """Closes the outbound queue of a connection that has ended, and its socket."""
+        self.writer.retire(queue)
+
+    def suspend_client(self, client_info):
+        """Keeps a client whose connection dropped logged in, buffering what is sent to it, until it resumes or session_grace runs out."""
+        parked = self.create_outbound_queue()
+        if client_info['slow']: parked.set_watermarks(self.slow_high_watermark, self.slow_low_watermark)
+        parked.requeue(client_info['outbound'].detach()); client_info['outbound'] = parked
+        client_info.pop('probe_sent', None)
+        since = client_info['suspended'] = time.monotonic()
+        self.call_later(self.session_grace, self.expire_session, client_info, since)
+        log.info(f"Connection of '{client_info['username']}' lost; keeping their session for {self.session_grace:g}s ({len(parked.frames)} frames waiting).")
+
+    def expire_session(self, client_info, since):
+        """Logs out a client whose connection has been gone since `since`, unless it has resumed in the meantime."""
+        with self.session_lock:
+            if client_info.get('suspended') != since: return
+            client_info['superseded'] = True
+            log.info(f"Session of '{client_info['username']}' ended: no reconnect within {self.session_grace:g}s.")
+            self.remove_client(client_info)
+        client_info['outbound'].close()
+
+    def resume_session(self, client_info, username, token):
+        """Moves a session onto the new connection of client_info: same registration and rooms, and every frame that waited for it.
+
+        Anything else gets an empty RESUME, telling the client to LOGIN instead. Returns whether the session was resumed.
+        """
+        with self.session_lock:
+            session = self.sessions.get(token) if isinstance(token, str) else None
+            if session is None or session['username'] != username or session['outbound'].closed:
+                log.info(f"Cannot resume a session for '{username}' from {client_info['tcp_address']}: unknown or expired token.")
+                self.send_to_client(protocol.pack_data(protocol.MSG_TYPE_RESUME_TCP, protocol.SERVER_NAME, 0, {}), client_info); return False
+            if not session.get('suspended'):
+                # The client noticed the drop before we did; its old connection is half-open.
+                queue = session['outbound']; self.disconnect_client(session); self.suspend_client(session); self.release_outbound(queue)
+            session['suspended'] = None; session['superseded'] = True
+            for key in SESSION_STATE:
+                if key in session: client_info[key] = session[key]
+            client_info['latency'] = reliability.LatencyStats(); client_info['slow'] = False
+            parked, connection = session['outbound'], client_info['outbound']
+            parked.set_watermarks(self.high_watermark, self.low_watermark); client_info['outbound'] = parked
+            self.clients.replace(username, session, client_info)
+            for room in client_info['rooms']: self.rooms.replace(room, username, client_info)
+            self.sessions[token] = client_info
+        waiting = len(parked.frames)
+        parked.requeue([(protocol.pack_data(protocol.MSG_TYPE_RESUME_TCP, protocol.SERVER_NAME, 0, {'session': token}, client_info['codec']), None)])
+        parked.attach(connection.on_ready, connection.sock)
+        log.info(f"User '{username}' resumed their session from {client_info['tcp_address']} ({waiting} frames waited for them).")
+        return True
+
+    def remove_client(self, client_info):
+        """Unregisters a client after its TCP connection has ended."""
+        username = client_info.get('username')
+        if username:
+            with self.session_lock:
+                if self.sessions.get(client_info.get('session')) is client_info: del self.sessions[client_info['session']]
+            self.clients.remove(username, client_info)
+            self.rtt_matrix.forget(username)
+            for room in list(client_info['rooms']): self.leave_room(client_info, room, notify=False)
+            self.roster_changed()
+            log.info(f"Cleaned up resources for user '{username}' ({client_info['dedup'].duplicates} duplicate UDP messages suppressed).")
 
     def broadcast_message(self, message, sender_id):
-        """Forwards a message to all clients except the sender."""
-        with self.clients_lock:
-            for user, client_info in self.clients.items():
-                if user != sender_id: self.send_to_client(message, client_info)
+        """Forwards a message to all clients except the sender.
+
+        The frame is shared by every recipient's queue that takes the same encoding, rather than copied per client.
+        """
+        frames = {}
+        recipients = tuple(client_info for user, client_info in self.clients.items() if user != sender_id)
+        self.metrics.fanout.observe(len(recipients))
+        for client_info in recipients: self.forward(client_info, message, frames)
+
+    def send_room_message(self, message, sender_id, room):
+        """Forwards a message to the members of a room except the sender; nobody else is looked at."""
+        frames = {}
+        members = self.rooms.members(room)
+        self.metrics.room_fanout.observe(len(members) - (sender_id in members))
+        for user, client_info in members.items():
+            if user != sender_id: self.forward(client_info, message, frames)
+
+    def join_room(self, client_info, room):
+        """Adds a client to a room, creating the room if needed. Returns whether it joined."""
+        username = client_info['username']
+        if not protocol.valid_room_name(room):
+            log.warning(f"User '{username}' tried to join a room with an invalid name: {room!r}."); return False
+        joined, created = self.rooms.join(room, username, client_info)
+        if not joined: return False
+        client_info['rooms'].add(room)
+        log.info(f"User '{username}' joined room '{room}'{' (new room)' if created else ''}; {len(self.rooms.members(room))} local members.")
+        self.send_room_list(client_info)
+        if created: self.rooms_changed()
+        return True
+
+    def leave_room(self, client_info, room, notify=True):
+        """Removes a client from a room; the room goes away with its last member. Returns whether it left."""
+        username = client_info['username']
+        if not protocol.valid_room_name(room): return False
+        left, removed = self.rooms.leave(room, username)
+        if not left: return False
+        client_info['rooms'].discard(room)
+        log.info(f"User '{username}' left room '{room}'{' (room closed)' if removed else ''}.")
+        if notify: self.send_room_list(client_info)
+        if removed: self.rooms_changed()
+        return True
+
+    def room_names(self):
+        """Returns the name of every room that has members."""
+        return self.rooms.names()
+
+    def send_room_list(self, client_info):
+        """Sends one client every room, and the rooms it is a member of."""
+        payload = {'rooms': sorted(self.room_names()), 'joined': sorted(client_info['rooms'])}
+        self.send_to_client(protocol.pack_data(protocol.MSG_TYPE_ROOM_LIST_TCP, "SERVER", 0, payload, client_info.get('codec', protocol.CODEC_JSON)), client_info, coalesce_key='room_list')
+
+    def rooms_changed(self):
+        """Schedules a room list update for every client; rooms opened or closed within ROSTER_DEBOUNCE share one."""
+        with self.room_list_lock:
+            if self.room_tick_pending: return
+            self.room_tick_pending = True
+        self.call_later(ROSTER_DEBOUNCE, self.broadcast_room_list)
+
+    def broadcast_room_list(self):
+        """Publishes the set of rooms to all connected clients if it changed since the last update.
+
+        This list has no 'joined' field, so one frame per codec is shared by every client.
+        """
+        with self.room_list_lock:
+            self.room_tick_pending = False
+            current = frozenset(self.room_names())
+            if current == self.published_rooms: return
+            self.published_rooms = current
+            log.info(f"Room list changed: {len(current)} rooms.")
+            frames = {}
+            for client_info in list(self.clients.values()):
+                codec = client_info.get('codec', protocol.CODEC_JSON)
+                if codec not in frames: frames[codec] = protocol.pack_data(protocol.MSG_TYPE_ROOM_LIST_TCP, "SERVER", 0, {'rooms': sorted(current)}, codec)
+                self.send_to_client(frames[codec], client_info, coalesce_key='room_list')
+
+    def record_history(self, message, sender_id, recipient=None, room=None):
+        """Stores an accepted public, private or room message, if the server keeps a history."""
+        if self.history: self.history.append(history.conversation_key(sender_id, recipient, room), message)
+
+    def send_history(self, client_info, request):
+        """Answers a HISTORY_REQUEST with one page of stored messages."""
+        response = self.history_page(client_info['username'], request)
+        self.send_to_client(protocol.pack_data(protocol.MSG_TYPE_HISTORY_RESPONSE_TCP, "SERVER", 0, response, client_info.get('codec', protocol.CODEC_JSON), client_info.get('compress', False)), client_info)
+
+    def history_page(self, username, request):
+        """Builds a HISTORY_RESPONSE payload for the public room, for request['room'], or for the user's private conversation with request['peer'].
+
+        'before' in the response is the message number to ask for next to page further back.
+        """
+        peer, room, before, limit = (request.get(field) for field in ('peer', 'room', 'before', 'limit'))
+        # Fields of the wrong type are ignored rather than allowed to fail the connection.
+        if not isinstance(peer, str): peer = None
+        if not isinstance(room, str): room = None
+        if type(before) is not int: before = None
+        limit = min(max(limit, 1), history.MAX_PAGE_SIZE) if type(limit) is int else protocol.HISTORY_PAGE_SIZE
+        key = history.conversation_key(username, room=room) if room else history.conversation_key(username, peer) if peer else history.PUBLIC
+        start, records = self.history.page(key, before, limit) if self.history else (0, [])
+        messages = []
+        for timestamp, frame in records:
+            header_bytes = frame[:protocol.HEADER_SIZE]
+            msg_type, sender_id, _, _ = protocol.unpack_header(header_bytes)
+            payload = protocol.unpack_payload(memoryview(frame)[protocol.HEADER_SIZE:], protocol.header_flags(header_bytes)) or {}
+            entry = {'sender': sender_id, 'text': payload.get('text', ''), 'time': timestamp}
+            if msg_type == protocol.MSG_TYPE_PRIVATE_TEXT_UDP: entry['recipient'] = payload.get('recipient')
+            elif msg_type == protocol.MSG_TYPE_ROOM_TEXT_UDP: entry['room'] = payload.get('recipient')
+            messages.append(entry)
+        response = {'messages': messages, 'before': start, 'more': start > 0}
+        if peer: response['peer'] = peer
+        if room: response['room'] = room
+        return response
 
     def send_private_message(self, message, recipient):
         """Forwards a message to a single, specific recipient."""
-        with self.clients_lock:
-            if recipient in self.clients: self.send_to_client(message, self.clients[recipient])
+        client_info = self.clients.get(recipient)
+        if client_info: self.forward(client_info, message, {})
+
+    def forward(self, client_info, message, frames):
+        """Queues a message for a client in a form it can read; one that cannot be re-encoded for it is dropped."""
+        frame = self.frame_for(client_info, message, frames)
+        if frame is not None: self.send_to_client(frame, client_info)
 
-    def send_to_client(self, message, client_info):
-        """Helper function to send a packet to a client's TCP socket."""
+    def frame_for(self, client_info, message, frames):
+        """Returns the message in a form the client can read, or None if it cannot be decoded; caches one per codec and compression support in frames."""
+        key = (client_info.get('codec', protocol.CODEC_JSON), client_info.get('compress', False))
+        if key not in frames:
+            try: frames[key] = memoryview(protocol.transcode(message, *key))
+            except ValueError as e:
+                frames[key] = None; sender_id = protocol.unpack_header(message[:protocol.HEADER_SIZE])[1]
+                events.info('transcode_failed', "Dropped a message from '%s' that could not be re-encoded: %s.", sender_id, str(e), user=sender_id)
+        return frames[key]
+
+    def create_outbound_queue(self, **kwargs):
+        """Creates a client's outbound buffer with the server's watermarks and slow-consumer policy."""
+        return outbound.OutboundQueue(self.high_watermark, self.low_watermark, self.outbound_policy, **kwargs)
+
+    def send_to_client(self, message, client_info, coalesce_key=None):
+        """Queues a packet for a client; the actual write happens off the routing path."""
+        queue = client_info['outbound']; dropped = queue.dropped
+        if not queue.push(message, coalesce_key):
+            self.metrics.dropped_frames.inc(1, self.outbound_policy)
+            log.warning(f"Disconnecting slow consumer '{client_info.get('username', client_info.get('tcp_address'))}': more than {queue.high_watermark} bytes pending.")
+            self.disconnect_client(client_info)
+        elif queue.dropped != dropped: self.metrics.dropped_frames.inc(queue.dropped - dropped, self.outbound_policy)
+
+    def start_probing(self):
+        """Starts the rounds of latency probes to every client, unless probe_interval is 0."""
+        if self.probe_interval: self.call_later(self.probe_interval, self.probe_clients)
+
+    def probe_clients(self):
+        """Sends every client a PING_REQUEST stamped with time.monotonic_ns(), then schedules the next round.
+
+        Probes queue behind everything else sent to a client, so their RTT includes the
+        time its outbound buffer takes to drain, which is what makes a slow consumer.
+        A client has one probe outstanding at most; while it stays unanswered for more
+        than slow_rtt, its age counts as a sample each round.
+        """
         try:
-            client_info['tcp_socket'].sendall(message)
-        except (BrokenPipeError, ConnectionResetError):
-            log.warning(f"Failed to send message to user at {client_info.get('tcp_address')}. Client might be disconnected.")
+            now = time.monotonic_ns(); probe = protocol.pack_data(protocol.MSG_TYPE_PING_REQUEST_TCP, protocol.SERVER_NAME, 0, {'sent': now}); frames = {}
+            for client_info in self.clients.values():
+                if client_info.get('suspended'): continue
+                sent = client_info.get('probe_sent')
+                if sent is None: client_info['probe_sent'] = now; self.forward(client_info, probe, frames)
+                elif (now - sent) / 1e9 > self.slow_rtt: self.observe_rtt(client_info, (now - sent) / 1e9)
+        finally:
+            self.call_later(self.probe_interval, self.probe_clients)
+
+    def observe_rtt(self, client_info, rtt):
+        """Records a probe RTT for a client, marking it slow above slow_rtt and healthy again below half of that."""
+        stats = client_info['latency']; stats.observe(rtt); self.metrics.client_rtt.observe(rtt)
+        if not client_info['slow'] and stats.srtt > self.slow_rtt: self.set_slow(client_info, True)
+        elif client_info['slow'] and stats.srtt < self.slow_rtt / 2: self.set_slow(client_info, False)
+
+    def set_slow(self, client_info, slow):
+        """Shrinks the outbound buffer of a client that is falling behind, or restores it once it has caught up."""
+        client_info['slow'] = slow; srtt = client_info['latency'].srtt * 1000
+        if slow:
+            client_info['outbound'].set_watermarks(self.slow_high_watermark, self.slow_low_watermark)
+            log.warning(f"Client '{client_info['username']}' is slow (probed RTT {srtt:.0f} ms); its outbound buffer is limited to {self.slow_high_watermark} bytes.")
+        else:
+            client_info['outbound'].set_watermarks(self.high_watermark, self.low_watermark)
+            log.info(f"Client '{client_info['username']}' has caught up (probed RTT {srtt:.0f} ms); its outbound buffer is back to {self.high_watermark} bytes.")
+
+    def slow_count(self):
+        """Returns the number of logged-in clients currently marked slow."""
+        return sum(1 for client_info in self.clients.values() if client_info.get('slow'))
+
+    def rtt_snapshot(self, user=None):
+        """The RTT matrix served at /rtt: the clients' reports, plus a SERVER row with the server's own probes."""
+        matrix = self.rtt_matrix.snapshot(user)
+        probes = {name: {'rtt_ms': round(client_info['latency'].srtt * 1000, 2), 'jitter_ms': round(client_info['latency'].jitter * 1000, 2), 'slow': client_info['slow']}
+                  for name, client_info in self.clients.items() if user in (None, name) and 'latency' in client_info and client_info['latency'].srtt is not None}
+        matrix[protocol.SERVER_NAME] = {'age': 0.0, 'peers': probes}
+        return matrix
+
+    def disconnect_client(self, client_info):
+        """Forces a client's connection closed; its reader thread then cleans up."""
+        try: client_info['tcp_socket'].shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+
+    def send_user_list(self, client_info):
+        """Sends a full, versioned snapshot of the online users to one client, with the features the server accepted from it."""
+        with self.roster_lock:
+            user_list = self.online_users()
+            features = [feature for feature in protocol.ACKNOWLEDGED_FEATURES if feature in client_info.get('features', ())]
+            payload = {'users': user_list, 'version': self.roster_version, 'features': features}
+            if client_info.get('session'): payload['session'] = client_info['session']
+            message = protocol.pack_data(protocol.MSG_TYPE_USER_LIST_TCP, "SERVER", 0, payload, client_info.get('codec', protocol.CODEC_JSON), client_info.get('compress', False))
+            self.send_to_client(message, client_info, coalesce_key='user_list')
+
+    def online_users(self):
+        """Returns the names of every user who is online."""
+        return self.clients.names()
+
+    def online_count(self):
+        """Returns the number of users logged in to this server process."""
+        return len(self.clients)
+
+    def roster_changed(self):
+        """Schedules a roster update; logins and logouts within ROSTER_DEBOUNCE share one."""
+        with self.roster_lock:
+            if self.roster_tick_pending: return
+            self.roster_tick_pending = True
+        self.call_later(ROSTER_DEBOUNCE, self.broadcast_user_list)
 
     def broadcast_user_list(self):
-        """Sends the current list of online users to all connected clients."""
-        with self.clients_lock:
-            user_list = list(self.clients.keys())
-            payload = {'users': user_list}
-            message = protocol.pack_data(protocol.MSG_TYPE_USER_LIST_TCP, "SERVER", 0, payload)
-            log.info(f"Broadcasting updated user list to {len(user_list)} clients: {user_list}")
-            for client_info in list(self.clients.values()):
-                try: client_info['tcp_socket'].sendall(message)
-                except (BrokenPipeError, ConnectionResetError): pass
+        """Publishes the users who joined or left since the last update to all connected clients.
+
+        Clients that support roster deltas get only the changes and the new roster version;
+        the others get the full list, as before.
+        """
+        with self.roster_lock:
+            self.roster_tick_pending = False
+            user_list = self.online_users()
+            recipients = list(self.clients.values())
+            current = frozenset(user_list)
+            joined = sorted(current - self.published_roster); left = sorted(self.published_roster - current)
+            if not joined and not left: return
+            self.roster_version += 1; self.published_roster = current
+            version = self.roster_version
+            log.info(f"Roster version {version}: {len(joined)} joined {joined}, {len(left)} left {left}; {len(user_list)} users online.")
+            # Pushed under roster_lock so no snapshot for a newer version can overtake this update.
+            deltas = {}; snapshots = {}
+            for client_info in recipients:
+                codec = client_info.get('codec', protocol.CODEC_JSON)
+                if protocol.FEATURE_ROSTER_DELTA in client_info.get('features', ()):
+                    if codec not in deltas: deltas[codec] = protocol.pack_data(protocol.MSG_TYPE_ROSTER_DELTA_TCP, "SERVER", 0, {'version': version, 'joined': joined, 'left': left}, codec)
+                    self.send_to_client(deltas[codec], client_info)
+                else:
+                    key = (codec, client_info.get('compress', False))
+                    if key not in snapshots: snapshots[key] = protocol.pack_data(protocol.MSG_TYPE_USER_LIST_TCP, "SERVER", 0, {'users': user_list, 'version': version}, *key)
+                    self.send_to_client(snapshots[key], client_info, coalesce_key='user_list')
     
-    def send_ack(self, username, seq_num):
-        """Sends a UDP acknowledgment packet to a client over TCP."""
-        with self.clients_lock:
-            if username in self.clients:
-                ack_packet = protocol.pack_data(protocol.MSG_TYPE_ACK_TCP, "SERVER", seq_num, {})
-                try:
-                    self.clients[username]['tcp_socket'].sendall(ack_packet)
-                    log.info(f"Sent ACK for message #{seq_num} to '{username}'.")
-                except Exception as e:
-                    log.error(f"Failed to send ACK to '{username}': {e}")
+    def call_later(self, delay, callback, *args):
+        """Runs callback(*args) after delay seconds on the engine's timer."""
+        self.timers.call_later(delay, callback, *args)
+
+    def send_ack(self, username, seq_num, received=None):
+        """Sends a UDP acknowledgment packet to a client over TCP.
+
+        Clients that support ACK batches get their acknowledgements collected for up
+        to ACK_DELAY seconds and sent as one cumulative/selective ACK frame. received
+        is the perf_counter() time the message arrived, for the ACK latency metric.
+        """
+        received = time.perf_counter() if received is None else received
+        client_info = self.clients.get(username)
+        if not client_info: return
+        if protocol.FEATURE_ACK_BATCH not in client_info['features']:
+            ack_packet = protocol.pack_data(protocol.MSG_TYPE_ACK_TCP, "SERVER", seq_num, {}, client_info.get('codec', protocol.CODEC_JSON))
+            self.send_to_client(ack_packet, client_info)
+            self.metrics.ack_latency.observe(time.perf_counter() - received)
+            events.info('ack', "Sent ACK for message #%d to '%s'.", seq_num, username, user=username, seq=seq_num)
+            return
+        pending = client_info['acks'].add(seq_num)
+        if pending == 1: client_info['oldest_ack'] = received; self.call_later(reliability.ACK_DELAY, self.flush_acks, client_info)
+        elif pending >= reliability.ACK_BATCH_LIMIT: self.flush_acks(client_info)
+
+    def flush_acks(self, client_info):
+        """Sends one ACK frame covering every acknowledgement pending for a client."""
+        payload = client_info['acks'].take(client_info['dedup'].cumulative)
+        if payload is None: return
+        ack_packet = protocol.pack_data(protocol.MSG_TYPE_ACK_BATCH_TCP, "SERVER", 0, payload, client_info.get('codec', protocol.CODEC_JSON))
+        self.send_to_client(ack_packet, client_info)
+        self.metrics.ack_latency.observe(time.perf_counter() - client_info['oldest_ack'])
+        events.info('ack_batch', "Sent ACK batch to '%s' (cumulative #%d, %d ranges).", client_info['username'], payload['cumulative'], len(payload['ranges']) // 2, user=client_info['username'], seq=payload['cumulative'])
+
+class UDPServerProtocol(asyncio.DatagramProtocol):
+    """Feeds datagrams received by the event loop into the server's UDP routing."""
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        try:
+            self.server.process_udp_packet(data, addr)
+        except Exception as e:
+            log.error(f"Error in UDP handler: {e}", exc_info=True)
+
+
+class AsyncChatServer(ChatServer):
+    """Chat server engine that serves every connection from a single asyncio event loop.
+
+    Routing is inherited from ChatServer; only the socket I/O differs. Each client costs
+    one coroutine and its stream buffers instead of a thread and its stack.
+    """
+    TRANSPORT_BUFFER_LIMIT = 64 * 1024
+    def start(self):
+        """Runs the event loop until interrupted."""
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            log.info("Server is shutting down by user command (Ctrl+C).")
+        finally:
+            self.tcp_socket.close(); self.udp_socket.close()
+            log.info("Server has been shut down.")
+
+    async def serve(self):
+        """Binds sockets and serves TCP streams and UDP datagrams forever."""
+        loop = self.loop = asyncio.get_running_loop()
+        self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp_socket.bind((self.host, self.tcp_port)); self.tcp_socket.listen(TCP_BACKLOG)
+        log.info(f"TCP Server listening on {self.host}:{self.tcp_port} (asyncio engine)")
+        self.udp_socket.bind((self.host, self.udp_port))
+        log.info(f"UDP Server listening on {self.host}:{self.udp_port} (asyncio engine)")
+        for sock, callback in self.readers: loop.add_reader(sock, callback)
+        self.start_probing()
+
+        await loop.create_datagram_endpoint(lambda: UDPServerProtocol(self), sock=self.udp_socket)
+        tcp_server = await asyncio.start_server(self.handle_tcp_stream, sock=self.tcp_socket, backlog=TCP_BACKLOG)
+        async with tcp_server:
+            await tcp_server.serve_forever()
+
+    async def handle_tcp_stream(self, reader, writer):
+        """Manages a single client's entire lifecycle via their TCP stream."""
+        addr = writer.get_extra_info('peername')
+        client_info = {'writer': writer, 'tcp_address': addr}
+        loop = asyncio.get_running_loop()
+        client_info['outbound'] = self.create_outbound_queue(on_ready=lambda queue: loop.call_soon(self.flush_outbound, client_info))
+        writer.transport.set_write_buffer_limits(high=self.TRANSPORT_BUFFER_LIMIT)
+        log.info(f"New TCP connection from {addr}, waiting for login...")
+        frame_reader = protocol.FrameReader()
+        try:
+            while True:
+                data = await reader.read(protocol.READ_BUFFER_SIZE)
+                if not data: break
+                if not self.process_frames(client_info, frame_reader.feed(data)): break
+                del data
+        except (ConnectionResetError, BrokenPipeError, OSError):
+            log.warning(f"Connection with '{client_info.get('username', addr)}' dropped unexpectedly.")
+        except Exception as e:
+            log.error(f"An error occurred with client '{client_info.get('username', addr)}': {e}", exc_info=True)
+        finally:
+            self.end_connection(client_info)
+            writer.close()
+
+    def flush_outbound(self, client_info):
+        """Moves a client's queued frames into its transport while the transport has room."""
+        if client_info.get('suspended') or client_info.get('superseded'): return  # its queue now belongs to the session, not this transport
+        writer = client_info['writer']
+        if writer.is_closing(): client_info['outbound'].close(); return
+        if 'drain_task' in client_info: return
+        if writer.transport.get_write_buffer_size() >= self.TRANSPORT_BUFFER_LIMIT:
+            client_info['drain_task'] = asyncio.get_running_loop().create_task(self.wait_writable(client_info))
+            return
+        start = time.perf_counter(); writer.writelines(client_info['outbound'].take_all())
+        self.metrics.send_seconds.observe(time.perf_counter() - start)
+
+    async def wait_writable(self, client_info):
+        """Waits for a slow client's transport to drain, leaving new frames to the outbound policy."""
+        try:
+            await client_info['writer'].drain()
+        except (ConnectionResetError, BrokenPipeError, OSError):
+            if not (client_info.get('suspended') or client_info.get('superseded')): client_info['outbound'].close()
+        finally:
+            del client_info['drain_task']
+        self.flush_outbound(client_info)
+
+    def call_later(self, delay, callback, *args):
+        """Runs callback(*args) after delay seconds on the event loop."""
+        self.loop.call_later(delay, callback, *args)
+
+    def release_outbound(self, queue):
+        """Closes the outbound queue of a connection that has ended; the stream handler closes the transport."""
+        queue.close()
+
+    def disconnect_client(self, client_info):
+        """Aborts a client's transport; its stream handler then cleans up."""
+        client_info['writer'].transport.abort()
+
+
+class ShardedChatServer(sharding.ShardMixin, ChatServer):
+    """One worker of a multi-process server, on the threaded engine."""
+
+
+class ShardedAsyncChatServer(sharding.ShardMixin, AsyncChatServer):
+    """One worker of a multi-process server, on the asyncio engine."""
+
+
+ENGINES = {'threads': ChatServer, 'asyncio': AsyncChatServer}
+SHARDED_ENGINES = {'threads': ShardedChatServer, 'asyncio': ShardedAsyncChatServer}
 
 if __name__ == "__main__":
-    server = ChatServer(protocol.SERVER_HOST, protocol.TCP_PORT, protocol.UDP_PORT)
-    server.start()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Network Project Chat server.")
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='threads', help="I/O engine: one thread per client, or a single asyncio event loop.")
+    parser.add_argument('--slow-consumer-policy', choices=outbound.POLICIES, default=outbound.POLICY_DROP_OLDEST, help="What to do when a client's outbound buffer passes the high watermark.")
+    parser.add_argument('--outbound-high-watermark', type=int, default=outbound.DEFAULT_HIGH_WATERMARK, help="Bytes buffered per client before the slow-consumer policy applies.")
+    parser.add_argument('--outbound-low-watermark', type=int, default=outbound.DEFAULT_LOW_WATERMARK, help="Bytes buffered per client below which a congested client is healthy again.")
+    parser.add_argument('--probe-interval', type=float, default=protocol.PROBE_INTERVAL, help="Seconds between latency probes to every client; 0 disables them.")
+    parser.add_argument('--slow-rtt', type=float, default=DEFAULT_SLOW_RTT, help="Probed RTT, in seconds, above which a client counts as slow and gets a smaller outbound buffer.")
+    parser.add_argument('--slow-high-watermark', type=int, help="Outbound buffer, in bytes, of a slow client (default: a quarter of --outbound-high-watermark).")
+    parser.add_argument('--session-grace', type=float, default=protocol.SESSION_GRACE, help="Seconds a client that lost its connection stays logged in, waiting to resume; 0 logs it out at once.")
+    parser.add_argument('--workers', type=int, default=1, help="Worker processes sharing the ports via SO_REUSEPORT (Linux only).")
+    parser.add_argument('--history-dir', help="Store message history in segment files under this directory; off by default.")
+    parser.add_argument('--log-file', help=f"Log file, rotated by size (default {serverlog.LOG_FILE}, or {serverlog.JSON_LOG_FILE} with --log-format json).")
+    parser.add_argument('--log-max-bytes', type=int, default=serverlog.MAX_BYTES, help="Size at which the log file is rotated.")
+    parser.add_argument('--log-backups', type=int, default=serverlog.BACKUP_COUNT, help="Rotated log files kept.")
+    parser.add_argument('--log-format', choices=('json', 'text'), default='text', help="Format of the log file: text lines, or one JSON object per line; the console always gets text.")
+    parser.add_argument('--log-level', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'), default='INFO')
+    parser.add_argument('--log-rate', type=float, default=serverlog.EVENT_RATE, help="Per-message INFO lines (forwards, ACKs, pings) logged per second for each kind; 0 logs every one.")
+    parser.add_argument('--metrics-port', type=int, help="Serve Prometheus metrics (and /profile) on this local port; worker N of --workers uses port + N - 1.")
+    parser.add_argument('--metrics-file', help="Write a JSON snapshot of the metrics to this file periodically; worker N of --workers adds -N to the name.")
+    parser.add_argument('--metrics-interval', type=float, default=metrics.SNAPSHOT_INTERVAL, help="Seconds between metrics snapshots.")
+    args = parser.parse_args()
+    log.setLevel(args.log_level); events.limiter.rate = args.log_rate
+    structured = args.log_format == 'json'
+    log_pipeline = serverlog.LogPipeline(log, args.log_file or (serverlog.JSON_LOG_FILE if structured else serverlog.LOG_FILE), args.log_max_bytes, args.log_backups, structured=structured)
+    server_args = (protocol.SERVER_HOST, protocol.TCP_PORT, protocol.UDP_PORT, args.slow_consumer_policy, args.outbound_high_watermark, args.outbound_low_watermark)
+    server_options = {'probe_interval': args.probe_interval, 'slow_rtt': args.slow_rtt, 'slow_high_watermark': args.slow_high_watermark, 'session_grace': args.session_grace}
+    history_dir = args.history_dir
+
+    def create_worker(worker_id, peers):
+        worker = SHARDED_ENGINES[args.engine](*server_args, history_dir=history_dir if worker_id == 0 else None, history_enabled=history_dir is not None, worker_id=worker_id, peers=peers, **server_options)
+        metrics_file = None
+        if args.metrics_file: stem, extension = os.path.splitext(args.metrics_file); metrics_file = f'{stem}-{worker_id + 1}{extension}'
+        worker.export_metrics(None if args.metrics_port is None else args.metrics_port + worker_id, metrics_file, args.metrics_interval)
+        return worker
+
+    if args.workers > 1:
+        if not hasattr(socket, 'SO_REUSEPORT') or not sys.platform.startswith('linux'): parser.error("--workers needs SO_REUSEPORT load balancing (Linux).")
+        log.info(f"Starting {args.workers} worker processes ({args.engine} engine)...")
+        log_pipeline.share_with_children()
+        sharding.run_workers(args.workers, create_worker)
+    else:
+        server = ENGINES[args.engine](*server_args, history_dir=history_dir, **server_options)
+        server.export_metrics(args.metrics_port, args.metrics_file, args.metrics_interval)
+        server.start()
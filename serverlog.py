@@ -0,0 +1,139 @@
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+import multiprocessing
+import logging.handlers
+
+LOG_FILE = 'server.log'
+JSON_LOG_FILE = 'server.jsonl'  # JSON lines go to their own file, never appended to a text log
+MAX_BYTES = 5 * 1024 * 1024
+BACKUP_COUNT = 5
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Per-message INFO lines (see EventLog) are logged at up to EVENT_RATE a second for each
+# event, after an initial burst of EVENT_BURST.
+EVENT_RATE = 20.0
+EVENT_BURST = 100
+
+STANDARD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+
+class TextFormatter(logging.Formatter):
+    """The classic one-line format, noting how many similar records the rate limit dropped."""
+    def __init__(self): super().__init__(TEXT_FORMAT)
+
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        return f"{text} ({suppressed} similar messages suppressed)" if suppressed else text
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and every field passed in `extra`."""
+    def format(self, record):
+        entry = {'time': f"{time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created))}.{int(record.msecs):03d}", 'level': record.levelname, 'logger': record.name, 'message': record.getMessage()}
+        entry.update((key, value) for key, value in vars(record).items() if key not in STANDARD_ATTRIBUTES)
+        if record.exc_info: entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text: entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class RateLimiter:
+    """Token buckets that let each event through at up to `rate` a second; rate 0 lets everything through.
+
+    Every event has a bucket holding up to `burst` records. allow() returns None for a
+    record that finds its bucket empty, and otherwise the number of records dropped
+    for that event since the last one let through.
+    """
+    def __init__(self, rate=EVENT_RATE, burst=EVENT_BURST):
+        self.rate, self.burst = rate, burst
+        self.buckets = {}  # event -> [tokens, last refill, records dropped since the last one let through]
+        self.lock = threading.Lock()
+
+    def allow(self, event):
+        if not self.rate: return 0
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(event)
+            if bucket is None: bucket = self.buckets[event] = [self.burst, now, 0]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate); bucket[1] = now
+            if tokens < 1: bucket[0] = tokens; bucket[2] += 1; return None
+            bucket[0] = tokens - 1; suppressed = bucket[2]; bucket[2] = 0
+            return suppressed
+
+
+class EventLog:
+    """Rate-limited INFO logging for per-message events such as forwards and ACKs.
+
+    The limit is checked before a LogRecord is created, so a dropped line costs a
+    dictionary lookup rather than a record. Lines that are logged carry the event
+    name and the given fields as structured `extra` fields, plus `suppressed` when
+    earlier lines for the event were dropped.
+    """
+    def __init__(self, logger, rate=EVENT_RATE, burst=EVENT_BURST):
+        self.logger = logger
+        self.limiter = RateLimiter(rate, burst)
+
+    def info(self, event, msg, *args, **fields):
+        if not self.logger.isEnabledFor(logging.INFO): return
+        suppressed = self.limiter.allow(event)
+        if suppressed is None: return
+        fields['event'] = event
+        if suppressed: fields['suppressed'] = suppressed
+        self.logger.info(msg, *args, extra=fields, stacklevel=2)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queues records as they are, so the logging thread never pays for formatting them.
+
+    That is safe because the server only passes immutable arguments (names, numbers)
+    to its log calls. Records bound for another process have to be pickled, so once
+    the queue is shared with worker processes they are formatted first, as usual.
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.cross_process = False
+
+    def prepare(self, record):
+        return super().prepare(record) if self.cross_process else record
+
+
+class LogPipeline:
+    """The server's log output, written by a background thread.
+
+    Log calls only put the record on a queue; a QueueListener thread formats it and
+    writes it to a size-rotated log file (text, or JSON lines with structured=True)
+    and to the console.
+    """
+    def __init__(self, logger, path=LOG_FILE, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT, structured=False, stream=sys.stdout):
+        file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        file_handler.setFormatter(JsonFormatter() if structured else TextFormatter())
+        handlers = [file_handler]
+        if stream is not None:
+            stream_handler = logging.StreamHandler(stream); stream_handler.setFormatter(TextFormatter()); handlers.append(stream_handler)
+        self.logger = logger
+        self.queue = queue.SimpleQueue()
+        self.handler = DeferredQueueHandler(self.queue)
+        self.listener = logging.handlers.QueueListener(self.queue, *handlers, respect_handler_level=True)
+        logger.addHandler(self.handler)
+        self.listener.start(); self.running = True
+        atexit.register(self.stop)
+
+    def share_with_children(self):
+        """Switches to a process-safe queue, so that worker processes forked afterwards log through this listener."""
+        self.listener.stop()
+        self.queue = self.listener.queue = self.handler.queue = multiprocessing.get_context('fork').Queue()
+        self.handler.cross_process = True
+        self.listener.start()
+
+    def stop(self):
+        """Writes out every queued record and stops the listener thread."""
+        if not self.running: return
+        self.running = False
+        self.listener.stop()
+        self.logger.removeHandler(self.handler)
+        for handler in self.listener.handlers: handler.close()
@@ -0,0 +1,372 @@
+import os
+import sys
+import time
+import signal
+import select
+import socket
+import json
+import struct
+import functools
+import itertools
+import threading
+import logging
+import multiprocessing
+import multiprocessing.connection
+
+import protocol
+import outbound
+import reliability
+
+log = logging.getLogger('ChatServer')
+
+# Messages on the bus between workers: a fixed header naming the operation, the worker
+# that sent it and the user it concerns, followed by an operation-specific body.
+BUS_HEADER_FORMAT = '! B B 16s'
+BUS_HEADER_SIZE = struct.calcsize(BUS_HEADER_FORMAT)
+BUS_PORT_FORMAT = '! H'
+BUS_PORT_SIZE = struct.calcsize(BUS_PORT_FORMAT)
+NAME_LENGTH_FORMAT = '! H'  # recipients of private messages are not checked against the 16-byte usernames
+NAME_LENGTH_SIZE = struct.calcsize(NAME_LENGTH_FORMAT)
+
+BUS_JOIN = 0x01         # user logged in on the sending worker
+BUS_LEAVE = 0x02        # user left the sending worker
+BUS_UDP = 0x03          # a datagram from user, received by a worker that does not own them
+BUS_BROADCAST = 0x04    # deliver the frame to every local user except user
+BUS_DELIVER = 0x05      # deliver the frame to local user
+BUS_HISTORY = 0x06      # store a message from user in the history kept by worker 0
+BUS_HISTORY_REQUEST = 0x07  # answer user's HISTORY_REQUEST from the history kept by worker 0
+BUS_ROOM_JOIN = 0x08    # user on the sending worker joined the room named by the body
+BUS_ROOM_LEAVE = 0x09   # user on the sending worker left the room named by the body
+BUS_ROOM = 0x0A         # deliver the frame to every local member of a room except user
+BUS_RESUME = 0x0B       # user reconnected to the sending worker with the session token in the body
+BUS_SESSION = 0x0C      # the state of user's session, as JSON, for the worker they resumed on; empty if it cannot resume
+
+BUS_BUFFER_SIZE = 4 * 1024 * 1024
+# Room for the largest reassembled datagram (MAX_FRAGMENTS pieces) with its headers; larger messages are refused.
+BUS_MAX_MESSAGE = 1024 * 1024
+BUS_SEND_TIMEOUT = 1.0
+
+
+def create_mesh(worker_count):
+    """Connects every pair of workers; returns, for each worker, a dict of peer worker id -> socket.
+
+    SOCK_SEQPACKET keeps message boundaries like a datagram socket, but queues up to the
+    socket buffer size instead of the handful of datagrams an AF_UNIX SOCK_DGRAM receiver
+    accepts before its senders block.
+    """
+    mesh = [{} for _ in range(worker_count)]
+    for a, b in itertools.combinations(range(worker_count), 2):
+        mesh[a][b], mesh[b][a] = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        for sock in (mesh[a][b], mesh[b][a]):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, BUS_BUFFER_SIZE)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, BUS_BUFFER_SIZE)
+    return mesh
+
+
+class ShardBus:
+    """Messages between the worker processes of one server, over a mesh of Unix socket pairs."""
+    def __init__(self, worker_id, peers):
+        self.worker_id = worker_id
+        self.peers = peers
+        self.buffers = {sock: bytearray(BUS_MAX_MESSAGE) for sock in peers.values()}  # one per socket: each may have its own reader thread
+
+    def send(self, worker, op, user, body=b''):
+        """Sends one bus message to a worker.
+
+        Waits at most BUS_SEND_TIMEOUT for room in the peer's buffer and drops the message
+        after that, so two workers writing to each other can never wait on each other for good.
+        """
+        sock = self.peers[worker]
+        message = struct.pack(BUS_HEADER_FORMAT, op, self.worker_id, user.encode('utf-8')) + body
+        if len(message) > BUS_MAX_MESSAGE:
+            log.warning(f"Worker {self.worker_id + 1}: bus message {op} for '{user}' to worker {worker + 1} is {len(message)} bytes, over the {BUS_MAX_MESSAGE} byte limit; dropped."); return
+        deadline = time.monotonic() + BUS_SEND_TIMEOUT
+        while True:
+            try:
+                sock.send(message, outbound.SEND_FLAGS); return
+            except BlockingIOError:
+                remaining = deadline - time.monotonic()
+                if remaining > 0 and select.select([], [sock], [], remaining)[1]: continue
+                log.warning(f"Worker {self.worker_id + 1}: bus to worker {worker + 1} is full, dropped message {op} for '{user}'."); return
+            except OSError as e:
+                log.warning(f"Worker {self.worker_id + 1}: bus message {op} for '{user}' to worker {worker + 1} failed: {e}"); return
+
+    def broadcast(self, op, user, body=b''):
+        """Sends one bus message to every other worker."""
+        for worker in self.peers: self.send(worker, op, user, body)
+
+    def receive(self, sock):
+        """Yields (op, origin, user, body) for every bus message waiting on one peer's socket.
+
+        A message that did not fit the receive buffer arrives cut short (MSG_TRUNC) and is dropped.
+        """
+        buffer = self.buffers[sock]
+        while True:
+            try:
+                received, _, flags, _ = sock.recvmsg_into([buffer], 0, outbound.SEND_FLAGS)
+            except BlockingIOError:
+                return
+            if not received: return
+            if flags & socket.MSG_TRUNC or received < BUS_HEADER_SIZE:
+                log.warning(f"Worker {self.worker_id + 1}: dropped a truncated bus message ({received} bytes received)."); continue
+            data = bytes(buffer[:received])
+            op, origin, user = struct.unpack_from(BUS_HEADER_FORMAT, data)
+            yield op, origin, user.decode('utf-8').strip('\x00'), memoryview(data)[BUS_HEADER_SIZE:]
+
+
+def pack_name(name):
+    """A length-prefixed username or room name, or an empty one for None."""
+    name = (name or '').encode('utf-8')
+    return struct.pack(NAME_LENGTH_FORMAT, len(name)) + name
+
+def unpack_name(body):
+    """Splits a body starting with pack_name() into the name (None if empty) and the rest."""
+    (name_len,) = struct.unpack_from(NAME_LENGTH_FORMAT, body); start = NAME_LENGTH_SIZE
+    return str(body[start:start + name_len], 'utf-8') or None, bytes(body[start + name_len:])
+
+def pack_address(addr):
+    """Prefix for a BUS_UDP body: the length-prefixed host followed by the port."""
+    host = addr[0].encode('utf-8')
+    return struct.pack('! B', len(host)) + host + struct.pack(BUS_PORT_FORMAT, addr[1])
+
+def unpack_address(body):
+    """Splits a BUS_UDP body into the client's (host, port) and the datagram."""
+    host_len = body[0]
+    host = str(body[1:1 + host_len], 'utf-8')
+    (port,) = struct.unpack_from(BUS_PORT_FORMAT, body, 1 + host_len)
+    return (host, port), bytes(body[1 + host_len + BUS_PORT_SIZE:])
+
+
+class ShardMixin:
+    """Makes a ChatServer engine one worker of a multi-process server.
+
+    Every worker binds the same TCP and UDP ports with SO_REUSEPORT and owns the
+    clients whose TCP connections the kernel gave it. Workers tell each other who
+    logged in where, and route over a ShardBus whatever concerns a user they do not
+    own: datagrams from that user go to the owner (which de-duplicates, ACKs and fans
+    out), broadcasts go to every worker, and private messages and pings go to the
+    recipient's owner. Workers also count each other's members of every room, so a room
+    message only goes to the workers where the room has members. Only worker 0 opens
+    the history store; with history_enabled, the others send it the messages to store
+    and the history requests to answer, and without it nothing goes over the bus. A
+    client that resumes its session on a different worker than the one that owns it
+    takes the session with it: the owner hands over its state and the frames that
+    waited for it, and the new worker becomes its owner.
+    """
+    def __init__(self, *args, worker_id, peers, history_enabled=False, **kwargs):
+        super().__init__(*args, reuse_port=True, **kwargs)
+        self.worker_id = worker_id
+        self.history_enabled = history_enabled  # whether worker 0 keeps a history the others can use
+        self.bus = ShardBus(worker_id, peers)
+        self.remote_users = {}
+        self.remote_rooms = {}  # room -> {worker: members there}
+        self.remote_lock = threading.Lock()
+        self.pending_resumes = {}  # username -> client info of a connection waiting for its session from another worker
+        for sock in peers.values(): self.add_reader(sock, functools.partial(self.handle_bus_messages, sock))
+        log.info(f"Worker {worker_id + 1}/{len(peers) + 1} started (pid {os.getpid()}).")
+
+    def owner_of(self, username):
+        """Returns the worker that owns a user connected elsewhere, or None if they are local or offline."""
+        if username in self.clients: return None
+        with self.remote_lock:
+            return self.remote_users.get(username)
+
+    def online_users(self):
+        users = super().online_users()
+        with self.remote_lock:
+            return users + list(self.remote_users)
+
+    def room_names(self):
+        rooms = super().room_names()
+        with self.remote_lock:
+            return list(set(rooms).union(self.remote_rooms))
+
+    def join_room(self, client_info, room):
+        joined = super().join_room(client_info, room)
+        if joined: self.bus.broadcast(BUS_ROOM_JOIN, client_info['username'], room.encode('utf-8'))
+        return joined
+
+    def leave_room(self, client_info, room, notify=True):
+        left = super().leave_room(client_info, room, notify)
+        if left: self.bus.broadcast(BUS_ROOM_LEAVE, client_info['username'], room.encode('utf-8'))
+        return left
+
+    def count_remote_member(self, room, worker, delta):
+        """Adjusts how many members of a room a worker has; returns whether the room appeared or disappeared there."""
+        with self.remote_lock:
+            workers = self.remote_rooms.setdefault(room, {})
+            count = workers.get(worker, 0) + delta
+            if count > 0: workers[worker] = count
+            else: workers.pop(worker, None)
+            if not workers: del self.remote_rooms[room]
+            return (count > 0) != (count - delta > 0)
+
+    def process_udp_packet(self, data, addr):
+        sender_id = protocol.unpack_header(data[:protocol.HEADER_SIZE])[1]
+        owner = self.owner_of(sender_id)
+        if owner is not None:
+            self.bus.send(owner, BUS_UDP, sender_id, pack_address(addr) + bytes(data)); return
+        super().process_udp_packet(data, addr)
+
+    def process_tcp_packet(self, client_info, msg_type, sender_id, payload, full_packet):
+        login = msg_type == protocol.MSG_TYPE_LOGIN and 'username' not in client_info  # a repeated LOGIN is ignored by the engine
+        if login and self.owner_of(sender_id) is not None:
+            log.warning(f"Login failed for {client_info['tcp_address']}: Username '{sender_id}' is already taken on another worker."); return False
+        keep_open = super().process_tcp_packet(client_info, msg_type, sender_id, payload, full_packet)
+        if login and keep_open: self.bus.broadcast(BUS_JOIN, sender_id)
+        return keep_open
+
+    def remove_client(self, client_info):
+        super().remove_client(client_info)
+        if client_info.get('username'): self.bus.broadcast(BUS_LEAVE, client_info['username'])
+
+    def end_connection(self, client_info):
+        if self.pending_resumes.get(client_info.get('resuming')) is client_info: del self.pending_resumes[client_info['resuming']]
+        super().end_connection(client_info)
+
+    def resume_session(self, client_info, username, token):
+        owner = self.owner_of(username)
+        if owner is None or not isinstance(token, str): return super().resume_session(client_info, username, token)
+        log.info(f"User '{username}' is resuming a session owned by worker {owner + 1}; asking for it.")
+        client_info['resuming'] = username; self.pending_resumes[username] = client_info
+        self.bus.send(owner, BUS_RESUME, username, token.encode('utf-8'))
+        return True
+
+    def hand_over_session(self, username, token, worker):
+        """Gives a local session to the worker its client reconnected to: first its state, then every frame that waited for it."""
+        with self.session_lock:
+            session = self.sessions.get(token)
+            if session is None or session['username'] != username or session['outbound'].closed:
+                log.info(f"Worker {worker + 1} asked for an unknown or expired session of '{username}'.")
+                self.bus.send(worker, BUS_SESSION, username); return
+            if not session.get('suspended'):
+                queue = session['outbound']; self.disconnect_client(session); self.suspend_client(session); self.release_outbound(queue)
+            session['suspended'] = None; session['superseded'] = True
+            self.flush_acks(session)
+            rooms = sorted(session['rooms']); dedup = session['dedup']
+            state = {'session': token, 'codec': session['codec'], 'features': sorted(session['features']), 'compress': session['compress'], 'rooms': rooms,
+                     'dedup': [dedup.highest, dedup.bitmap, dedup.cumulative, dedup.duplicates], 'udp_address': session.get('udp_address')}
+            # Removed without a BUS_LEAVE: the user stays online, on the other worker.
+            with self.remote_lock: self.remote_users[username] = worker
+            del self.sessions[token]; self.clients.remove(username, session); self.rtt_matrix.forget(username)
+            for room in rooms: self.leave_room(session, room, notify=False)
+            frames = session['outbound'].detach()
+        self.bus.send(worker, BUS_SESSION, username, json.dumps(state).encode('utf-8'))
+        for frame, _ in frames: self.bus.send(worker, BUS_DELIVER, username, bytes(frame))
+        log.info(f"Handed the session of '{username}' over to worker {worker + 1} ({len(frames)} frames waited for them).")
+
+    def take_over_session(self, username, state):
+        """Registers a session handed over by its previous owner on the connection that asked for it."""
+        client_info = self.pending_resumes.pop(username, None)
+        if client_info is not None and state is None:
+            super().resume_session(client_info, username, None); return
+        if client_info is not None:
+            client_info.update(username=username, codec=state['codec'], features=set(state['features']), compress=state['compress'], session=state['session'],
+                               dedup=reliability.DedupWindow(), acks=reliability.AckBatcher(), rooms=set(), fragments=protocol.Reassembler(), latency=reliability.LatencyStats(), slow=False)
+            client_info['dedup'].highest, client_info['dedup'].bitmap, client_info['dedup'].cumulative, client_info['dedup'].duplicates = state['dedup']
+            if state['udp_address']: client_info['udp_address'] = tuple(state['udp_address'])
+            if not self.clients.add(username, client_info): del client_info['username']; client_info = None
+        if client_info is None:
+            if state is not None:
+                log.warning(f"The session of '{username}' arrived after its connection was gone; ending it.")
+                with self.remote_lock: self.remote_users.pop(username, None)
+                self.bus.broadcast(BUS_LEAVE, username); self.roster_changed()
+            return
+        with self.remote_lock: self.remote_users.pop(username, None)
+        with self.session_lock: self.sessions[state['session']] = client_info
+        self.send_to_client(protocol.pack_data(protocol.MSG_TYPE_RESUME_TCP, protocol.SERVER_NAME, 0, {'session': state['session']}, client_info['codec']), client_info)
+        for room in state['rooms']: self.join_room(client_info, room)
+        self.bus.broadcast(BUS_JOIN, username)
+        log.info(f"User '{username}' resumed their session from {client_info['tcp_address']}, taken over from another worker.")
+
+    def broadcast_message(self, message, sender_id):
+        super().broadcast_message(message, sender_id)
+        self.bus.broadcast(BUS_BROADCAST, sender_id, bytes(message))
+
+    def send_private_message(self, message, recipient):
+        owner = self.owner_of(recipient)
+        if owner is None: super().send_private_message(message, recipient)
+        else: self.bus.send(owner, BUS_DELIVER, recipient, bytes(message))
+
+    def send_room_message(self, message, sender_id, room):
+        super().send_room_message(message, sender_id, room)
+        with self.remote_lock:
+            workers = list(self.remote_rooms.get(room, ()))
+        if workers:
+            body = pack_name(room) + bytes(message)
+            for worker in workers: self.bus.send(worker, BUS_ROOM, sender_id, body)
+
+    def record_history(self, message, sender_id, recipient=None, room=None):
+        if not self.history_enabled: return
+        if self.history is None and self.worker_id: self.bus.send(0, BUS_HISTORY, sender_id, pack_name(recipient) + pack_name(room) + bytes(message))
+        else: super().record_history(message, sender_id, recipient, room)
+
+    def send_history(self, client_info, request):
+        if self.history_enabled and self.history is None and self.worker_id: self.bus.send(0, BUS_HISTORY_REQUEST, client_info['username'], json.dumps(request).encode('utf-8'))
+        else: super().send_history(client_info, request)
+
+    def handle_bus_messages(self, sock):
+        """Applies every message waiting on the bus from one peer."""
+        for op, origin, user, body in self.bus.receive(sock):
+            if op == BUS_JOIN:
+                with self.remote_lock: self.remote_users[user] = origin
+                local = self.clients.get(user)
+                if local and origin < self.worker_id:
+                    # Two workers accepted the same name at once; the lower-numbered worker keeps it.
+                    log.warning(f"Username '{user}' also logged in on worker {origin + 1}; disconnecting the local session.")
+                    local['logged_out'] = True; self.disconnect_client(local)
+                    if local.get('suspended'): self.expire_session(local, local['suspended'])
+                self.roster_changed()
+            elif op == BUS_LEAVE:
+                with self.remote_lock:
+                    if self.remote_users.get(user) == origin: del self.remote_users[user]
+                self.roster_changed()
+            elif op == BUS_UDP:
+                addr, data = unpack_address(body)
+                super().process_udp_packet(data, addr)
+            elif op == BUS_BROADCAST:
+                super().broadcast_message(bytes(body), user)
+            elif op == BUS_DELIVER:
+                super().send_private_message(bytes(body), user)
+            elif op == BUS_ROOM_JOIN or op == BUS_ROOM_LEAVE:
+                if self.count_remote_member(str(body, 'utf-8'), origin, 1 if op == BUS_ROOM_JOIN else -1): self.rooms_changed()
+            elif op == BUS_ROOM:
+                room, message = unpack_name(body)
+                super().send_room_message(message, user, room)
+            elif op == BUS_HISTORY:
+                recipient, rest = unpack_name(body)
+                room, message = unpack_name(rest)
+                self.record_history(message, user, recipient, room)
+            elif op == BUS_HISTORY_REQUEST:
+                response = self.history_page(user, json.loads(bytes(body)))
+                self.send_private_message(protocol.pack_data(protocol.MSG_TYPE_HISTORY_RESPONSE_TCP, "SERVER", 0, response), user)
+            elif op == BUS_RESUME:
+                self.hand_over_session(user, str(body, 'utf-8'), origin)
+            elif op == BUS_SESSION:
+                self.take_over_session(user, json.loads(bytes(body)) if body else None)
+
+
+def run_workers(worker_count, make_server):
+    """Forks worker_count processes, each running make_server(worker_id, peers).start(), and waits for them."""
+    context = multiprocessing.get_context('fork')
+    mesh = create_mesh(worker_count)
+    processes = [context.Process(target=run_worker, args=(make_server, worker_id, mesh)) for worker_id in range(worker_count)]
+    for process in processes: process.start()
+    for peers in mesh:
+        for sock in peers.values(): sock.close()
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        # Workers route through each other, so the server stops as a whole when any of them exits.
+        multiprocessing.connection.wait([process.sentinel for process in processes])
+        log.error("A worker process exited; stopping the other workers.")
+    except (KeyboardInterrupt, SystemExit):
+        log.info("Stopping workers...")
+    finally:
+        for process in processes: process.terminate()
+        for process in processes: process.join()
+
+def run_worker(make_server, worker_id, mesh):
+    for other, peers in enumerate(mesh):
+        if other != worker_id:
+            for sock in peers.values(): sock.close()
+    make_server(worker_id, mesh[worker_id]).start()
@@ -0,0 +1,156 @@
+import os
+import random
+import socket
+import threading
+
+import pytest
+
+import protocol
+
+
+def long_packet(size, seq_num=7):
+    return protocol.pack_data(protocol.MSG_TYPE_TEXT_BROADCAST_UDP, 'alice', seq_num, {'text': os.urandom(size // 2).hex()}, protocol.CODEC_BINARY)
+
+
+def reassemble(reassembler, datagrams):
+    packets = []
+    for datagram in datagrams:
+        msg_type, _, seq_num, _ = protocol.unpack_header(datagram[:protocol.HEADER_SIZE])
+        assert msg_type == protocol.MSG_TYPE_FRAGMENT_UDP
+        packet = reassembler.add(seq_num, memoryview(datagram)[protocol.HEADER_SIZE:], 0.0)
+        if packet: packets.append(packet)
+    return packets
+
+
+def test_fragment_leaves_short_packets_alone():
+    packet = long_packet(100)
+    assert protocol.fragment(packet) == [packet]
+
+
+def test_fragments_fit_a_datagram_and_reassemble_in_any_order():
+    packet = long_packet(50_000)
+    datagrams = protocol.fragment(packet)
+    assert len(datagrams) > 1 and all(len(datagram) <= protocol.BUFFER_SIZE for datagram in datagrams)
+    random.Random(1).shuffle(datagrams)
+    assert reassemble(protocol.Reassembler(), datagrams) == [packet]
+
+
+def test_retransmission_fills_the_gaps_of_a_partial_packet():
+    packet = long_packet(50_000); reassembler = protocol.Reassembler()
+    datagrams = protocol.fragment(packet)
+    assert reassemble(reassembler, datagrams[:len(datagrams) // 2]) == []
+    assert reassemble(reassembler, datagrams[len(datagrams) // 2:]) == [packet]
+
+
+def test_fragment_refuses_packets_needing_too_many_fragments():
+    with pytest.raises(ValueError): protocol.fragment(long_packet(protocol.MAX_FRAGMENTS * protocol.BUFFER_SIZE))
+
+
+def test_reassembler_ignores_malformed_fragments():
+    reassembler = protocol.Reassembler()
+    assert reassembler.add(1, b'\x00', 0.0) is None
+    assert reassembler.add(1, b'\x00\x05\x00\x02data', 0.0) is None
+    assert reassembler.add(1, b'\x00\x00\x00\x01data', 0.0) is None
+    assert not reassembler.pending
+
+
+def test_largest_packet_survives_a_paced_burst_over_loopback():
+    packet = long_packet((protocol.MAX_FRAGMENTS - 1) * (protocol.BUFFER_SIZE - 64))
+    datagrams = protocol.fragment(packet)
+    with protocol.udp_receive_socket() as receiver, socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+        receiver.bind(('127.0.0.1', 0)); receiver.settimeout(1.0)
+        protocol.send_datagrams(sender, datagrams, receiver.getsockname())
+        received = [receiver.recvfrom(protocol.BUFFER_SIZE)[0] for _ in datagrams]
+    assert reassemble(protocol.Reassembler(), received) == [packet]
+
+
+def test_transcode_reencodes_for_the_peer_codec():
+    packet = protocol.pack_data(protocol.MSG_TYPE_PRIVATE_TEXT_UDP, 'alice', 3, {'recipient': 'bob', 'text': 'hi ' * 100}, protocol.CODEC_BINARY, compress=True)
+    assert protocol.transcode(packet, protocol.CODEC_BINARY, compress=True) is packet
+    for codec in protocol.SUPPORTED_CODECS:
+        transcoded = protocol.transcode(packet, codec)
+        header, payload = transcoded[:protocol.HEADER_SIZE], transcoded[protocol.HEADER_SIZE:]
+        assert protocol.unpack_header(header)[:3] == (protocol.MSG_TYPE_PRIVATE_TEXT_UDP, 'alice', 3)
+        assert protocol.frame_codec(transcoded) == codec and not transcoded[0] & protocol.FLAG_COMPRESSED
+        assert protocol.unpack_payload(payload, protocol.header_flags(header)) == {'recipient': 'bob', 'text': 'hi ' * 100}
+
+
+def test_transcode_refuses_undecodable_payloads():
+    corrupt = protocol.pack_raw(protocol.MSG_TYPE_TEXT_BROADCAST_UDP | protocol.FLAG_BINARY_PAYLOAD, 'alice', 1, b'\xff\xff\xff')
+    with pytest.raises(ValueError): protocol.transcode(corrupt, protocol.CODEC_JSON)
+    deflated = protocol.pack_raw(protocol.MSG_TYPE_TEXT_BROADCAST_UDP | protocol.FLAG_COMPRESSED, 'alice', 1, b'not deflate')
+    with pytest.raises(ValueError): protocol.transcode(deflated, protocol.CODEC_JSON)
+
+
+def frames_from(reader, chunks):
+    frames = []
+    for chunk in chunks: frames += [(frame.msg_type, frame.sender_id, frame.seq_num, bytes(frame.packet)) for frame in reader.feed(chunk)]
+    return frames
+
+
+def test_frame_reader_splits_a_stream_however_it_is_cut():
+    packets = [protocol.pack_data(protocol.MSG_TYPE_TEXT_BROADCAST_UDP, 'alice', seq, {'text': 'x' * seq * 37}) for seq in range(1, 40)]
+    stream = b''.join(packets); expected = [(protocol.MSG_TYPE_TEXT_BROADCAST_UDP, 'alice', seq, packet) for seq, packet in enumerate(packets, 1)]
+    for size in (1, 7, protocol.HEADER_SIZE, 1000, len(stream)):
+        reader = protocol.FrameReader(buffer_size=64)
+        assert frames_from(reader, [stream[i:i + size] for i in range(0, len(stream), size)]) == expected
+
+
+def test_frame_reader_reads_frames_larger_than_its_buffer_from_a_socket():
+    packet = protocol.pack_data(protocol.MSG_TYPE_TEXT_BROADCAST_UDP, 'alice', 1, {'text': 'y' * 300_000})
+    left, right = socket.socketpair()
+    with left, right:
+        sender = threading.Thread(target=lambda: (left.sendall(packet + packet[:10]), left.shutdown(socket.SHUT_WR))); sender.start()
+        reader = protocol.FrameReader(right); frames = []
+        while (batch := reader.read_frames()) is not None: frames += [bytes(frame.packet) for frame in batch]
+        sender.join()
+    assert frames == [packet]
+
+
+def test_frame_reader_refuses_oversized_frames():
+    header = protocol.pack_raw(protocol.MSG_TYPE_TEXT_BROADCAST_UDP, 'alice', 1, b'')[:protocol.HEADER_SIZE - 4] + (protocol.MAX_FRAME_SIZE + 1).to_bytes(4, 'big')
+    with pytest.raises(ValueError): protocol.FrameReader().feed(header)
+
+
+def test_frame_reader_gives_back_the_buffer_of_a_large_frame():
+    big = protocol.pack_data(protocol.MSG_TYPE_TEXT_BROADCAST_UDP, 'alice', 1, {'text': 'z' * 10_000}); small = protocol.pack_data(protocol.MSG_TYPE_TEXT_BROADCAST_UDP, 'alice', 2, {'text': 'hi'})
+    reader = protocol.FrameReader(buffer_size=64)
+    [frame] = reader.feed(big)
+    assert len(reader.buffer) == 64 and bytes(frame.packet) == big
+    assert len(reader.feed(big + small[:10])) == 1 and len(reader.buffer) > 64
+    assert [bytes(frame.packet) for frame in reader.feed(small[10:])] == [small] and len(reader.buffer) == 64
+
+
+@pytest.mark.parametrize('codec', protocol.SUPPORTED_CODECS)
+@pytest.mark.parametrize('compress', (False, True))
+def test_payloads_round_trip(codec, compress):
+    payload = {'recipient': 'bob', 'text': 'héllo ' * 60, 'users': ['alice', 'bob'], 'version': 7, 'ranges': [1, 3, 5, 9], 'sent': 2 ** 40}
+    packet = protocol.pack_data(protocol.MSG_TYPE_PRIVATE_TEXT_UDP, 'alice', 42, payload, codec, compress)
+    header = packet[:protocol.HEADER_SIZE]
+    assert protocol.unpack_header(header) == (protocol.MSG_TYPE_PRIVATE_TEXT_UDP, 'alice', 42, len(packet) - protocol.HEADER_SIZE)
+    assert protocol.frame_codec(packet) == codec and bool(protocol.header_flags(header) & protocol.FLAG_COMPRESSED) == compress
+    assert protocol.unpack_payload(packet[protocol.HEADER_SIZE:], protocol.header_flags(header)) == payload
+    assert protocol.peek_recipient(packet[protocol.HEADER_SIZE:], protocol.header_flags(header)) == 'bob'
+
+
+def test_binary_codec_falls_back_to_json_for_fields_it_cannot_encode():
+    packet = protocol.pack_data(protocol.MSG_TYPE_HISTORY_RESPONSE_TCP, 'SERVER', 0, {'messages': [{'text': 'hi'}]}, protocol.CODEC_BINARY)
+    assert protocol.frame_codec(packet) == protocol.CODEC_JSON
+    assert protocol.encode_binary_payload({'version': -1}) is None and protocol.encode_binary_payload({'users': ['a\0b']}) is None
+
+
+def test_unpack_payload_returns_none_for_garbage():
+    assert protocol.unpack_payload(b'{not json') is None
+    assert protocol.unpack_payload(b'\x02\x00\x00\x00\x10short', protocol.FLAG_BINARY_PAYLOAD) is None
+    assert protocol.unpack_payload(b'\xee', protocol.FLAG_BINARY_PAYLOAD) is None
+    assert protocol.unpack_payload(b'junk', protocol.FLAG_COMPRESSED) is None
+
+
+def test_split_batch_returns_every_complete_frame():
+    packets = [protocol.pack_data(protocol.MSG_TYPE_TEXT_BROADCAST_UDP, 'alice', seq, {'text': f'm{seq}'}) for seq in range(1, 6)]
+    [batch] = protocol.pack_batch('alice', packets, compress=True)
+    header = batch[:protocol.HEADER_SIZE]
+    assert protocol.unpack_header(header)[0] == protocol.MSG_TYPE_BATCH
+    assert [frame.packet for frame in protocol.split_batch(memoryview(batch)[protocol.HEADER_SIZE:], protocol.header_flags(header))] == packets
+    plain = b''.join(packets)
+    assert len(protocol.split_batch(plain[:-3])) == 4
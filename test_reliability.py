@@ -0,0 +1,62 @@
+import pytest
+
+import reliability
+
+
+def test_dedup_window_reports_repeats():
+    window = reliability.DedupWindow()
+    assert window.check_and_mark(1) and window.check_and_mark(2)
+    assert not window.check_and_mark(1) and not window.check_and_mark(2)
+    assert window.duplicates == 2
+
+
+def test_dedup_window_accepts_reordered_numbers_once():
+    window = reliability.DedupWindow()
+    for seq_num in (1, 2, 5, 3): assert window.check_and_mark(seq_num)
+    assert window.cumulative == 3
+    assert window.check_and_mark(4) and window.cumulative == 5
+    assert not window.check_and_mark(4)
+
+
+def test_dedup_window_refuses_numbers_beyond_the_window():
+    window = reliability.DedupWindow(size=8)
+    with pytest.raises(ValueError): window.check_and_mark(9)
+    assert window.check_and_mark(8) and window.cumulative == 0
+    with pytest.raises(ValueError): window.check_and_mark(2 ** 31)
+    assert window.highest == 8 and window.bitmap == 1 << 7
+
+
+def test_dedup_window_slides_as_gaps_fill_and_never_forgets_a_gap():
+    window = reliability.DedupWindow(size=8)
+    for seq_num in range(2, 9): assert window.check_and_mark(seq_num)
+    with pytest.raises(ValueError): window.check_and_mark(10)
+    assert window.check_and_mark(1) and window.cumulative == 8 and window.bitmap == 0
+    assert window.check_and_mark(16) and not window.check_and_mark(5)
+    assert window.check_and_mark(9) and window.cumulative == 9
+
+
+def test_spoofed_jump_does_not_silence_the_sender():
+    window = reliability.DedupWindow()
+    for seq_num in range(1, 11): window.check_and_mark(seq_num)
+    for spoofed in (500_010, 2 ** 31):
+        with pytest.raises(ValueError): window.check_and_mark(spoofed)
+    assert all(window.check_and_mark(seq_num) for seq_num in range(11, 16))
+    assert window.cumulative == 15 and window.duplicates == 0
+
+
+def test_cumulative_ack_does_not_cover_a_gap_across_the_window():
+    window = reliability.DedupWindow(size=8); batcher = reliability.AckBatcher()
+    for seq_num in (1, 2, 9, 10):
+        assert window.check_and_mark(seq_num); batcher.add(seq_num)
+    with pytest.raises(ValueError): window.check_and_mark(30)
+    payload = batcher.take(window.cumulative)
+    assert payload == {'cumulative': 2, 'ranges': [9, 10]}
+    acked = reliability.acked_by(payload)
+    assert [seq_num for seq_num in range(1, 33) if acked(seq_num)] == [1, 2, 9, 10]
+
+
+def test_ack_batch_ranges_merge_consecutive_numbers():
+    batcher = reliability.AckBatcher()
+    for seq_num in (9, 5, 6, 7, 3, 7): batcher.add(seq_num)
+    assert batcher.take(3) == {'cumulative': 3, 'ranges': [5, 7, 9, 9]}
+    assert batcher.take(3) is None
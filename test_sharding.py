@@ -0,0 +1,41 @@
+import socket
+
+import pytest
+
+import sharding
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, 'AF_UNIX') or not hasattr(socket.socket, 'recvmsg_into'), reason="the bus uses Unix SOCK_SEQPACKET sockets")
+
+
+@pytest.fixture
+def buses():
+    mesh = sharding.create_mesh(2)
+    yield sharding.ShardBus(0, mesh[0]), sharding.ShardBus(1, mesh[1]), mesh
+    for peers in mesh:
+        for sock in peers.values(): sock.close()
+
+
+def test_bus_carries_messages_up_to_the_limit_whole(buses):
+    first, second, mesh = buses
+    body = bytes(range(256)) * 1000
+    first.send(1, sharding.BUS_DELIVER, 'alice', body); first.send(1, sharding.BUS_LEAVE, 'bob')
+    received = [(op, origin, user, bytes(data)) for op, origin, user, data in second.receive(mesh[1][0])]
+    assert received == [(sharding.BUS_DELIVER, 0, 'alice', body), (sharding.BUS_LEAVE, 0, 'bob', b'')]
+
+
+def test_bus_refuses_messages_over_the_limit(buses):
+    first, second, mesh = buses
+    first.send(1, sharding.BUS_DELIVER, 'alice', b'x' * sharding.BUS_MAX_MESSAGE)
+    assert list(second.receive(mesh[1][0])) == []
+
+
+def test_bus_drops_truncated_messages(buses):
+    first, second, mesh = buses
+    mesh[0][1].send(b'x' * (sharding.BUS_MAX_MESSAGE + 1)); first.send(1, sharding.BUS_LEAVE, 'bob')
+    assert [(op, user) for op, _, user, _ in second.receive(mesh[1][0])] == [(sharding.BUS_LEAVE, 'bob')]
+
+
+def test_names_longer_than_a_byte_can_count_cross_the_bus():
+    name = 'ü' * 200
+    assert sharding.unpack_name(sharding.pack_name(name) + b'rest') == (name, b'rest')
+    assert sharding.unpack_name(sharding.pack_name(None)) == (None, b'')
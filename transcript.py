@@ -0,0 +1,127 @@
+import collections
+import itertools
+import time
+import customtkinter as ctk
+
+TRANSCRIPT_HISTORY = 5000  # messages kept in memory; older ones are forgotten
+POOL_SIZE = 40             # bubble widgets; enough to fill a tall window, the oldest are clipped
+SCROLL_STEP = 3
+
+KIND_OWN, KIND_OTHER, KIND_SYSTEM, KIND_ERROR = range(4)
+
+OWN_BUBBLE_COLOR = ("#3B8ED0", "#1F6AA5"); OTHER_BUBBLE_COLOR = ("#1565C0", "#1f2b38")
+OWN_TEXT_COLOR = "white"; OTHER_TEXT_COLOR = ("white", "#E0E0E0")
+SYSTEM_COLOR = ("#00838F", "#00BCD4"); ERROR_COLOR = ("#C62828", "#F44336")
+
+
+def format_time(timestamp):
+    """HH:MM for today's messages, with the date for older ones."""
+    local = time.localtime(timestamp)
+    return time.strftime("%H:%M" if local[:3] == time.localtime()[:3] else "%d.%m.%Y %H:%M", local)
+
+
+class Transcript(ctk.CTkFrame):
+    """The chat transcript, rendering only the newest messages in view with a fixed pool of bubbles.
+
+    Messages live in a bounded in-memory store. The widgets are POOL_SIZE slots stacked
+    from the bottom up; new arrivals and scrolling re-bind the slots to other messages
+    instead of creating widgets, so memory and layout cost stay constant however long
+    the conversation runs. Rendering waits for idle time, so every message added in one
+    Tk callback shares a single render. on_reach_top() is called whenever the oldest
+    stored message is in view, so older messages can be fetched and prepended.
+    """
+    def __init__(self, master, on_reach_top=None, **kwargs):
+        super().__init__(master, **kwargs)
+        self.on_reach_top = on_reach_top
+        self.messages = collections.deque(maxlen=TRANSCRIPT_HISTORY)
+        self.offset = 0  # messages hidden below the view; 0 follows new messages
+        self.render_pending = False
+        self.grid_columnconfigure(0, weight=1); self.grid_rowconfigure(0, weight=1)
+        self.viewport = ctk.CTkFrame(self, fg_color="transparent"); self.viewport.grid(row=0, column=0, sticky="nsew"); self.viewport.pack_propagate(False)
+        self.scrollbar = ctk.CTkScrollbar(self, command=self.on_scrollbar); self.scrollbar.grid(row=0, column=1, sticky="ns")
+        self.slots = [self.create_slot() for _ in range(POOL_SIZE)]
+        for slot in self.slots: slot['frame'].pack(side="bottom", fill="x")
+        self.bind_wheel(self.viewport)
+
+    def create_slot(self):
+        """Creates one recyclable bubble; slots[0] is the bottom of the view."""
+        frame = ctk.CTkFrame(self.viewport, fg_color="transparent", height=1)
+        bubble = ctk.CTkFrame(frame, corner_radius=10)
+        header = ctk.CTkLabel(bubble, text="", font=("Arial", 10)); body = ctk.CTkLabel(bubble, text="", font=("Arial", 14))
+        for widget in (frame, bubble, header, body): self.bind_wheel(widget)
+        return {'frame': frame, 'bubble': bubble, 'header': header, 'body': body, 'message': None}
+
+    def bind_wheel(self, widget):
+        widget.bind("<MouseWheel>", lambda event: self.scroll(SCROLL_STEP if event.delta > 0 else -SCROLL_STEP))
+        widget.bind("<Button-4>", lambda event: self.scroll(SCROLL_STEP)); widget.bind("<Button-5>", lambda event: self.scroll(-SCROLL_STEP))
+
+    def add_message(self, kind, sender, text, timestamp=None):
+        """Stores a message and schedules a render; a view scrolled up stays on the messages it shows."""
+        self.messages.append((kind, sender, text, format_time(time.time() if timestamp is None else timestamp)))
+        if self.offset: self.offset = min(self.offset + 1, len(self.messages) - 1)
+        self.schedule_render()
+
+    def prepend_messages(self, entries):
+        """Stores (kind, sender, text, timestamp) entries, oldest first, before every stored message.
+
+        Only as many as fit under TRANSCRIPT_HISTORY are kept, so scrollback never pushes out newer messages.
+        """
+        entries = entries[max(len(entries) - (TRANSCRIPT_HISTORY - len(self.messages)), 0):]
+        self.messages.extendleft((kind, sender, text, format_time(timestamp)) for kind, sender, text, timestamp in reversed(entries))
+        self.schedule_render()
+
+    def schedule_render(self):
+        if not self.render_pending: self.render_pending = True; self.after_idle(self.render)
+
+    def render(self):
+        """Binds the slots to the messages in view, moving slots rather than re-binding when the view shifts."""
+        self.render_pending = False
+        desired = list(itertools.islice(reversed(self.messages), self.offset, self.offset + POOL_SIZE))
+        shown = len(desired); desired += [None] * (POOL_SIZE - shown)
+        bottom = self.slots[0]['message']
+        shift = next((i for i, message in enumerate(desired) if bottom is not None and message is bottom), 0)
+        if shift: self.rotate(shift)
+        wraplength = self.winfo_toplevel().winfo_width() * 0.4
+        for slot, message in zip(self.slots, desired): self.bind_slot(slot, message, wraplength)
+        total = len(self.messages)
+        if total: self.scrollbar.set((total - self.offset - shown) / total, (total - self.offset) / total)
+        else: self.scrollbar.set(0.0, 1.0)
+        if self.on_reach_top and self.offset + shown >= total: self.on_reach_top()
+
+    def rotate(self, shift):
+        """Moves the top `shift` slots to the bottom, where the newest messages go."""
+        self.slots = self.slots[-shift:] + self.slots[:-shift]
+        for i in range(shift - 1, -1, -1): self.slots[i]['frame'].pack(side="bottom", fill="x", before=self.slots[i + 1]['frame'])
+
+    def bind_slot(self, slot, message, wraplength):
+        """Shows a message in a slot, or hides the slot for None."""
+        if slot['message'] is message: return
+        slot['message'] = message; bubble = slot['bubble']; header = slot['header']; body = slot['body']
+        if message is None: bubble.pack_forget(); return
+        kind, sender, text, timestamp = message
+        header.pack_forget(); body.pack_forget()
+        if kind in (KIND_SYSTEM, KIND_ERROR):
+            bubble.configure(fg_color="transparent"); bubble.pack(anchor="center", padx=0, pady=5)
+            body.configure(text=text, text_color=SYSTEM_COLOR if kind == KIND_SYSTEM else ERROR_COLOR, font=("Arial", 12, "italic"), wraplength=0, justify="center"); body.pack()
+        else:
+            own = kind == KIND_OWN; anchor = "e" if own else "w"; text_color = OWN_TEXT_COLOR if own else OTHER_TEXT_COLOR
+            bubble.configure(fg_color=OWN_BUBBLE_COLOR if own else OTHER_BUBBLE_COLOR); bubble.pack(anchor=anchor, padx=(50, 5) if own else (5, 50), pady=4)
+            header.configure(text=f"{sender} - {timestamp}", text_color=text_color); header.pack(anchor=anchor, padx=10, pady=(5, 0))
+            body.configure(text=text, text_color=text_color, font=("Arial", 14), wraplength=wraplength, justify="right" if own else "left"); body.pack(anchor=anchor, padx=10, pady=(0, 5), fill="x")
+
+    def scroll(self, lines):
+        """Moves the view `lines` messages back in time (negative: towards the newest)."""
+        self.offset = min(max(self.offset + lines, 0), max(len(self.messages) - 1, 0)); self.schedule_render()
+
+    def scroll_to_bottom(self): self.offset = 0; self.schedule_render()
+
+    def on_scrollbar(self, *args):
+        """Handles CTkScrollbar 'moveto' and 'scroll' commands, measured in messages rather than pixels."""
+        total = len(self.messages)
+        if not total: return
+        if args[0] == "moveto":
+            shown = min(POOL_SIZE, total)
+            self.offset = min(max(total - round(float(args[1]) * total) - shown, 0), total - 1); self.schedule_render()
+        elif args[0] == "scroll":
+            step = POOL_SIZE // 2 if args[2] == "pages" else SCROLL_STEP
+            self.scroll(-int(args[1]) * step)